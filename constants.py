@@ -124,6 +124,23 @@ def sort_protocols_for_ui(protocols):
 DEFAULT_ENABLED_PROTOCOLS = list(_BASE_PROTOCOL_UI_ORDER)
 
 
+# --- Live feed --------------------------------------------------------------
+# Capped Redis Stream the monitor XADDs every knock to (fields: proto, knock=JSON).
+# Stream IDs double as the WebSocket clients' resume cursors. Each knock is also
+# XADDed, under the same ID, to a short per-protocol stream capped at FEED_SIZE, so
+# a quiet protocol's feed tab stays full however busy the shared stream is.
+FEED_STREAM = 'knock:feed'
+
+
+def proto_feed_stream(name):
+    """Per-protocol feed stream key, e.g. knock:feed:ssh."""
+    return f"{FEED_STREAM}:{str(name).lower()}"
+
+# Bumped by the monitor whenever it registers a new row in the `sources` table, so the
+# web tier knows to reload its cached copy.
+SOURCES_VERSION_KEY = 'knock:sources_version'
+
+
 # --- Database schema version ------------------------------------------------
 # Monotonic integer stamped into the DB's `PRAGMA user_version` by updatedb.py
 # after a successful migration, and checked by the services at startup.
@@ -8,22 +8,38 @@ caught attacking this honeypot:
 
   GET /check-ranges?ranges=198.51.100.0/24,203.0.113.0/22&list=year
   GET /check-asn?asn=12345&list=year
-  GET /ip/198.51.100.45
-
-Membership checks run against an in-memory snapshot rebuilt hourly from
-ip_intel in one DB pass; only confirmed hits touch the database again (one
-IN(...) query for metadata). Redis holds rate-limit state and health metrics.
+  GET /ip/198.51.100.45                (IPv4 or IPv6 throughout)
+  POST /check-bulk?list=year           (newline-separated CIDRs/IPs, optionally gzipped)
+
+Every endpoint is answered from an in-memory snapshot of ip_intel and
+ip_intel_proto (membership plus hit metadata), kept current by merging in the
+rows seen since the last pass every minute or two, with a periodic full rebuild
+as an integrity check; requests never touch the database. The snapshot is one
+file that all workers memory-map. Redis holds rate-limit state and health metrics.
 See API_DESIGN.md for the full design.
 """
 import asyncio
 import bisect
+import calendar
+import fcntl
+import gzip
+import hashlib
 import ipaddress
+import json
+import mmap
 import os
+import socket
 import sqlite3
+import struct
 import sys
 import time
+import zlib
+from array import array
+from collections import OrderedDict
 from contextlib import asynccontextmanager
 from datetime import datetime, timedelta, timezone
+from itertools import accumulate, compress, repeat
+from operator import sub
 from pathlib import Path
 
 import geoip2.database
@@ -32,14 +48,17 @@ import redis.asyncio as aioredis
 import uvicorn
 from fastapi import FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 
 ROOT = Path(__file__).resolve().parent.parent.parent
 sys.path.insert(0, str(ROOT))
 from constants import PROTO_NAME  # noqa: E402
+from visitor_log import VisitorLogger, init_visitors_db  # noqa: E402
 
 KNOCK_DB = ROOT / os.environ.get('DB_DIR', 'data') / 'knock_knock.db'
 VISITORS_DB = ROOT / os.environ.get('DB_DIR', 'data') / 'visitors.db'
+SNAPSHOT_PATH = Path(os.environ.get('KNOCK_API_SNAPSHOT',
+                                    ROOT / os.environ.get('DB_DIR', 'data') / 'knock-api-snapshot.bin'))
 GEOIP_CITY = '/usr/share/GeoIP/GeoLite2-City.mmdb'
 GEOIP_ASN = '/usr/share/GeoIP/GeoLite2-ASN.mmdb'
 
@@ -52,14 +71,32 @@ TRUST_PROXY_HEADERS = os.environ.get('TRUST_PROXY_HEADERS', 'true').lower() not
 
 WINDOWS = {'year': 365, 'month': 30}
 MAX_RANGES = 10          # CIDRs per check-ranges request
-MIN_PREFIXLEN = 16       # largest range accepted (a /16)
+MIN_PREFIXLEN = {4: 16, 6: 32}   # largest range accepted per family (a /16; an RIR-sized /32)
 MAX_HITS = 25000         # detail rows returned before truncation (safety ceiling only;
-                         # far above any real ASN/range — total_matched is always exact)
+                         # far above any real ASN/range — total_matched is always exact;
+                         # format=ndjson streams every row)
+STREAM_CHUNK = 1000      # hit rows formatted and sent per NDJSON write
+FORMATS = ('json', 'ndjson')
+PAGE_DEFAULT = 50        # top-prefixes / asn-summary rows per page
+PAGE_MAX = 500           # small enough to serialize inline (INLINE_HITS)
+SORTS = ('hits', 'ips')  # rankings: total hits, or distinct listed IPs
 DAY_CAP = 500            # per-IP requests/day, all endpoints (backstop against abuse)
 CHECK_CAP = 20           # per-IP check-ranges / check-asn requests/hour
+BULK_MAX_ENTRIES = 100_000   # CIDRs/IPs per check-bulk request
+BULK_MAX_BYTES = 4 << 20     # check-bulk body, after decompression
+BULK_MAX_MATCHES = 100_000   # listed IPs streamed per check-bulk request (total_matched stays exact)
+BULK_HOUR_CAP = 200_000      # per-IP check-bulk units/hour: distinct entries or IPs streamed, whichever is more
 IP_MIN_CAP = 30          # per-IP /ip lookups/minute
-GLOBAL_MIN_CAP = 300     # global /ip lookups/minute (token bucket)
+GLOBAL_MIN_CAP = 3000    # global /ip lookups/minute (token bucket; answered from memory)
+GLOBAL_LEASE = 30        # global tokens a worker takes from Redis at a time
 WAIT_MAX = 25            # seconds a /ip request will wait for a global token
+REFRESH_SECONDS = int(os.environ.get('KNOCK_API_REFRESH_SECONDS', '90'))     # incremental snapshot merge
+REBUILD_SECONDS = int(os.environ.get('KNOCK_API_REBUILD_SECONDS', '21600'))  # full rebuild (integrity check)
+RELOAD_SECONDS = 5       # how often workers check for a newer snapshot file
+REFRESH_OVERLAP = 120    # seconds before the high-water mark each refresh re-reads
+INLINE_HITS = 500        # larger hit lists are formatted on a worker thread
+CACHE_BYTES = 32 << 20   # per-worker budget for cached (compressed) check responses
+GZIP_MIN_BYTES = 1024    # smaller cached responses are stored and sent uncompressed
 
 app = FastAPI(title='knock-api', docs_url=None, redoc_url=None)
 # Let the docs page's "Run" widget call the API from the main site (cross-origin).
@@ -71,43 +108,375 @@ app.add_middleware(
     allow_headers=['*'],
 )
 R: aioredis.Redis = None
+guard_script = lease_script = global_budget = None
 city_reader = asn_reader = None
+visitor_logger = None
 
 
-# --- In-memory snapshot (rebuilt hourly, one DB pass) -----------------------
+# --- In-memory snapshot (columnar, mmap-shared, incremental refresh) --------
+# One process (whichever holds the snapshot lock) builds the snapshot and writes it
+# to SNAPSHOT_PATH; every worker, the builder included, maps that file read-only, so
+# N workers share one copy in the page cache. Each window holds one Snapshot per
+# address family. Columns are native uint32, and timestamps are ip_intel's (local)
+# wall-clock strings read as UTC epoch seconds.
 
-class Snapshot:
-    """Sorted-int IP membership for one time window, plus a per-ASN index."""
-    __slots__ = ('ips', 'ip_strs', 'asn_map', 'generated_at')
+SNAPSHOT_MAGIC = b'KNOCKAPI'
+SNAPSHOT_VERSION = 5
+# IP key columns per family: IPv4 is one uint32, IPv6 a (high, low) pair of uint64
+KEY_COLUMNS = {4: ('ip',), 6: ('ip_hi', 'ip_lo')}
+KEY_TYPE = {4: 'I', 6: 'Q'}
+COLUMNS = ('last_seen', 'asn', 'hits', 'first_seen', 'ban_until')   # per IP, aligned with ips
+PROTO_COLUMNS = ('proto', 'hits', 'last_seen')   # per (IP, protocol), sorted by IP
+NO_BAN = 0xFFFFFFFF      # ban_until NULL (0 is a permanent ban); asn / first_seen use 0
+WIDEST = max(WINDOWS, key=WINDOWS.get)   # the other windows are subsets of it
+PREFIX_LEN = {4: 24, 6: 48}   # the prefix each family's offender statistics group by
+assert array('I').itemsize == 4 and array('Q').itemsize == 8
 
-    def __init__(self):
-        self.ips = []            # sorted list[int]
-        self.ip_strs = {}        # int -> original string (avoids re-formatting)
-        self.asn_map = {}        # asn -> sorted list[int]
-        self.generated_at = None
 
+class Keys128:
+    """Sorted 128-bit IPs over paired uint64 arrays, as a sequence bisect can search."""
+    __slots__ = ('hi', 'lo')
+
+    def __init__(self, hi, lo):
+        self.hi, self.lo = hi, lo
+
+    def __len__(self):
+        return len(self.hi)
+
+    def __getitem__(self, i):
+        return self.hi[i] << 64 | self.lo[i]
+
+    def __iter__(self):
+        return (h << 64 | lo for h, lo in zip(self.hi, self.lo))
+
+
+def _keys(version, ip_int):
+    """ip_int as its family's key column values."""
+    return (ip_int,) if version == 4 else (ip_int >> 64, ip_int & 0xFFFFFFFFFFFFFFFF)
+
+
+def _key_view(version, arrays):
+    return arrays[0] if version == 4 else Keys128(*arrays)
+
+
+class Aggregates:
+    """Offender statistics per group (a /24 or /48 prefix, or an ASN), sorted by key.
+
+    ips (listed IPs), hits (their total) and last_seen are aligned with keys.
+    Each group's protocol mix is CSR like the ASN index: proto and proto_hits
+    at [proto_offsets[g]:proto_offsets[g + 1]], busiest first. by_hits and
+    by_ips hold the group keys worst first, so a page of either ranking is a
+    slice, and a refresh moves only the groups that changed.
+    """
+    TYPES = {'keys': 'Q', 'ips': 'I', 'hits': 'Q', 'last_seen': 'I', 'proto_offsets': 'I',
+             'proto': 'I', 'proto_hits': 'Q', 'by_hits': 'Q', 'by_ips': 'Q'}
+    __slots__ = tuple(TYPES)
+
+    def __init__(self, arrays=None):
+        for name, code in self.TYPES.items():
+            setattr(self, name, arrays[name] if arrays else array(code))
+
+    def find(self, key):
+        g = bisect.bisect_left(self.keys, key)
+        return g if g < len(self.keys) and self.keys[g] == key else None
+
+    def row(self, g):
+        """Response fields for group g."""
+        lo, hi = self.proto_offsets[g], self.proto_offsets[g + 1]
+        return {'ips': self.ips[g], 'hits': self.hits[g], 'last_seen': _ts(self.last_seen[g]),
+                'protocols': [{'proto': PROTO_NAME.get(p, str(p)), 'hits': h}
+                              for p, h in zip(self.proto[lo:hi], self.proto_hits[lo:hi])]}
+
+    def arrays(self):
+        return {name: getattr(self, name) for name in self.TYPES}
+
+
+def _busiest(row):
+    return -row[1], row[0]   # a (proto, hits) mix row: busiest first, ties by protocol
+
+
+def _aggregate(rows):
+    """Aggregates from (group key, hits, last_seen, [(proto, hits)]) per IP."""
+    index, ips, hits, seen, mixes = {}, [], [], [], []
+    for key, h, last, mix in rows:
+        g = index.get(key)
+        if g is None:
+            index[key] = len(ips)
+            ips.append(1)
+            hits.append(h)
+            seen.append(last)
+            mixes.append(mix)
+            continue
+        ips[g] += 1
+        hits[g] += h
+        if last > seen[g]:
+            seen[g] = last
+        m = mixes[g]
+        if type(m) is list:
+            m = mixes[g] = dict(m)
+        for proto, n in mix:
+            m[proto] = m.get(proto, 0) + n
+    keys = list(index)
+    order = sorted(range(len(keys)), key=keys.__getitem__)   # already sorted for prefixes
+    agg = Aggregates()
+    agg.keys = array('Q', map(keys.__getitem__, order))
+    agg.ips, agg.hits, agg.last_seen = (array(code, map(col.__getitem__, order))
+                                        for col, code in ((ips, 'I'), (hits, 'Q'), (seen, 'I')))
+    offsets = agg.proto_offsets
+    offsets.append(0)
+    for g in order:
+        mix = mixes[g]
+        for proto, n in sorted(mix.items() if type(mix) is dict else mix, key=_busiest):
+            agg.proto.append(proto)
+            agg.proto_hits.append(n)
+        offsets.append(len(agg.proto))
+    # worst first; the sort is stable, so ties stay in key order and pages don't shuffle
+    for rank, col in ((agg.by_hits, agg.hits), (agg.by_ips, agg.ips)):
+        rank.extend(map(agg.keys.__getitem__, sorted(range(len(keys)), key=col.__getitem__, reverse=True)))
+    return agg
+
+
+def _group_deltas(changes, group):
+    """Per group: [ips, hits, newest last_seen added, newest removed, {proto: hits}].
+
+    changes are (ip, before, after) pairs of Snapshot.contrib tuples (None
+    where the IP isn't listed), and group(ip, contrib) is the IP's group key,
+    or None to leave it out.
+    """
+    out = {}
+    for ip, before, after in changes:
+        kept = before and after and group(ip, before) == group(ip, after) and after[2] >= before[2]
+        for c, sign in ((before, -1), (after, 1)):
+            key = c and group(ip, c)
+            if key is None:
+                continue
+            d = out.get(key) or out.setdefault(key, [0, 0, 0, 0, {}])
+            d[0] += sign
+            d[1] += sign * c[1]
+            if sign > 0:
+                d[2] = max(d[2], c[2])
+            elif not kept:   # a re-seen IP can't take its group's last_seen back
+                d[3] = max(d[3], c[2])
+            for proto, n in c[3]:
+                d[4][proto] = d[4].get(proto, 0) + sign * n
+    return out
+
+
+def _fold(agg, deltas, newest):
+    """agg with _group_deltas applied; groups without a delta are copied as slices.
+
+    A group's last_seen only moves forward as IPs join it. When an IP that
+    leaves may have held it, newest(key) recomputes it from the members.
+    """
+    changed = {}
+    for key, (ips, hits, added, removed, mix) in deltas.items():
+        g = agg.find(key)
+        last = added
+        if g is not None:
+            ips += agg.ips[g]
+            hits += agg.hits[g]
+            lo, hi = agg.proto_offsets[g], agg.proto_offsets[g + 1]
+            for proto, n in zip(agg.proto[lo:hi], agg.proto_hits[lo:hi]):
+                mix[proto] = mix.get(proto, 0) + n
+        if ips <= 0:
+            changed[key] = None
+            continue
+        if g is not None:
+            last = newest(key) if removed >= agg.last_seen[g] else max(agg.last_seen[g], added)
+        changed[key] = (ips, hits, last), sorted(((p, n) for p, n in mix.items() if n > 0), key=_busiest)
+    new = Aggregates()
+    new.keys, (new.ips, new.hits, new.last_seen), new.proto_offsets, (new.proto, new.proto_hits) = (
+        _splice_groups(agg.keys, agg.proto_offsets, [agg.ips, agg.hits, agg.last_seen],
+                       [agg.proto, agg.proto_hits], changed))
+    new.by_hits = _rerank(agg.by_hits, agg, new, 'hits', changed)
+    new.by_ips = _rerank(agg.by_ips, agg, new, 'ips', changed)
+    return new
+
+
+def _rerank(rank, old, new, col, keys):
+    """rank (old's keys worst first by col, ties in key order) with keys moved to their new place."""
+    old_col, new_col = getattr(old, col), getattr(new, col)
+
+    def place(key):   # a rank entry's sort position, by its old value
+        return -old_col[old.find(key)], key
+    drop, inserts = [], []
+    for key in keys:
+        g = old.find(key)
+        if g is not None:
+            i = bisect.bisect_left(rank, (-old_col[g], key), key=place)
+            drop.append((i, i + 1))
+        g = new.find(key)
+        if g is not None:
+            at = (-new_col[g], key)
+            inserts.append((bisect.bisect_left(rank, at, key=place), at))
+    inserts.sort()
+    (out,) = _splice([rank], drop, [(i, (key,)) for i, (_, key) in inserts])
+    return out
+
+
+class Snapshot:
+    """One time window and address family: sorted IPs, hit metadata, ASN index.
+
+    ips is a sorted sequence of ints over the key columns (KEY_COLUMNS), and
+    each name in COLUMNS is an array aligned with it. protos holds the
+    ip_intel_proto rows of those IPs (PROTO_COLUMNS, keyed by proto_ips),
+    sorted by IP and then by hits descending, so an IP's breakdown is one
+    bisected run. ASN membership is CSR: asn_keys is sorted, and the members of
+    asn_keys[k] are the indexes asn_idx[asn_offsets[k]:asn_offsets[k + 1]] into
+    ips, in ascending IP order. prefixes aggregates the IPs per PREFIX_LEN
+    prefix (keyed by the prefix's top bits); asns, per ASN across both families,
+    is the window's and shared by its Snapshots. Arrays are memoryviews over the
+    shared snapshot file (or arrays while being built) and are never mutated
+    once published.
+    """
+    __slots__ = ('version', 'keys', 'ips', 'columns', 'proto_keys', 'proto_ips', 'protos',
+                 'asn_keys', 'asn_offsets', 'asn_idx', 'prefixes', 'asns', 'generated_at')
+
+    def __init__(self, version, keys=None, columns=None, proto_keys=None, protos=None):
+        self.version = version
+        self.keys = keys or [array(KEY_TYPE[version]) for _ in KEY_COLUMNS[version]]
+        self.ips = _key_view(version, self.keys)
+        self.columns = dict(zip(COLUMNS, columns or [array('I') for _ in COLUMNS]))
+        self.proto_keys = proto_keys or [array(KEY_TYPE[version]) for _ in KEY_COLUMNS[version]]
+        self.proto_ips = _key_view(version, self.proto_keys)
+        self.protos = dict(zip(PROTO_COLUMNS, protos or [array('I') for _ in PROTO_COLUMNS]))
+        self.asn_keys = array('I')
+        self.asn_offsets = array('I', [0])
+        self.asn_idx = array('I')
+        self.prefixes = self.asns = Aggregates()
+        self.generated_at = None
 
-snapshots: dict[str, Snapshot] = {}
+    def find(self, ip_int):
+        """Index of ip_int in ips, or None if it isn't listed."""
+        i = bisect.bisect_left(self.ips, ip_int)
+        return i if i < len(self.ips) and self.ips[i] == ip_int else None
+
+    def asn_members(self, asn):
+        """Indexes into ips of the listed IPs in asn (empty if none)."""
+        k = bisect.bisect_left(self.asn_keys, asn)
+        if k == len(self.asn_keys) or self.asn_keys[k] != asn:
+            return self.asn_idx[:0]
+        return self.asn_idx[self.asn_offsets[k]:self.asn_offsets[k + 1]]
+
+    def protocols(self, ip_int):
+        p = self.protos
+        lo = bisect.bisect_left(self.proto_ips, ip_int)
+        hi = bisect.bisect_right(self.proto_ips, ip_int, lo)
+        return [{'proto': PROTO_NAME.get(p['proto'][j], str(p['proto'][j])),
+                 'hits': p['hits'][j], 'last_seen': _ts(p['last_seen'][j])} for j in range(lo, hi)]
+
+    def hit(self, i):
+        """Response row for the IP at index i: hits, first/last seen, protocol breakdown."""
+        c, ip_int = self.columns, self.ips[i]
+        return {'ip': ip_str(ip_int, self.version), 'hits': c['hits'][i],
+                'first_seen': _ts(c['first_seen'][i]) if c['first_seen'][i] else None,
+                'last_seen': _ts(c['last_seen'][i]), 'protocols': self.protocols(ip_int)}
+
+    def hits(self, indexes):
+        return [self.hit(i) for i in indexes]
+
+    def range_of(self, lo, hi):
+        """Indexes into ips of the IPs in [lo, hi)."""
+        start = bisect.bisect_left(self.ips, lo)
+        return range(start, bisect.bisect_left(self.ips, hi, start))
+
+    def newest(self, indexes):
+        """The latest last_seen among the IPs at indexes (0 if none)."""
+        return max(map(self.columns['last_seen'].__getitem__, indexes), default=0)
+
+    def contrib(self, i):
+        """(asn, hits, last_seen, [(proto, hits)]) of the IP at index i, as the aggregates count it."""
+        c, ip_int = self.columns, self.ips[i]
+        lo = bisect.bisect_left(self.proto_ips, ip_int)
+        hi = bisect.bisect_right(self.proto_ips, ip_int, lo)
+        return (c['asn'][i], c['hits'][i], c['last_seen'][i],
+                list(zip(self.protos['proto'][lo:hi], self.protos['hits'][lo:hi])))
+
+    def index_csr(self):
+        """Fill the ASN index from the asn column."""
+        asns = self.columns['asn']
+        order = sorted(range(len(self.ips)), key=asns.__getitem__)   # stable: IP order within an ASN
+        by_asn = list(map(asns.__getitem__, order))
+        start = bisect.bisect_left(by_asn, 1)                         # skip asn 0 (unknown)
+        self.asn_keys = array('I', sorted(set(by_asn[start:])))
+        self.asn_offsets = array('I', [bisect.bisect_left(by_asn, a) - start for a in self.asn_keys])
+        self.asn_offsets.append(len(order) - start)
+        self.asn_idx = array('I', order[start:])
+
+    def per_ip(self):
+        """(ip, index, hits, last_seen, [(proto, hits)]) per IP, walking ips and protos together."""
+        proto_ips = list(self.proto_ips)
+        proto_ips.append(None)   # sentinel: ends the last IP's run
+        mixes = list(zip(self.protos['proto'], self.protos['hits']))
+        j = 0
+        for i, (ip, hits, seen) in enumerate(zip(self.ips, self.columns['hits'], self.columns['last_seen'])):
+            while proto_ips[j] is not None and proto_ips[j] < ip:   # orphaned proto rows
+                j += 1
+            start = j
+            while proto_ips[j] == ip:
+                j += 1
+            mix = mixes[start:j]
+            yield ip, i, hits, seen, mix
+
+    def arrays(self):
+        names = KEY_COLUMNS[self.version]
+        return {**dict(zip(names, self.keys)), **self.columns,
+                **{f'proto_{n}': a for n, a in zip(names, self.proto_keys)},
+                **{f'proto_{c}': a for c, a in self.protos.items()},
+                'asn_keys': self.asn_keys, 'asn_offsets': self.asn_offsets, 'asn_idx': self.asn_idx,
+                **{f'prefix_{n}': a for n, a in self.prefixes.arrays().items()}}
+
+
+snapshots: dict[str, dict[int, Snapshot]] = {}   # window -> family -> Snapshot
 
 
 def ro_conn(path):
     return sqlite3.connect(f'file:{path}?mode=ro', uri=True)
 
 
-def build_snapshots():
-    """One pass over ip_intel builds both windows; ASN comes from GeoLite2."""
-    cutoffs = {w: (datetime.now() - timedelta(days=d)).strftime('%Y-%m-%d %H:%M:%S')
-               for w, d in WINDOWS.items()}
-    fresh = {w: Snapshot() for w in WINDOWS}
-    now = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
-    with ro_conn(KNOCK_DB) as conn:
-        rows = conn.execute(
-            'SELECT ip, last_seen, asn FROM ip_intel WHERE last_seen >= ?',
-            (cutoffs['year'],)).fetchall()
-    for ip, last_seen, asn in rows:
+def ip_str(n, version=4):
+    # inet_ntop matches how the honeypots' sockets wrote the address into ip_intel
+    if version == 4:
+        return socket.inet_ntoa(n.to_bytes(4, 'big'))
+    return socket.inet_ntop(socket.AF_INET6, n.to_bytes(16, 'big'))
+
+
+def _ts(t):
+    """A snapshot timestamp back in ip_intel's 'YYYY-MM-DD HH:MM:SS' form."""
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(t))
+
+
+def _cutoffs(now):
+    """Per window: (last_seen string for SQL, epoch seconds for the columns)."""
+    out = {}
+    for w, d in WINDOWS.items():
+        t = now - timedelta(days=d)
+        out[w] = (t.strftime('%Y-%m-%d %H:%M:%S'), calendar.timegm(t.timetuple()))
+    return out
+
+
+def _stamp():
+    return datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def _ip_key(ip):
+    """(family, int) for an ip_intel key, or None if it isn't an address."""
+    for version, family in ((4, socket.AF_INET), (6, socket.AF_INET6)):
         try:
-            ip_int = int(ipaddress.IPv4Address(ip))
-        except (ipaddress.AddressValueError, ValueError):
+            return version, int.from_bytes(socket.inet_pton(family, ip), 'big')
+        except (OSError, TypeError):
+            pass
+    return None
+
+
+def _read_rows(conn, since):
+    """(family, ip_int, (COLUMNS values), last_seen string) per ip_intel row seen since."""
+    for ip, last_seen, ts, asn, hits, first_seen, ban_until in conn.execute(
+            "SELECT ip, last_seen, CAST(strftime('%s', last_seen) AS INTEGER), asn, hits, "
+            "CAST(strftime('%s', first_seen) AS INTEGER), ban_until "
+            'FROM ip_intel WHERE last_seen >= ?', (since,)):
+        key = _ip_key(ip)
+        if key is None:
             continue
         if asn is None and asn_reader:
             # rows not re-observed since the asn column was added
@@ -115,31 +484,479 @@ def build_snapshots():
                 asn = asn_reader.asn(ip).autonomous_system_number
             except geoip2.errors.AddressNotFoundError:
                 pass
-        for w, snap in fresh.items():
-            if last_seen >= cutoffs[w]:
-                snap.ips.append(ip_int)
-                snap.ip_strs[ip_int] = ip
-                if asn is not None:
-                    snap.asn_map.setdefault(asn, []).append(ip_int)
-    for snap in fresh.values():
-        snap.ips.sort()
-        for lst in snap.asn_map.values():
-            lst.sort()
-        snap.generated_at = now
+        yield (*key, (ts or 0, asn or 0, min(hits or 0, NO_BAN), first_seen or 0,
+                      NO_BAN if ban_until is None else ban_until), last_seen)
+
+
+def _read_protos(conn, since):
+    """(family, ip_int, proto, hits, last_seen) for the protocol rows of the IPs seen since."""
+    for ip, proto, hits, ts in conn.execute(
+            "SELECT p.ip, p.proto, p.hits, CAST(strftime('%s', p.last_seen) AS INTEGER) "
+            # CROSS JOIN keeps ip_intel as the outer loop: a small delta then costs one
+            # primary-key probe per row instead of a pass over ip_intel_proto
+            'FROM ip_intel i CROSS JOIN ip_intel_proto p ON p.ip = i.ip WHERE i.last_seen >= ?',
+            (since,)):
+        key = _ip_key(ip)
+        if key is not None:
+            yield *key, proto or 0, min(hits or 0, NO_BAN), ts or 0
+
+
+def _proto_order(row):
+    return row[0], row[1], -row[3]   # by family and IP, then busiest protocol first
+
+
+def _typecode(arr):
+    return arr.typecode if isinstance(arr, array) else arr.format
+
+
+def _raw(arr):
+    """The bytes of an array or view, without copying."""
+    return memoryview(arr).cast('B')
+
+
+def _gather(arrays, keep):
+    """The elements of each array at the (ascending) indexes in keep."""
+    return [array(_typecode(a), map(a.__getitem__, keep)) for a in arrays]
+
+
+def _splice(arrays, drop, inserts):
+    """arrays (aligned) minus the (start, stop) ranges in drop, plus (index, row) inserts.
+
+    The ranges don't overlap. An insert at index i lands before element i;
+    inserts at the same index keep their given order. Unchanged runs are copied
+    as whole slices, so the cost is a memcpy plus work per change.
+    """
+    out = [array(_typecode(a)) for a in arrays]
+    start = 0
+    events = sorted([(i, 0, row) for i, row in inserts] + [(lo, 1, hi) for lo, hi in drop],
+                    key=lambda e: e[:2])
+    for pos, dropped, row in events:
+        for d, s in zip(out, arrays):
+            d.frombytes(_raw(s[start:pos]))
+        if dropped:
+            start = row
+            continue
+        for d, v in zip(out, row):
+            d.append(v)
+        start = pos
+    for d, s in zip(out, arrays):
+        d.frombytes(_raw(s[start:]))
+    return out
+
+
+GONE = 0xFFFFFFFF   # _remap's index for a dropped element
+
+
+def _remap(n, drop, inserts):
+    """Old index -> new index across _splice(drop, inserts) of n elements (GONE if dropped)."""
+    out = array('I')
+    start = shift = 0
+    for pos, dropped, stop in sorted([(i, 0, 0) for i in inserts] + [(lo, 1, hi) for lo, hi in drop]):
+        out.extend(range(start + shift, pos + shift))
+        if dropped:
+            out.extend(repeat(GONE, stop - pos))
+            shift -= stop - pos
+            start = stop
+        else:
+            shift += 1
+            start = pos
+    out.extend(range(start + shift, n + shift))
+    return out
+
+
+def _splice_groups(keys, offsets, columns, runs, changed):
+    """A CSR layout with whole groups replaced.
+
+    keys (sorted) and columns are aligned per group, and group g's rows are
+    runs[:][offsets[g]:offsets[g + 1]]. changed maps a key to its new
+    (column values, rows), or to None to drop the group. Returns (keys,
+    columns, offsets, runs); the unchanged groups are copied as slices.
+    """
+    drop, inserts, run_drop, run_inserts = [], [], [], []
+    for key in sorted(changed):
+        g = bisect.bisect_left(keys, key)
+        if g < len(keys) and keys[g] == key:
+            drop.append((g, g + 1))
+            run_drop.append((offsets[g], offsets[g + 1]))
+        if changed[key] is not None:
+            values, rows = changed[key]
+            inserts.append((g, (key, *values, len(rows))))
+            run_inserts.extend((offsets[g], row) for row in rows)
+    lengths = array('I', map(sub, offsets[1:], offsets[:-1]))
+    out = _splice([keys, *columns, lengths], drop, inserts)
+    return (out[0], out[1:-1], array('I', accumulate(out[-1], initial=0)),
+            _splice(runs, run_drop, run_inserts))
+
+
+def _build(version, rows, protos):
+    """A family's widest-window Snapshot from sorted _read_rows / _read_protos output."""
+    n_keys = len(KEY_COLUMNS[version])
+    kt = KEY_TYPE[version]
+    cols = list(zip(*(_keys(version, r[1]) + r[2] for r in rows)))
+    pcols = list(zip(*(_keys(version, p[1]) + p[2:] for p in protos)))
+    if not rows:
+        return Snapshot(version)
+    return Snapshot(version,
+                    [array(kt, c) for c in cols[:n_keys]], [array('I', c) for c in cols[n_keys:]],
+                    [array(kt, c) for c in pcols[:n_keys]] if protos else None,
+                    [array('I', c) for c in pcols[n_keys:]] if protos else None)
+
+
+def _derive(widest, cutoffs, generated_at):
+    """Every window's Snapshots from the widest window's rows."""
+    fresh = {}
+    for w, (_, cutoff) in cutoffs.items():
+        fresh[w] = {}
+        for version, snap in widest.items():
+            if w != WIDEST:
+                keep = [i for i, t in enumerate(snap.columns['last_seen']) if t >= cutoff]
+                n_keys = len(snap.keys)
+                rows = _gather([*snap.keys, *snap.columns.values()], keep)
+                members = set(_key_view(version, rows[:n_keys]))
+                keep = [j for j, ip in enumerate(snap.proto_ips) if ip in members]
+                protos = _gather([*snap.proto_keys, *snap.protos.values()], keep)
+                snap = Snapshot(version, rows[:n_keys], rows[n_keys:], protos[:n_keys], protos[n_keys:])
+            snap.index_csr()
+            snap.generated_at = generated_at
+            fresh[w][version] = snap
+        _aggregate_window(fresh[w])
     return fresh
 
 
+def _aggregate_window(families):
+    """Each Snapshot's prefix aggregates and the window's shared ASN aggregates, from scratch."""
+    rows = {v: list(s.per_ip()) for v, s in families.items()}
+    asns = _aggregate((s.columns['asn'][i], hits, seen, mix)
+                      for v, s in families.items() for _, i, hits, seen, mix in rows[v]
+                      if s.columns['asn'][i])
+    for version, snap in families.items():
+        shift = (32 if version == 4 else 128) - PREFIX_LEN[version]
+        snap.prefixes = _aggregate((ip >> shift, hits, seen, mix)
+                                   for ip, _, hits, seen, mix in rows[version])
+        snap.asns = asns
+
+
+def _reindex(old, new, remap, dirty, joined):
+    """new's ASN index: old's remapped, with the runs of the dirty ASNs rebuilt.
+
+    remap is _remap's old -> new index map, dirty the ASNs that gained or lost
+    a member, and joined the IPs each of them gained.
+    """
+    asns = new.columns['asn']
+    changed = {}
+    for asn in dirty:
+        members = [j for j in map(remap.__getitem__, old.asn_members(asn)) if j != GONE and asns[j] == asn]
+        members.extend(map(new.find, joined.get(asn, ())))
+        changed[asn] = ((), [(j,) for j in sorted(members)]) if members else None
+    idx = array('I', map(remap.__getitem__, old.asn_idx))
+    keys, _, offsets, (idx,) = _splice_groups(old.asn_keys, old.asn_offsets, [], [idx], changed)
+    return keys, offsets, idx
+
+
+def write_snapshots(fresh, path, high_water):
+    """Write every window to path atomically (temp file + rename)."""
+    header = {'version': SNAPSHOT_VERSION, 'high_water': high_water, 'windows': {}}
+    blobs, offset = [], 0
+
+    def place(arrays):
+        """Queue arrays for writing; returns their {name: [offset, length, typecode]}."""
+        nonlocal offset
+        spec = {}
+        for name, arr in arrays.items():
+            spec[name] = [offset, len(arr), _typecode(arr)]
+            size = len(arr) * memoryview(arr).itemsize
+            blobs.append((arr, -size % 8))   # keep every array 8-byte aligned
+            offset += size + -size % 8
+        return spec
+
+    for w, families in fresh.items():
+        entry = header['windows'][w] = {'generated_at': None, 'families': {}}
+        for version, snap in families.items():
+            entry['generated_at'] = snap.generated_at
+            entry['families'][str(version)] = place(snap.arrays())
+        entry['asns'] = place(snap.asns.arrays())
+    head = json.dumps(header).encode()
+    pad = -(len(SNAPSHOT_MAGIC) + 4 + len(head)) % 8
+    tmp = path.with_name(path.name + '.tmp')
+    with open(tmp, 'wb') as f:
+        f.write(SNAPSHOT_MAGIC + struct.pack('<I', len(head) + pad) + head + b' ' * pad)
+        for arr, gap in blobs:
+            f.write(_raw(arr))
+            f.write(b'\0' * gap)
+    os.replace(tmp, path)
+
+
+def load_snapshots(path):
+    """Map a snapshot file read-only; returns (snapshots, header, file identity)."""
+    with open(path, 'rb') as f:
+        st = os.fstat(f.fileno())
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if mm[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+        raise ValueError(f'{path}: not a knock-api snapshot')
+    (head_len,) = struct.unpack_from('<I', mm, len(SNAPSHOT_MAGIC))
+    base = len(SNAPSHOT_MAGIC) + 4 + head_len
+    header = json.loads(mm[len(SNAPSHOT_MAGIC) + 4:base])
+    if header['version'] != SNAPSHOT_VERSION:
+        raise ValueError(f'{path}: snapshot version {header["version"]}')
+    view = memoryview(mm)
+
+    def arrays_of(spec):
+        return {name: view[base + off:base + off + n * array(code).itemsize].cast(code)
+                for name, (off, n, code) in spec.items()}
+
+    loaded = {}
+    for w, entry in header['windows'].items():
+        loaded[w] = {}
+        asns = Aggregates(arrays_of(entry['asns']))
+        for version, spec in entry['families'].items():
+            version = int(version)
+            arrays = arrays_of(spec)
+            names = KEY_COLUMNS[version]
+            snap = Snapshot(version, [arrays[n] for n in names], [arrays[c] for c in COLUMNS],
+                            [arrays[f'proto_{n}'] for n in names],
+                            [arrays[f'proto_{c}'] for c in PROTO_COLUMNS])
+            snap.asn_keys, snap.asn_offsets, snap.asn_idx = (
+                arrays['asn_keys'], arrays['asn_offsets'], arrays['asn_idx'])
+            snap.prefixes = Aggregates({n: arrays[f'prefix_{n}'] for n in Aggregates.TYPES})
+            snap.asns = asns
+            snap.generated_at = entry['generated_at']
+            loaded[w][version] = snap
+    return loaded, header, (st.st_ino, st.st_mtime_ns)
+
+
+def _drift(old, new, high_water):
+    """{difference: count} between two Snapshots of one family, for IPs last seen by high_water.
+
+    Per IP it compares every column and the protocol rows. An IP the rebuild
+    saw after high_water moved since the file was written and is skipped.
+    """
+    def by_ip(snap):
+        proto = [snap.proto_ips, *snap.protos.values()]
+        runs = {}
+        for ip, *row in zip(*proto):
+            runs.setdefault(ip, []).append(tuple(row))
+        return {ip: (tuple(c[i] for c in snap.columns.values()), sorted(runs.get(ip, [])))
+                for i, ip in enumerate(snap.ips)}
+    a, b = by_ip(old), by_ip(new)
+    moved = {ip for ip, (cols, _) in b.items() if cols[0] > high_water}
+    drift = {'only in incremental': len(a.keys() - b.keys() - moved),
+             'only in rebuild': len(b.keys() - a.keys() - moved)}
+    both = [ip for ip in a.keys() & b.keys() if ip not in moved]
+    for c, name in enumerate(COLUMNS):
+        drift[name] = sum(a[ip][0][c] != b[ip][0][c] for ip in both)
+    drift['protocols'] = sum(a[ip][1] != b[ip][1] for ip in both)
+    return {n: count for n, count in drift.items() if count}
+
+
+class SnapshotBuilder:
+    """Writes the snapshot file: full rebuilds and incremental refreshes.
+
+    Keeps no state between runs. The windows in the file and the high-water
+    mark in its header are what a refresh starts from, so a worker
+    that takes over the lock picks up where the previous builder stopped.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def rebuild(self, now=None, check=False):
+        """Full rebuild from one ip_intel pass; with check, log drift from the file.
+
+        The check first refreshes the file at the same now, so both sides share
+        the window cutoffs, and compares only IPs last seen by its high-water
+        mark: a difference is then something the incremental merge got wrong
+        (or can't see, like a deleted row or an unban), not new traffic.
+        """
+        now = now or datetime.now()
+        cutoffs = _cutoffs(now)
+        since = cutoffs[WIDEST][0]
+        if check:
+            self.refresh(now)
+            current, header, _ = load_snapshots(self.path)
+        with ro_conn(KNOCK_DB) as conn:
+            rows = sorted(_read_rows(conn, since), key=lambda r: r[:2])
+            protos = sorted(_read_protos(conn, since), key=_proto_order)
+        widest = {v: _build(v, [r for r in rows if r[0] == v], [p for p in protos if p[0] == v])
+                  for v in KEY_COLUMNS}
+        if check and header['high_water']:
+            high_water = calendar.timegm(time.strptime(header['high_water'], '%Y-%m-%d %H:%M:%S'))
+            for v, old in current[WIDEST].items():
+                drift = _drift(old, widest[v], high_water)
+                if drift:
+                    print(f'snapshot drift (IPv{v}): ' + ', '.join(f'{n} {c}' for n, c in drift.items()),
+                          file=sys.stderr)
+        write_snapshots(_derive(widest, cutoffs, _stamp()), self.path,
+                        max((r[3] for r in rows), default=''))
+
+    def refresh(self, now=None):
+        """Merge rows seen since the high-water mark into every window and expire aged-out IPs.
+
+        Each window is merged on its own rather than re-derived from the
+        year, and a family with nothing to merge or expire is carried over.
+        """
+        now = now or datetime.now()
+        cutoffs = _cutoffs(now)
+        current, header, _ = load_snapshots(self.path)
+        high_water = header['high_water']
+        # Re-read REFRESH_OVERLAP before the high-water mark: rows written later in
+        # that same second, and bans the monitor records just after the knock that
+        # triggered them, would otherwise be missed. Re-reading a row is a no-op.
+        since = high_water and (datetime.strptime(high_water, '%Y-%m-%d %H:%M:%S')
+                                - timedelta(seconds=REFRESH_OVERLAP)).strftime('%Y-%m-%d %H:%M:%S')
+        with ro_conn(KNOCK_DB) as conn:
+            delta = list(_read_rows(conn, since))
+            delta_protos = sorted(_read_protos(conn, since), key=_proto_order)
+        high_water = max([high_water, *(r[3] for r in delta)])
+        generated_at = _stamp()
+        fresh = {}
+        for w, (_, cutoff) in cutoffs.items():
+            fresh[w], changes = {}, {}
+            for v, old in current[w].items():
+                fresh[w][v], changes[v] = self._merge(old, [r for r in delta if r[0] == v],
+                                                      [p for p in delta_protos if p[0] == v], cutoff)
+            self._fold_aggregates(current[w], fresh[w], changes)
+            for snap in fresh[w].values():
+                snap.generated_at = generated_at
+        write_snapshots(fresh, self.path, high_water)
+
+    @staticmethod
+    def _fold_aggregates(old, new, changes):
+        """Carry a window's prefix and ASN aggregates forward by its families' changes."""
+        for version, snap in new.items():
+            if changes[version]:
+                shift = (32 if version == 4 else 128) - PREFIX_LEN[version]
+                snap.prefixes = _fold(old[version].prefixes,
+                                      _group_deltas(changes[version], lambda ip, c: ip >> shift),
+                                      lambda key: snap.newest(snap.range_of(key << shift, (key + 1) << shift)))
+        asns = old[4].asns
+        if any(changes.values()):
+            asns = _fold(asns, _group_deltas([c for v in changes.values() for c in v], lambda ip, c: c[0] or None),
+                         lambda asn: max(s.newest(s.asn_members(asn)) for s in new.values()))
+        for snap in new.values():
+            snap.asns = asns
+
+    @staticmethod
+    def _merge(old, delta, delta_protos, cutoff):
+        """One family's window: old plus delta rows, minus rows before cutoff.
+
+        Returns (snapshot, changes): the changes are (ip, before, after)
+        Snapshot.contrib pairs for _group_deltas, and with none the snapshot
+        is old itself. Otherwise every array, the ASN index included, is
+        spliced: unchanged runs are copied as slices, so the cost is a memcpy
+        plus work per changed IP.
+        """
+        version = old.version
+        runs = {}
+        for p in delta_protos:
+            runs.setdefault(p[1], []).append(p[2:])
+        updates, inserts, added, joined = {}, [], [], {}   # joined: asn -> IPs that are new to it
+        for _, ip_int, values, _ in delta:
+            if values[0] < cutoff:
+                continue
+            i = old.find(ip_int)
+            if i is None:
+                inserts.append((bisect.bisect_left(old.ips, ip_int), _keys(version, ip_int) + values))
+                added.append((ip_int, values))
+                joined.setdefault(values[1], []).append(ip_int)
+                continue
+            lo = bisect.bisect_left(old.proto_ips, ip_int)
+            hi = bisect.bisect_right(old.proto_ips, ip_int, lo)
+            if (values != tuple(c[i] for c in old.columns.values())   # an overlap re-read changes nothing
+                    or runs.get(ip_int, []) != list(zip(*(c[lo:hi] for c in old.protos.values())))):
+                updates[i] = values
+        expired = [i for i in compress(range(len(old.ips)), map(cutoff.__gt__, old.columns['last_seen']))
+                   if i not in updates]   # a re-seen IP stays
+        if not (updates or inserts or expired):
+            return old, []
+
+        def contrib(ip_int, values):   # Snapshot.contrib of a delta row
+            return values[1], values[2], values[0], [p[:2] for p in runs.get(ip_int, ())]
+        changes = [(old.ips[i], old.contrib(i), contrib(old.ips[i], v)) for i, v in updates.items()]
+        changes.extend((ip_int, None, contrib(ip_int, v)) for ip_int, v in added)
+        changes.extend((old.ips[i], old.contrib(i), None) for i in expired)
+
+        columns = [array('I') for _ in COLUMNS]   # private, writable copies
+        for d, s in zip(columns, old.columns.values()):
+            d.frombytes(_raw(s))
+        asn = old.columns['asn']
+        dirty = {asn[i] for i in expired}
+        for i, values in updates.items():
+            if values[1] != asn[i]:
+                dirty.add(asn[i])
+                joined.setdefault(values[1], []).append(old.ips[i])
+            for col, v in zip(columns, values):
+                col[i] = v
+        inserts.sort()
+        dirty = (dirty | joined.keys()) - {0}   # asn 0 (unknown) isn't indexed
+        n_keys = len(old.keys)
+        drop = [(i, i + 1) for i in expired]
+        rows = _splice([*old.keys, *columns], drop, inserts)
+
+        # An IP's protocol rows are replaced wholesale: drop the old run, insert
+        # the re-read one at the same place.
+        touched = {old.ips[i] for i in updates} | {ip for ips in joined.values() for ip in ips}
+        proto_drop = []
+        for ip_int in touched | {old.ips[i] for i in expired}:
+            lo = bisect.bisect_left(old.proto_ips, ip_int)
+            hi = bisect.bisect_right(old.proto_ips, ip_int, lo)
+            if lo < hi:
+                proto_drop.append((lo, hi))
+        proto_inserts = [(bisect.bisect_left(old.proto_ips, p[1]), _keys(version, p[1]) + p[2:])
+                         for p in delta_protos if p[1] in touched]
+        protos = _splice([*old.proto_keys, *old.protos.values()], proto_drop, proto_inserts)
+        new = Snapshot(version, rows[:n_keys], rows[n_keys:], protos[:n_keys], protos[n_keys:])
+        remap = _remap(len(old.ips), drop, [i for i, _ in inserts])
+        new.asn_keys, new.asn_offsets, new.asn_idx = _reindex(old, new, remap, dirty, joined)
+        return new, changes
+
+
+builder = SnapshotBuilder(SNAPSHOT_PATH)
+_lock_file = None
+_loaded_id = None
+
+
+def take_lead():
+    """True if this process builds the snapshot; the lock is held until exit."""
+    global _lock_file
+    if _lock_file is None:
+        f = open(SNAPSHOT_PATH.with_name(SNAPSHOT_PATH.name + '.lock'), 'a')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.close()
+            return False
+        _lock_file = f
+    return True
+
+
+def reload_snapshots():
+    """Map the snapshot file if the builder has replaced it since the last load."""
+    global snapshots, _loaded_id
+    st = os.stat(SNAPSHOT_PATH)
+    if (st.st_ino, st.st_mtime_ns) != _loaded_id:
+        snapshots, _, _loaded_id = load_snapshots(SNAPSHOT_PATH)
+        response_cache.clear()   # keyed by generation, so every entry is now stale
+
+
 async def refresher():
-    global snapshots
+    last_refresh = last_rebuild = time.monotonic()
     while True:
-        await asyncio.sleep(3600)
+        await asyncio.sleep(RELOAD_SECONDS)
         try:
-            snapshots = await asyncio.to_thread(build_snapshots)
+            now = time.monotonic()
+            if take_lead():   # passes to another worker if the builder exits
+                if now - last_rebuild >= REBUILD_SECONDS:
+                    await asyncio.to_thread(builder.rebuild, None, True)
+                    last_rebuild = last_refresh = now
+                elif now - last_refresh >= REFRESH_SECONDS:
+                    await asyncio.to_thread(builder.refresh)
+                    last_refresh = now
+            reload_snapshots()
         except Exception as e:
             print(f'snapshot refresh failed: {e}', file=sys.stderr)
 
 
-# --- Rate limiting (Redis fixed windows; count only admitted requests) ------
+# --- Rate limiting (Redis fixed windows, checked by Lua; count only admitted requests)
 
 def _429(retry_after):
     return HTTPException(429, detail={'error': 'rate_limited',
@@ -147,42 +964,116 @@ def _429(retry_after):
                          headers={'Retry-After': str(max(int(retry_after), 1))})
 
 
-async def _take(key, ttl, cap):
-    """Consume one slot; return None if admitted, else seconds until reset."""
-    n = await R.incr(key)
-    if n == 1:
-        await R.expire(key, ttl)
-    if n > cap:
-        await R.decr(key)
-        return await R.ttl(key)
-    return None
+# One EVAL per request covers every window: nothing is charged unless all of them
+# admit, so a 429 never consumes quota. KEYS are the windows and then the 429
+# counter; ARGV is (ttl, cap, cost) per window, then 1 to charge or 0 to only
+# check. Returns 0 or the seconds until the first full window resets.
+GUARD_LUA = """
+local n = #KEYS - 1
+for i = 1, n do
+  local cap, cost = tonumber(ARGV[3 * i - 1]), tonumber(ARGV[3 * i])
+  if tonumber(redis.call('GET', KEYS[i]) or '0') + cost > cap then
+    redis.call('INCR', KEYS[n + 1])
+    local ttl = redis.call('TTL', KEYS[i])
+    if ttl == -1 then
+      redis.call('EXPIRE', KEYS[i], ARGV[3 * i - 2])
+      ttl = tonumber(ARGV[3 * i - 2])
+    end
+    return math.max(ttl, 1)
+  end
+end
+if ARGV[3 * n + 1] == '0' then
+  return 0
+end
+for i = 1, n do
+  redis.call('INCRBY', KEYS[i], ARGV[3 * i])
+  if redis.call('TTL', KEYS[i]) < 0 then
+    redis.call('EXPIRE', KEYS[i], ARGV[3 * i - 2])
+  end
+end
+return 0
+"""
+
+# Leases up to ARGV[3] tokens from the global window KEYS[1] (ttl ARGV[1], cap
+# ARGV[2]). Returns {tokens granted, milliseconds until the window resets}.
+LEASE_LUA = """
+local n = math.min(tonumber(ARGV[3]), tonumber(ARGV[2]) - tonumber(redis.call('GET', KEYS[1]) or '0'))
+if n > 0 then
+  redis.call('INCRBY', KEYS[1], n)
+else
+  n = 0
+end
+local ms = redis.call('PTTL', KEYS[1])
+if ms == -1 then
+  redis.call('EXPIRE', KEYS[1], ARGV[1])
+  ms = tonumber(ARGV[1]) * 1000
+end
+return {n, math.max(ms, 1)}
+"""
 
 
-async def guard(ip, endpoint):
-    """Daily cap + per-endpoint per-IP limit. Raises 429 when over."""
-    checks = [(f'knock:api:rl:day:{ip}', 86400, DAY_CAP)]
+async def guard(ip, endpoint, cost=1, charge=True):
+    """Daily cap + per-endpoint per-IP limit, in one round trip. Raises 429 when over.
+
+    cost is what the request charges against the per-endpoint limit (check-bulk
+    charges per distinct entry or per IP streamed); the daily cap always counts
+    requests. With charge=False it only checks that cost would fit, so work
+    whose cost isn't known yet can be refused before it is done.
+    """
+    checks = [(f'knock:api:rl:day:{ip}', 86400, DAY_CAP, 1)]
     if endpoint == 'ip':
-        checks.append((f'knock:api:rl:ip:{ip}', 60, IP_MIN_CAP))
+        checks.append((f'knock:api:rl:ip:{ip}', 60, IP_MIN_CAP, cost))
+    elif endpoint == 'check-bulk':
+        checks.append((f'knock:api:rl:check-bulk:{ip}', 3600, BULK_HOUR_CAP, cost))
     else:
-        checks.append((f'knock:api:rl:{endpoint}:{ip}', 3600, CHECK_CAP))
-    for key, ttl, cap in checks:
-        retry = await _take(key, ttl, cap)
-        if retry is not None:
-            await R.incr('knock:api:rate_limited:count')
-            raise _429(retry)
+        checks.append((f'knock:api:rl:{endpoint}:{ip}', 3600, CHECK_CAP, cost))
+    retry = await guard_script(keys=[c[0] for c in checks] + ['knock:api:rate_limited:count'],
+                               args=[v for c in checks for v in c[1:]] + [int(charge)])
+    if retry:
+        raise _429(retry)
 
 
-async def take_global_token():
-    """Global /ip budget; waits (rather than rejecting) up to WAIT_MAX seconds."""
-    deadline = time.monotonic() + WAIT_MAX
-    while True:
-        retry = await _take('knock:api:rl:global_min', 60, GLOBAL_MIN_CAP)
-        if retry is None:
-            return
-        if time.monotonic() + 1 >= deadline:
-            await R.incr('knock:api:rate_limited:count')
-            raise _429(retry)
-        await asyncio.sleep(1)
+class GlobalBudget:
+    """The global /ip budget, leased from its Redis window GLOBAL_LEASE tokens at a time.
+
+    Workers share GLOBAL_MIN_CAP a minute through the Redis window; each hands
+    out its leased tokens locally, so most /ip requests spend no round trip
+    here. Tokens expire with the window they were leased from. Once the window
+    is spent, requests wait on a Condition until it resets (one lease call
+    for all of them) instead of polling Redis.
+    """
+
+    def __init__(self):
+        self.tokens = 0
+        self.expires = 0.0   # monotonic time the leased tokens' window resets
+        self.spent = 0.0     # until then, the Redis window is known to be used up
+        self.cond = asyncio.Condition()
+
+    async def take(self):
+        """One token; waits (rather than rejecting) up to WAIT_MAX seconds."""
+        deadline = time.monotonic() + WAIT_MAX
+        async with self.cond:
+            while True:
+                now = time.monotonic()
+                if self.tokens and now < self.expires:
+                    self.tokens -= 1
+                    return
+                if now < self.spent:
+                    if self.spent >= deadline:
+                        await R.incr('knock:api:rate_limited:count')
+                        raise _429(self.spent - now)
+                    try:   # until the window resets, or another waiter's lease succeeds
+                        await asyncio.wait_for(self.cond.wait(), self.spent - now)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                granted, ms = await lease_script(keys=['knock:api:rl:global_min'],
+                                                 args=[60, GLOBAL_MIN_CAP, GLOBAL_LEASE])
+                if granted:
+                    self.tokens, self.expires = granted, now + ms / 1000
+                    self.cond.notify_all()
+                else:
+                    self.spent = now + ms / 1000
 
 
 # --- Request helpers --------------------------------------------------------
@@ -198,6 +1089,75 @@ def client_ip(request: Request):
     return request.client.host if request.client else '?'
 
 
+async def read_bulk(request: Request):
+    """check-bulk body as text: gunzipped if needed, at most BULK_MAX_BYTES."""
+    too_big = HTTPException(413, detail={'error': f'body over {BULK_MAX_BYTES >> 20} MB'})
+    body = bytearray()
+    async for chunk in request.stream():
+        body += chunk
+        if len(body) > BULK_MAX_BYTES:
+            raise too_big
+    if body[:2] == b'\x1f\x8b':   # gzip, whatever the headers say
+        inflate = zlib.decompressobj(wbits=31)
+        try:
+            body = inflate.decompress(body, BULK_MAX_BYTES + 1)
+        except zlib.error:
+            raise HTTPException(400, detail={'error': 'invalid gzip body'})
+        if len(body) > BULK_MAX_BYTES or inflate.unconsumed_tail:
+            raise too_big
+    try:
+        return bytes(body).decode()
+    except UnicodeDecodeError:
+        raise HTTPException(400, detail={'error': 'body must be UTF-8 text'})
+
+
+def parse_entries(lines):
+    """(family, first, last, line) per CIDR or IP line; 400 naming the first bad line.
+
+    Blank lines and #-comments are skipped. Host bits are masked off, and an
+    IPv4-mapped IPv6 entry is checked as IPv4, as on /ip. Parses with inet_pton:
+    ipaddress.ip_network costs ~9 µs an entry, close to a second for a full request.
+    """
+    entries = []
+    for n, line in enumerate(lines, 1):
+        line = line.split('#', 1)[0].strip()
+        if not line:
+            continue
+        addr, slash, plen = line.partition('/')
+        key = _ip_key(addr)
+        if key is None or slash and not (plen.isdigit() and int(plen) <= (32 if key[0] == 4 else 128)):
+            raise HTTPException(400, detail={'error': f'line {n}: invalid CIDR or IP: {line!r}'})
+        version, first = key
+        bits = 32 if version == 4 else 128
+        plen = int(plen) if slash else bits
+        if version == 6 and first >> 32 == 0xFFFF and plen >= 96:
+            version, first, bits, plen = 4, first & 0xFFFFFFFF, 32, plen - 96
+        if plen < MIN_PREFIXLEN[version]:
+            raise HTTPException(400, detail={'error':
+                f'line {n}: {line} too large — /{MIN_PREFIXLEN[version]} maximum'})
+        host = (1 << bits - plen) - 1
+        first &= ~host
+        entries.append((version, first, first | host, line))
+    return entries
+
+
+def drop_covered(entries):
+    """entries minus duplicates and entries inside another one, in input order.
+
+    CIDRs either nest or don't overlap at all, so sorted by start (the widest
+    first, then input order) an entry is covered exactly when it starts at or
+    before the end of the last one kept. Each listed IP then matches one entry.
+    """
+    order = sorted(range(len(entries)), key=lambda i: (entries[i][0], entries[i][1], -entries[i][2], i))
+    keep, end = [], {4: -1, 6: -1}
+    for i in order:
+        version, first, last, _ = entries[i]
+        if first > end[version]:
+            keep.append(i)
+            end[version] = last
+    return [entries[i] for i in sorted(keep)]
+
+
 # --- Access log (real client IP, not the Cloudflare edge) -------------------
 # uvicorn's built-in access log prints request.client.host, which behind Cloudflare
 # is the CF *edge* IP — useless for per-client attribution. We disable it
@@ -222,51 +1182,7 @@ async def access_log_middleware(request: Request, call_next):
     return response
 
 
-def init_visitors_db():
-    """Same append-only visitor_events DDL as main.py — a no-op when the dashboard
-    has already created it. The legacy daily-rollup `visitors` table is left untouched."""
-    with sqlite3.connect(VISITORS_DB) as conn:
-        conn.execute("""CREATE TABLE IF NOT EXISTS visitor_events (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            timestamp INTEGER NOT NULL,
-            ip TEXT NOT NULL, page TEXT NOT NULL DEFAULT '/', query_string TEXT,
-            method TEXT, status_code INTEGER,
-            city TEXT, region TEXT, country TEXT, iso_code TEXT, isp TEXT, asn INTEGER,
-            referrer TEXT, user_agent TEXT)""")
-        conn.execute("CREATE INDEX IF NOT EXISTS idx_ve_ip_ts ON visitor_events(ip, timestamp)")
-        conn.execute("CREATE INDEX IF NOT EXISTS idx_ve_page_ts ON visitor_events(page, timestamp)")
-        conn.execute('PRAGMA journal_mode=WAL')
-
-
-def log_visitor(ip, user_agent, page, query_string, referrer=None,
-                method=None, status_code=None):
-    """Append one raw request event to visitor_events (same table main.py writes; no dedup)."""
-    geo = {'city': None, 'region': None, 'country': None, 'iso': None,
-           'isp': None, 'asn': None}
-    try:
-        if city_reader:
-            c = city_reader.city(ip)
-            geo.update(city=c.city.name, country=c.country.name, iso=c.country.iso_code,
-                       region=c.subdivisions[0].name if c.subdivisions else None)
-        if asn_reader:
-            a = asn_reader.asn(ip)
-            geo.update(isp=a.autonomous_system_organization, asn=a.autonomous_system_number)
-    except Exception:
-        pass
-    try:
-        with sqlite3.connect(VISITORS_DB) as conn:
-            conn.execute("""
-                INSERT INTO visitor_events (timestamp, ip, page, query_string, method, status_code,
-                                            city, region, country, iso_code, isp, asn, referrer, user_agent)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (int(time.time()), ip, page, query_string, method, status_code,
-                  geo['city'], geo['region'], geo['country'], geo['iso'],
-                  geo['isp'], geo['asn'], referrer, user_agent))
-    except sqlite3.Error as e:
-        print(f'visitor log failed: {e}', file=sys.stderr)
-
-
-async def _record(user_agent, ip, endpoint, query, ms, referer=None, method=None):
+async def _record(user_agent, ip, endpoint, query, ms, referer=None, method=None, status=200):
     try:
         async with R.pipeline(transaction=False) as pipe:
             pipe.incr(f'knock:api:{endpoint}:count')
@@ -276,47 +1192,194 @@ async def _record(user_agent, ip, endpoint, query, ms, referer=None, method=None
         if prev is None or ms > float(prev):
             await R.set(f'knock:api:{endpoint}:ms_max', f'{ms:.1f}')
         if LOG_VISITORS:
-            # record() only runs after a successful endpoint (errors raise first) → status 200.
-            await asyncio.to_thread(log_visitor, ip, user_agent, f'/{endpoint}', query, referer, method, 200)
+            # record() only runs after a successful endpoint (errors raise first) → 200 or 304.
+            visitor_logger.log(ip, user_agent, referer, f'/{endpoint}', query, method, status)
     except Exception as e:
         print(f'record failed: {e}', file=sys.stderr)
 
 
-def record(request, ip, endpoint, started, query=None):
+def record(request, ip, endpoint, started, query=None, status=200):
     """Metrics + visitor logging — fire-and-forget, off the response path."""
     ms = (time.monotonic() - started) * 1000
     asyncio.get_running_loop().create_task(
         _record(request.headers.get('user-agent'), ip, endpoint,
                 query or request.url.query or None, ms,
-                request.headers.get('referer'), request.method))
-
-
-# --- Hit metadata (the only per-request DB work) ----------------------------
-
-def fetch_meta(ips: list[str]):
-    """hits + last_seen + per-protocol breakdown for confirmed hits, in one pass."""
-    meta = {ip: {'ip': ip, 'hits': 0, 'first_seen': None, 'last_seen': None,
-                 'protocols': []} for ip in ips}
-    with ro_conn(KNOCK_DB) as conn:
-        for chunk in (ips[i:i + 900] for i in range(0, len(ips), 900)):
-            marks = ','.join('?' * len(chunk))
-            for ip, hits, first, last in conn.execute(
-                    f'SELECT ip, hits, first_seen, last_seen FROM ip_intel WHERE ip IN ({marks})', chunk):
-                meta[ip].update(hits=hits, first_seen=first, last_seen=last)
-            for ip, proto, hits, last in conn.execute(
-                    f'SELECT ip, proto, hits, last_seen FROM ip_intel_proto '
-                    f'WHERE ip IN ({marks}) ORDER BY hits DESC', chunk):
-                meta[ip]['protocols'].append(
-                    {'proto': PROTO_NAME.get(proto, str(proto)), 'hits': hits, 'last_seen': last})
-    return [meta[ip] for ip in ips]
+                request.headers.get('referer'), request.method, status))
+
+
+# --- Hit metadata (from the snapshot; no per-request DB work) ---------------
+
+async def hit_rows(snap, indexes):
+    """Response rows for the IPs at indexes; big lists are built off the event loop."""
+    if len(indexes) > INLINE_HITS:
+        return await asyncio.to_thread(snap.hits, indexes)
+    return snap.hits(indexes)
+
+
+# --- Response cache (per snapshot generation; ETag / 304) -------------------
+# A check response changes only when the snapshot does, so each one is serialized
+# (and gzipped) once per generation and replayed from a per-worker LRU. Entries are
+# (etag, data, gzipped, fresh_until); the ETag hashes the uncompressed JSON.
+
+class ResponseCache:
+    """Bounded LRU of serialized responses, keyed by (endpoint, query, window, generated_at)."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key, entry):
+        if key not in self.entries and len(entry[1]) <= self.max_bytes:
+            self.entries[key] = entry
+            self.size += len(entry[1])
+            while self.size > self.max_bytes:
+                self.size -= len(self.entries.popitem(last=False)[1][1])
+        return entry
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+
+response_cache = ResponseCache(CACHE_BYTES)
+
+
+def serialize(payload, generated_at):
+    """A cache entry for payload, fresh until the snapshot's next refresh is due."""
+    # the separators etc. of FastAPI's JSONResponse, so cached bodies read the same
+    body = json.dumps(payload, ensure_ascii=False, allow_nan=False, separators=(',', ':')).encode()
+    etag = f'"{hashlib.blake2b(body, digest_size=12).hexdigest()}"'
+    fresh_until = (calendar.timegm(time.strptime(generated_at, '%Y-%m-%dT%H:%M:%SZ'))
+                   + REFRESH_SECONDS + RELOAD_SECONDS)
+    if len(body) >= GZIP_MIN_BYTES:
+        return etag, gzip.compress(body, 6), True, fresh_until
+    return etag, body, False, fresh_until
+
+
+def not_modified(request, entry):
+    """True if the request's If-None-Match names the entry's ETag."""
+    tags = request.headers.get('if-none-match')
+    if not tags:
+        return False
+    return tags.strip() == '*' or entry[0] in (t.strip().removeprefix('W/') for t in tags.split(','))
+
+
+def cached_response(request, entry):
+    """The entry as a 200 (gzipped if the client takes it), or a 304 if the client has it."""
+    etag, data, gzipped, fresh_until = entry
+    # shared caches (Cloudflare) may keep it until the next refresh is due
+    headers = {'ETag': etag, 'Vary': 'Accept-Encoding',
+               'Cache-Control': f'public, max-age={max(int(fresh_until - time.time()), 0)}'}
+    if not_modified(request, entry):
+        return Response(status_code=304, headers=headers)
+    if gzipped and 'gzip' in request.headers.get('accept-encoding', ''):
+        headers['Content-Encoding'] = 'gzip'
+    elif gzipped:
+        data = gzip.decompress(data)
+    return Response(data, media_type='application/json', headers=headers)
+
+
+def ndjson_response(summary, parts):
+    """Stream a summary line, then one line per hit, about STREAM_CHUNK rows per write.
+
+    parts yields (extra fields, snapshot, indexes into its ips); indexes can be a
+    range or an ASN member slice. Only one chunk of rows exists at a time, and the
+    summary goes out before any row is formatted.
+    """
+    def render(batch):
+        return b''.join(json.dumps({**extra, **row}).encode() + b'\n'
+                        for extra, snap, indexes in batch for row in snap.hits(indexes))
+
+    async def lines():
+        yield json.dumps(summary).encode() + b'\n'
+        batch, size = [], 0
+        for extra, snap, indexes in parts:
+            while len(indexes):   # split big parts so every write is about STREAM_CHUNK rows
+                part, indexes = indexes[:STREAM_CHUNK - size], indexes[STREAM_CHUNK - size:]
+                batch.append((extra, snap, part))
+                size += len(part)
+                if size == STREAM_CHUNK:
+                    yield await asyncio.to_thread(render, batch)
+                    batch, size = [], 0
+        if batch:
+            yield render(batch)
+
+    return StreamingResponse(lines(), media_type='application/x-ndjson')
+
+
+async def cache_entry(payload, generated_at):
+    """serialize(), off the event loop for big hit lists."""
+    if len(payload['hits']) > INLINE_HITS:
+        return await asyncio.to_thread(serialize, payload, generated_at)
+    return serialize(payload, generated_at)
 
 
 def get_snapshot(window):
+    """The window's Snapshot per address family."""
     if window not in WINDOWS:
         raise HTTPException(400, detail={'error': f"list must be one of {list(WINDOWS)}"})
     return snapshots[window]
 
 
+def asn_org(family, asn):
+    """The ASN's organization, looked up via one of its listed IPs (None if unknown)."""
+    for snap in family.values():
+        members = snap.asn_members(asn) if 0 < asn < 2**32 else []
+        if len(members) and asn_reader:
+            try:
+                return asn_reader.asn(ip_str(snap.ips[members[0]], snap.version)).autonomous_system_organization
+            except Exception:
+                return None
+    return None
+
+
+def get_page(sort, limit, offset):
+    if sort not in SORTS:
+        raise HTTPException(400, detail={'error': f"sort must be one of {list(SORTS)}"})
+    if not 1 <= limit <= PAGE_MAX or offset < 0:
+        raise HTTPException(400, detail={'error': f'limit must be 1-{PAGE_MAX} and offset at least 0'})
+    return sort, limit, offset
+
+
+def ranked(agg, sort, offset, limit, groups=None):
+    """(total, group indexes of the page) worst first by sort, from a rank array or groups (a key range)."""
+    if groups is None:
+        rank = agg.by_hits if sort == 'hits' else agg.by_ips
+        return len(rank), [agg.find(key) for key in rank[offset:offset + limit]]
+    col = agg.hits if sort == 'hits' else agg.ips
+    order = sorted(groups, key=col.__getitem__, reverse=True)   # stable: ties stay in key order
+    return len(order), order[offset:offset + limit]
+
+
+def bulk_spans(family, entries):
+    """(snapshot, lo, hi) per entry: its matches are snapshot.ips[lo:hi].
+
+    Most entries match nothing, and those cost a single bisect; so does a
+    single-IP entry that matches. (Sorting the entries first, searchsorted
+    style, costs more in Python than the narrower searches save.)
+    """
+    spans = []
+    for version, first, last, _ in entries:
+        snap = family[version]
+        ips = snap.ips
+        lo = bisect.bisect_left(ips, first)
+        if lo == len(ips) or ips[lo] > last:
+            hi = lo
+        elif first == last:
+            hi = lo + 1
+        else:
+            hi = bisect.bisect_right(ips, last, lo)
+        spans.append((snap, lo, hi))
+    return spans
+
+
 # --- Endpoints --------------------------------------------------------------
 
 @app.get('/', include_in_schema=False)
@@ -327,11 +1390,10 @@ async def index(request: Request):
     Logged as '/api' (not '/') so landing hits register distinctly from the
     main dashboard homepage and roll up with knock-knock.net/api."""
     if LOG_VISITORS:
-        # Fire-and-forget, off the response path (matches record()/_record()). Always a 200 here.
-        asyncio.get_running_loop().create_task(asyncio.to_thread(
-            log_visitor, client_ip(request), request.headers.get('user-agent'),
-            '/api', request.url.query or None, request.headers.get('referer'),
-            request.method, 200))
+        # Queued for the batching writer, off the response path. Always a 200 here.
+        visitor_logger.log(client_ip(request), request.headers.get('user-agent'),
+                           request.headers.get('referer'), '/api',
+                           request.url.query or None, request.method, 200)
     from fastapi.responses import HTMLResponse
     try:
         return HTMLResponse((ROOT / 'api.html').read_text())
@@ -340,12 +1402,18 @@ async def index(request: Request):
                             '<a href="https://knock-knock.net/api">knock-knock.net/api</a></p>')
 
 
+def get_format(fmt):
+    if fmt not in FORMATS:
+        raise HTTPException(400, detail={'error': f"format must be one of {list(FORMATS)}"})
+    return fmt
+
+
 @app.get('/check-ranges')
 async def check_ranges(request: Request, ranges: str,
-                       window: str = Query('year', alias='list')):
+                       window: str = Query('year', alias='list'), fmt: str = Query('json', alias='format')):
     ip, started = client_ip(request), time.monotonic()
-    await guard(ip, 'check-ranges')
-    snap = get_snapshot(window)
+    family = get_snapshot(window)
+    fmt = get_format(fmt)
 
     nets = []
     for part in ranges.split(','):
@@ -353,61 +1421,207 @@ async def check_ranges(request: Request, ranges: str,
             net = ipaddress.ip_network(part.strip(), strict=False)
         except ValueError:
             raise HTTPException(400, detail={'error': f'invalid CIDR: {part.strip()!r}'})
-        if net.version != 4:
-            raise HTTPException(400, detail={'error': 'IPv4 ranges only'})
-        if net.prefixlen < MIN_PREFIXLEN:
-            raise HTTPException(400, detail={'error':
-                f'{net} too large — /{MIN_PREFIXLEN} maximum ({2**(32-MIN_PREFIXLEN):,} IPs)'})
+        limit = MIN_PREFIXLEN[net.version]
+        if net.prefixlen < limit:
+            size = f' ({2**(32 - limit):,} IPs)' if net.version == 4 else ''
+            raise HTTPException(400, detail={'error': f'{net} too large — /{limit} maximum{size}'})
         nets.append(net)
     if not 1 <= len(nets) <= MAX_RANGES:
         raise HTTPException(400, detail={'error': f'1-{MAX_RANGES} ranges per request'})
 
-    # Walk the full match set for an exact count (cheap — bounded by blocklist size),
-    # but only materialize the first MAX_HITS for the metadata fetch / response body.
-    hit_ints, total_matched = [], 0
+    generated_at = family[4].generated_at
+    key = ('check-ranges', tuple(map(str, nets)), window, generated_at)
+    entry = response_cache.get(key) if fmt == 'json' else None
+    if entry and not_modified(request, entry):   # the client has it: free
+        record(request, ip, 'check-ranges', started, status=304)
+        return cached_response(request, entry)
+    await guard(ip, 'check-ranges')
+    if entry:
+        record(request, ip, 'check-ranges', started)
+        return cached_response(request, entry)
+
+    # Two bisects per range give its matches as one run of ips, so the exact count
+    # costs nothing; rows are only formatted for what the response carries.
+    spans = []
     for net in nets:
-        lo, hi = int(net[0]), int(net[-1])
-        i = bisect.bisect_left(snap.ips, lo)
-        while i < len(snap.ips) and snap.ips[i] <= hi:
-            total_matched += 1
-            if len(hit_ints) < MAX_HITS:
-                hit_ints.append(snap.ips[i])
-            i += 1
-    hit_ips = [snap.ip_strs[n] for n in hit_ints]
-
-    hits = await asyncio.to_thread(fetch_meta, hit_ips) if hit_ips else []
+        snap = family[net.version]
+        lo = bisect.bisect_left(snap.ips, int(net[0]))
+        spans.append((snap, range(lo, bisect.bisect_right(snap.ips, int(net[-1]), lo))))
+    total_matched = sum(len(r) for _, r in spans)
+    summary = {'list': window, 'generated_at': generated_at,
+               'ranges_checked': [str(n) for n in nets],
+               'total_ips_checked': sum(n.num_addresses for n in nets)}
+    if fmt == 'ndjson':
+        record(request, ip, 'check-ranges', started)
+        return ndjson_response({**summary, 'total_matched': total_matched},
+                               (({}, snap, r) for snap, r in spans))
+
+    hits = []
+    for snap, r in spans:
+        hits.extend(await hit_rows(snap, r[:MAX_HITS - len(hits)]))
+    payload = {**summary, 'hit_count': len(hits), 'total_matched': total_matched,
+               'truncated': total_matched > len(hits),
+               'hits': hits}   # long array last, so the summary reads first
+    entry = response_cache.put(key, await cache_entry(payload, generated_at))
     record(request, ip, 'check-ranges', started)
-    return {'list': window, 'generated_at': snap.generated_at,
-            'ranges_checked': [str(n) for n in nets],
-            'total_ips_checked': sum(n.num_addresses for n in nets),
-            'hit_count': len(hits), 'total_matched': total_matched,
-            'truncated': total_matched > len(hits),
-            'hits': hits}   # long array last, so the summary reads first
+    return cached_response(request, entry)
 
 
 @app.get('/check-asn')
 async def check_asn(request: Request, asn: int,
-                    window: str = Query('year', alias='list')):
+                    window: str = Query('year', alias='list'), fmt: str = Query('json', alias='format')):
     ip, started = client_ip(request), time.monotonic()
+    family = get_snapshot(window)
+    fmt = get_format(fmt)
+    generated_at = family[4].generated_at
+    key = ('check-asn', asn, window, generated_at)
+    entry = response_cache.get(key) if fmt == 'json' else None
+    if entry and not_modified(request, entry):   # the client has it: free
+        record(request, ip, 'check-asn', started, status=304)
+        return cached_response(request, entry)
     await guard(ip, 'check-asn')
-    snap = get_snapshot(window)
+    if entry:
+        record(request, ip, 'check-asn', started)
+        return cached_response(request, entry)
+
+    # IPv4 members first, then IPv6; each family's run is in address order
+    members = [(snap, snap.asn_members(asn) if 0 < asn < 2**32 else [])
+               for snap in family.values()]
+    total_matched = sum(len(m) for _, m in members)   # exact and free from the in-memory index
+    org = asn_org(family, asn)
+    if fmt == 'ndjson':
+        record(request, ip, 'check-asn', started)
+        return ndjson_response({'list': window, 'generated_at': generated_at, 'asn': asn, 'isp': org,
+                                'total_matched': total_matched},
+                               (({}, snap, m) for snap, m in members))
+
+    hits = []
+    for snap, m in members:
+        hits.extend(await hit_rows(snap, m[:MAX_HITS - len(hits)]))
+    payload = {'list': window, 'generated_at': generated_at, 'asn': asn, 'isp': org,
+               'hit_count': len(hits), 'total_matched': total_matched,
+               'truncated': total_matched > len(hits),
+               'hits': hits}   # long array last, so the summary reads first
+    entry = response_cache.put(key, await cache_entry(payload, generated_at))
+    record(request, ip, 'check-asn', started)
+    return cached_response(request, entry)
 
-    members = snap.asn_map.get(asn, [])
-    total_matched = len(members)          # exact and free from the in-memory index
-    hit_ips = [snap.ip_strs[n] for n in members[:MAX_HITS]]
-    org = None
-    if hit_ips and asn_reader:
-        try:
-            org = asn_reader.asn(hit_ips[0]).autonomous_system_organization
-        except Exception:
-            pass
 
-    hits = await asyncio.to_thread(fetch_meta, hit_ips) if hit_ips else []
-    record(request, ip, 'check-asn', started)
-    return {'list': window, 'generated_at': snap.generated_at, 'asn': asn, 'isp': org,
-            'hit_count': len(hits), 'total_matched': total_matched,
-            'truncated': total_matched > len(hits),
-            'hits': hits}   # long array last, so the summary reads first
+@app.post('/check-bulk')
+async def check_bulk(request: Request, window: str = Query('year', alias='list')):
+    """Streams NDJSON: a summary line, then one line per listed IP, tagged with its entry."""
+    ip, started = client_ip(request), time.monotonic()
+    family = get_snapshot(window)
+    # A client that is already over its limits doesn't get its body read and parsed
+    await guard(ip, 'check-bulk', charge=False)
+    text = await read_bulk(request)
+    entries = await asyncio.to_thread(parse_entries, text.splitlines())
+    if not 1 <= len(entries) <= BULK_MAX_ENTRIES:
+        raise HTTPException(400, detail={'error': f'1-{BULK_MAX_ENTRIES:,} entries per request'})
+    checked = len(entries)
+    entries = await asyncio.to_thread(drop_covered, entries)
+    spans = await asyncio.to_thread(bulk_spans, family, entries)
+    total_matched = sum(hi - lo for _, lo, hi in spans)
+    # What is streamed is capped and paid for: each distinct entry or each IP sent,
+    # whichever is more, so repeating a busy /16 buys nothing.
+    budget = BULK_MAX_MATCHES
+    streamed = []
+    for snap, lo, hi in spans:
+        hi = min(hi, lo + budget)
+        budget -= hi - lo
+        streamed.append((snap, range(lo, hi)))
+    await guard(ip, 'check-bulk', cost=max(len(entries), BULK_MAX_MATCHES - budget))
+    summary = {'list': window, 'generated_at': family[4].generated_at,
+               'entries_checked': checked, 'entries_covered': checked - len(entries),
+               'entries_matched': sum(hi > lo for _, lo, hi in spans),
+               'total_matched': total_matched, 'truncated': total_matched > BULK_MAX_MATCHES}
+    record(request, ip, 'check-bulk', started, query=f'list={window}&entries={checked}')
+    return ndjson_response(summary, (({'query': label}, snap, r)
+                                     for (*_, label), (snap, r) in zip(entries, streamed)))
+
+
+@app.get('/top-prefixes')
+async def top_prefixes(request: Request, window: str = Query('year', alias='list'), family: int = 4,
+                       sort: str = 'hits', within: str = None, limit: int = PAGE_DEFAULT, offset: int = 0):
+    """The worst /24 (IPv4) or /48 (IPv6) prefixes, from the snapshot's aggregates."""
+    ip, started = client_ip(request), time.monotonic()
+    snaps = get_snapshot(window)
+    sort, limit, offset = get_page(sort, limit, offset)
+    net = None
+    if within is not None:
+        try:
+            net = ipaddress.ip_network(within.strip(), strict=False)
+        except ValueError:
+            raise HTTPException(400, detail={'error': f'invalid CIDR: {within.strip()!r}'})
+        family = net.version
+        if not MIN_PREFIXLEN[family] <= net.prefixlen <= PREFIX_LEN[family]:
+            raise HTTPException(400, detail={'error': f'within must be a /{MIN_PREFIXLEN[family]} to '
+                                                      f'/{PREFIX_LEN[family]} for IPv{family}'})
+    elif family not in PREFIX_LEN:
+        raise HTTPException(400, detail={'error': 'family must be 4 or 6'})
+
+    generated_at = snaps[4].generated_at
+    key = ('top-prefixes', family, sort, net and str(net), limit, offset, window, generated_at)
+    entry = response_cache.get(key)
+    if entry and not_modified(request, entry):   # the client has it: free
+        record(request, ip, 'top-prefixes', started, status=304)
+        return cached_response(request, entry)
+    await guard(ip, 'top-prefixes')
+    if entry:
+        record(request, ip, 'top-prefixes', started)
+        return cached_response(request, entry)
+
+    agg = snaps[family].prefixes
+    shift = (32 if family == 4 else 128) - PREFIX_LEN[family]
+    if net is None:
+        total, page = ranked(agg, sort, offset, limit)
+    else:   # the prefixes inside it are one run of the sorted keys
+        lo = bisect.bisect_left(agg.keys, int(net[0]) >> shift)
+        total, page = ranked(agg, sort, offset, limit,
+                             range(lo, bisect.bisect_right(agg.keys, int(net[-1]) >> shift, lo)))
+    rows = [{'prefix': f'{ip_str(agg.keys[g] << shift, family)}/{PREFIX_LEN[family]}', **agg.row(g)}
+            for g in page]
+    payload = {'list': window, 'generated_at': generated_at, 'family': family, 'sort': sort,
+               'within': net and str(net), 'total': total, 'offset': offset, 'limit': limit,
+               'prefixes': rows}
+    entry = response_cache.put(key, serialize(payload, generated_at))   # a page is at most INLINE_HITS rows
+    record(request, ip, 'top-prefixes', started)
+    return cached_response(request, entry)
+
+
+@app.get('/asn-summary')
+async def asn_summary(request: Request, window: str = Query('year', alias='list'), asn: int = None,
+                      sort: str = 'hits', limit: int = PAGE_DEFAULT, offset: int = 0):
+    """One ASN's offender statistics, or the worst ASNs ranked, across both families."""
+    ip, started = client_ip(request), time.monotonic()
+    family = get_snapshot(window)
+    sort, limit, offset = get_page(sort, limit, offset)
+    generated_at = family[4].generated_at
+    key = ('asn-summary', asn, sort, limit, offset, window, generated_at)
+    entry = response_cache.get(key)
+    if entry and not_modified(request, entry):   # the client has it: free
+        record(request, ip, 'asn-summary', started, status=304)
+        return cached_response(request, entry)
+    await guard(ip, 'asn-summary')
+    if entry:
+        record(request, ip, 'asn-summary', started)
+        return cached_response(request, entry)
+
+    agg = family[4].asns   # shared by the window's families
+    if asn is not None:
+        g = agg.find(asn) if 0 <= asn < 2**32 else None
+        payload = {'list': window, 'generated_at': generated_at, 'asn': asn, 'listed': g is not None}
+        if g is not None:
+            payload.update({'isp': asn_org(family, asn), **agg.row(g)})
+    else:
+        total, page = ranked(agg, sort, offset, limit)
+        payload = {'list': window, 'generated_at': generated_at, 'sort': sort,
+                   'total': total, 'offset': offset, 'limit': limit,
+                   'asns': [{'asn': agg.keys[g], 'isp': asn_org(family, agg.keys[g]), **agg.row(g)}
+                            for g in page]}
+    entry = response_cache.put(key, serialize(payload, generated_at))
+    record(request, ip, 'asn-summary', started)
+    return cached_response(request, entry)
 
 
 @app.get('/ip/{target}')
@@ -415,30 +1629,22 @@ async def ip_detail(request: Request, target: str):
     ip, started = client_ip(request), time.monotonic()
     await guard(ip, 'ip')
     try:
-        target = str(ipaddress.IPv4Address(target.strip()))
-    except (ipaddress.AddressValueError, ValueError):
-        raise HTTPException(400, detail={'error': f'invalid IPv4 address: {target!r}'})
-    await take_global_token()
-
-    def lookup():
-        with ro_conn(KNOCK_DB) as conn:
-            row = conn.execute(
-                'SELECT hits, first_seen, last_seen, ban_until, asn FROM ip_intel WHERE ip=?',
-                (target,)).fetchone()
-            if row is None:
-                return None
-            protos = [{'proto': PROTO_NAME.get(p, str(p)), 'hits': h, 'last_seen': ls}
-                      for p, h, ls in conn.execute(
-                          'SELECT proto, hits, last_seen FROM ip_intel_proto '
-                          'WHERE ip=? ORDER BY hits DESC', (target,))]
-        return row, protos
-
-    result = await asyncio.to_thread(lookup)
+        addr = ipaddress.ip_address(target.strip())
+    except ValueError:
+        raise HTTPException(400, detail={'error': f'invalid IP address: {target!r}'})
+    if addr.version == 6 and addr.ipv4_mapped:
+        addr = addr.ipv4_mapped   # the monitor records these as plain IPv4
+    target = str(addr)
+    await global_budget.take()
+
+    snap = snapshots[WIDEST][addr.version]
+    i = snap.find(int(addr))
     record(request, ip, 'ip', started, query=target)
-    if result is None:
+    if i is None:
         return {'ip': target, 'listed': False}
 
-    (hits, first_seen, last_seen, ban_until, asn), protocols = result
+    c = snap.columns
+    asn, ban_until = c['asn'][i] or None, c['ban_until'][i]
     country = isp = None
     try:
         if city_reader:
@@ -449,14 +1655,15 @@ async def ip_detail(request: Request, target: str):
             asn = asn or a.autonomous_system_number   # stored (observed) ASN wins
     except Exception:
         pass
-    banned = ban_until is not None and (ban_until == 0 or ban_until > time.time())
-    return {'ip': target, 'listed': True, 'hits': hits,
-            'first_seen': first_seen, 'last_seen': last_seen,
+    banned = ban_until != NO_BAN and (ban_until == 0 or ban_until > time.time())
+    row = snap.hit(i)
+    return {'ip': target, 'listed': True, 'hits': row['hits'],
+            'first_seen': row['first_seen'], 'last_seen': row['last_seen'],
             'country': country, 'isp': isp, 'asn': asn, 'banned': banned,
             'ban_until': ('permanent' if ban_until == 0 else
                           datetime.fromtimestamp(ban_until, timezone.utc)
                           .strftime('%Y-%m-%dT%H:%M:%SZ')) if banned else None,
-            'protocols': protocols}
+            'protocols': row['protocols']}
 
 
 @app.exception_handler(HTTPException)
@@ -469,19 +1676,35 @@ async def http_exc(request, exc):
 
 @asynccontextmanager
 async def lifespan(app):
-    global R, city_reader, asn_reader, snapshots
+    global R, guard_script, lease_script, global_budget, city_reader, asn_reader, visitor_logger
     R = aioredis.Redis(host=REDIS_HOST, db=REDIS_DB, decode_responses=True)
+    guard_script, lease_script = R.register_script(GUARD_LUA), R.register_script(LEASE_LUA)
+    global_budget = GlobalBudget()
     city_reader = geoip2.database.Reader(GEOIP_CITY) if os.path.exists(GEOIP_CITY) else None
     asn_reader = geoip2.database.Reader(GEOIP_ASN) if os.path.exists(GEOIP_ASN) else None
     if LOG_VISITORS:
-        init_visitors_db()
-    snapshots = await asyncio.to_thread(build_snapshots)
-    print(f'knock-api ready: {len(snapshots["year"].ips)} IPs (year), '
-          f'{len(snapshots["month"].ips)} (month), '
-          f'{len(snapshots["year"].asn_map)} ASNs', file=sys.stderr)
+        init_visitors_db(VISITORS_DB)
+        visitor_logger = VisitorLogger(VISITORS_DB, city_reader, asn_reader)
+        visitor_logger.start()
+    lead = take_lead()
+    if lead:
+        await asyncio.to_thread(builder.rebuild)
+    while True:
+        try:
+            reload_snapshots()
+            break
+        except (OSError, ValueError):   # another worker is building it (or upgrading its format)
+            await asyncio.sleep(1)
+    year, month = snapshots['year'], snapshots['month']
+    print(f'knock-api ready: {len(year[4].ips)} IPv4 + {len(year[6].ips)} IPv6 (year), '
+          f'{len(month[4].ips)} + {len(month[6].ips)} (month), '
+          f'{len(set(year[4].asn_keys) | set(year[6].asn_keys))} ASNs'
+          f'{" (snapshot builder)" if lead else ""}', file=sys.stderr)
     task = asyncio.create_task(refresher())
     yield
     task.cancel()
+    if visitor_logger:
+        await visitor_logger.close()
     await R.aclose()
 
 app.router.lifespan_context = lifespan
@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+"""Build quantized TopoJSON globe geometry at several detail levels.
+
+Reads static/countries.geojson and static/cities.geojson and writes one TopoJSON
+topology per detail level to static/geo/, plus static/geo/manifest.json naming the
+current file for each level. main.py serves /geo with immutable cache headers (the
+file names carry a content hash) and the pages pick a level by device class,
+decoding it with the topojson-client they already load.
+
+Per level:
+  - coordinates are quantized onto an integer grid (the topology's "transform"),
+  - country borders become shared arcs, so a border between two countries is stored
+    once and both sides simplify identically (no slivers or gaps),
+  - arcs are simplified with Douglas-Peucker and delta-encoded,
+  - islands and holes below the level's minimum area are dropped (never a
+    country's largest polygon),
+  - properties are trimmed to the ones the pages read.
+
+Cities are stored as quantized points in the same topology, so a page needs one
+request for all of its geometry. The land outline is topojson.merge() of the
+countries, replacing the external world-atlas fetch.
+
+Usage:
+    python extras/generate-geometry/generate_geometry.py
+"""
+
+import hashlib
+import json
+import math
+from pathlib import Path
+
+STATIC_DIR = Path(__file__).resolve().parents[2] / "static"
+COUNTRIES_PATH = STATIC_DIR / "countries.geojson"
+CITIES_PATH = STATIC_DIR / "cities.geojson"
+OUTPUT_DIR = STATIC_DIR / "geo"
+MANIFEST_NAME = "manifest.json"
+
+# level -> (grid steps per axis, simplification tolerance in degrees, minimum ring area in deg²)
+LEVELS = {
+    "low": (10_000, 0.5, 2.0),
+    "medium": (30_000, 0.15, 0.25),
+    "high": (100_000, 0.0, 0.0),
+}
+COUNTRY_PROPERTIES = ("ADMIN", "NAME", "ISO_A2")
+CITY_PROPERTIES = ("name", "nameascii", "pop_max")   # latitude/longitude come from the point
+
+
+def polygons_of(geometry):
+    """A Polygon or MultiPolygon's coordinates as a list of polygons (lists of rings)."""
+    if geometry["type"] == "Polygon":
+        return [geometry["coordinates"]]
+    return geometry["coordinates"]
+
+
+def ring_area(ring):
+    """Unsigned planar (shoelace) area of a closed ring, in the ring's units squared."""
+    s = 0.0
+    for (x0, y0), (x1, y1) in zip(ring, ring[1:]):
+        s += x0 * y1 - x1 * y0
+    return abs(s) / 2
+
+
+class Quantizer:
+    """Maps lon/lat onto a steps x steps integer grid spanning the input bbox."""
+
+    def __init__(self, bbox, steps):
+        x0, y0, x1, y1 = bbox
+        self.translate = (x0, y0)
+        self.scale = ((x1 - x0) / (steps - 1) or 1, (y1 - y0) / (steps - 1) or 1)
+
+    def point(self, p):
+        return (round((p[0] - self.translate[0]) / self.scale[0]),
+                round((p[1] - self.translate[1]) / self.scale[1]))
+
+    def ring(self, ring):
+        """Quantized closed ring with consecutive duplicates removed (None if degenerate)."""
+        out = []
+        for p in ring:
+            q = self.point(p)
+            if not out or out[-1] != q:
+                out.append(q)
+        if out[0] != out[-1]:
+            out.append(out[0])
+        return out if len(out) >= 4 else None
+
+    def transform(self):
+        return {"scale": list(self.scale), "translate": list(self.translate)}
+
+
+def find_junctions(rings):
+    """Points where rings stop running alongside each other.
+
+    A point is a junction when it is visited with different neighbours (in either
+    direction) — where a shared border meets a third country or the coast.
+    """
+    neighbours = {}
+    junctions = set()
+    for ring in rings:
+        n = len(ring) - 1   # closed: last point repeats the first
+        for i in range(n):
+            p, prev, nxt = ring[i], ring[i - 1], ring[i + 1]
+            pair = (prev, nxt) if prev <= nxt else (nxt, prev)
+            seen = neighbours.setdefault(p, pair)
+            if seen != pair:
+                junctions.add(p)
+    return junctions
+
+
+class ArcTable:
+    """Deduplicated arcs; each is stored once and referenced as i or ~i (reversed)."""
+
+    def __init__(self):
+        self.arcs = []
+        self._index = {}
+
+    def add(self, points):
+        key = tuple(points)
+        if key in self._index:
+            return self._index[key]
+        reverse = key[::-1]
+        if reverse in self._index:
+            return ~self._index[reverse]
+        self._index[key] = len(self.arcs)
+        self.arcs.append(list(points))
+        return self._index[key]
+
+    def cut(self, ring, junctions):
+        """Split a closed ring at its junctions; returns its arc references in order."""
+        body = ring[:-1]
+        cuts = [i for i, p in enumerate(body) if p in junctions]
+        if not cuts:
+            # A free-standing ring (an island, an enclave's border): start it at its
+            # smallest point so a neighbour walking it backwards finds the same arc.
+            start = body.index(min(body))
+            rotated = body[start:] + body[:start]
+            return [self.add(rotated + rotated[:1])]
+        rotated = body[cuts[0]:] + body[:cuts[0]]
+        offsets = [c - cuts[0] for c in cuts] + [len(body)]
+        rotated.append(rotated[0])
+        return [self.add(rotated[a:b + 1]) for a, b in zip(offsets, offsets[1:])]
+
+
+def _segment_distance(p, a, b):
+    (px, py), (ax, ay), (bx, by) = p, a, b
+    dx, dy = bx - ax, by - ay
+    if dx == 0 and dy == 0:
+        return math.hypot(px - ax, py - ay)
+    t = max(0.0, min(1.0, ((px - ax) * dx + (py - ay) * dy) / (dx * dx + dy * dy)))
+    return math.hypot(px - ax - t * dx, py - ay - t * dy)
+
+
+def dp_weights(points):
+    """Douglas-Peucker importance per point: the largest tolerance that still keeps it.
+
+    Endpoints are always kept. A closed arc is first split at the point farthest from
+    its start, which is kept too, so a small island never simplifies away entirely.
+    """
+    n = len(points)
+    weights = [0.0] * n
+    weights[0] = weights[-1] = math.inf
+    stack = [(0, n - 1, math.inf)]
+    if n > 2 and points[0] == points[-1]:
+        far = max(range(1, n - 1), key=lambda i: math.dist(points[i], points[0]))
+        weights[far] = math.inf
+        stack = [(0, far, math.inf), (far, n - 1, math.inf)]
+    while stack:
+        a, b, cap = stack.pop()
+        if b - a < 2:
+            continue
+        best, best_d = a + 1, -1.0
+        for i in range(a + 1, b):
+            d = _segment_distance(points[i], points[a], points[b])
+            if d > best_d:
+                best, best_d = i, d
+        w = min(best_d, cap)   # a point can't outrank the split that exposed it
+        weights[best] = w
+        stack.append((a, best, w))
+        stack.append((best, b, w))
+    return weights
+
+
+def simplify(points, tolerance):
+    if tolerance <= 0 or len(points) <= 2:
+        return points
+    weights = dp_weights(points)
+    return [p for p, w in zip(points, weights) if w >= tolerance]
+
+
+def delta_encode(points):
+    out = [list(points[0])]
+    for (x0, y0), (x1, y1) in zip(points, points[1:]):
+        out.append([x1 - x0, y1 - y0])
+    return out
+
+
+def build_topology(countries, cities, steps, tolerance, min_area):
+    """One TopoJSON topology (countries + cities) at a single detail level."""
+    bbox = countries["bbox"]
+    q = Quantizer(bbox, steps)
+
+    # Pick the polygons and rings this level keeps, quantized.
+    kept = []   # per country: (properties, [[ring, ...], ...])
+    for feature in countries["features"]:
+        polygons = polygons_of(feature["geometry"])
+        largest = max(range(len(polygons)), key=lambda i: ring_area(polygons[i][0]))
+        out = []
+        for i, polygon in enumerate(polygons):
+            if i != largest and ring_area(polygon[0]) < min_area:
+                continue
+            rings = [q.ring(polygon[0])]
+            rings += [q.ring(h) for h in polygon[1:] if ring_area(h) >= min_area]
+            if rings[0] is None:
+                continue
+            out.append([r for r in rings if r is not None])
+        props = {k: feature["properties"].get(k) for k in COUNTRY_PROPERTIES}
+        kept.append((props, out))
+
+    all_rings = [r for _, polys in kept for poly in polys for r in poly]
+    junctions = find_junctions(all_rings)
+    table = ArcTable()
+    geometries = []
+    for props, polys in kept:
+        arcs = [[table.cut(ring, junctions) for ring in poly] for poly in polys]
+        if not arcs:
+            continue
+        if len(arcs) == 1:
+            geometries.append({"type": "Polygon", "arcs": arcs[0], "properties": props})
+        else:
+            geometries.append({"type": "MultiPolygon", "arcs": arcs, "properties": props})
+
+    tol = tolerance / max(q.scale)
+    simplified = [simplify(arc, tol) for arc in table.arcs]
+    # A ring simplified below a triangle would vanish or render as a spike; give its
+    # arcs back their full detail (shared arcs stay shared, so neighbours still agree).
+    for g in geometries:
+        for poly in ([g["arcs"]] if g["type"] == "Polygon" else g["arcs"]):
+            for refs in poly:
+                if len({p for ref in refs for p in simplified[ref if ref >= 0 else ~ref]}) < 3:
+                    for ref in refs:
+                        simplified[ref if ref >= 0 else ~ref] = table.arcs[ref if ref >= 0 else ~ref]
+    arcs = [delta_encode(arc) for arc in simplified]
+
+    city_geometries = []
+    for feature in cities["features"]:
+        props = {k: feature["properties"].get(k) for k in CITY_PROPERTIES}
+        city_geometries.append({"type": "Point", "coordinates": list(q.point(feature["geometry"]["coordinates"])),
+                                "properties": props})
+
+    return {
+        "type": "Topology",
+        "bbox": bbox,
+        "transform": q.transform(),
+        "objects": {
+            "countries": {"type": "GeometryCollection", "geometries": geometries},
+            "cities": {"type": "GeometryCollection", "geometries": city_geometries},
+        },
+        "arcs": arcs,
+    }
+
+
+def main():
+    countries = json.loads(COUNTRIES_PATH.read_text())
+    cities = json.loads(CITIES_PATH.read_text())
+    OUTPUT_DIR.mkdir(exist_ok=True)
+
+    manifest = {}
+    for level, (steps, tolerance, min_area) in LEVELS.items():
+        topology = build_topology(countries, cities, steps, tolerance, min_area)
+        body = json.dumps(topology, separators=(",", ":")).encode()
+        digest = hashlib.sha256(body).hexdigest()[:12]
+        name = f"world-{level}.{digest}.json"
+        (OUTPUT_DIR / name).write_bytes(body)
+        manifest[level] = name
+        points = sum(len(a) for a in topology["arcs"])
+        print(f"{level}: {name} ({len(body) / 1024:.0f} KB, {len(topology['arcs'])} arcs, {points} points)")
+
+    # Drop builds of earlier geometry (and their .br/.gz siblings) no longer named here.
+    current = set(manifest.values())
+    for path in OUTPUT_DIR.glob("world-*.json*"):
+        if path.name.split(".json")[0] + ".json" not in current:
+            path.unlink()
+
+    (OUTPUT_DIR / MANIFEST_NAME).write_text(json.dumps({"levels": manifest}, indent=2) + "\n")
+    print(f"Saved {OUTPUT_DIR / MANIFEST_NAME}")
+
+
+if __name__ == "__main__":
+    main()
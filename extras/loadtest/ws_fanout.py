@@ -0,0 +1,449 @@
+#!/usr/bin/env python3
+"""
+WebSocket fan-out load test for main.py.
+
+Starts a local Redis stand-in and the web app (uvicorn, on loopback), opens --clients
+simulated dashboard connections spread over --client-procs processes, then publishes
+synthetic knocks to `knocks_stream` at --rate per second for --duration seconds. A
+--slow-fraction of the clients are deliberately slow readers: they sleep --slow-delay
+after every frame, so the server's send buffers for them back up.
+
+Reports:
+  connect latency     WebSocket handshake, and handshake until init_stats arrives
+                      (includes main.py's 100 ms post-accept breather)
+  fan-out latency     publish -> frame received, p50/p90/p99/max, fast and slow readers
+  memory              app RSS before/after connecting, per connection, and at the end
+  dropped / evicted   connects refused (WS_MAX_CONNECTIONS) or failed, clients the
+                      server closed, and frames never received by the end of --drain
+
+Everything binds to 127.0.0.1; no network access is needed. The Redis stand-in is
+`redis-server` when it is on PATH, otherwise fakeredis's TCP server in a subprocess
+(`pip install fakeredis`). Linux only (memory is read from /proc).
+
+Usage:
+  python3 extras/loadtest/ws_fanout.py --clients 2000 --rate 20 --duration 30
+  python3 extras/loadtest/ws_fanout.py --clients 5000 --client-procs 8 --workers 2 --json out.json
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing as mp
+import os
+import random
+import resource
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from pathlib import Path
+
+import redis
+import websockets
+
+ROOT = Path(__file__).resolve().parents[2]
+sys.path.insert(0, str(ROOT))
+
+from constants import PROTO  # noqa: E402
+
+_FAKE_REDIS_SERVER = """
+import sys
+from fakeredis import TcpFakeServer
+TcpFakeServer(('127.0.0.1', int(sys.argv[1])), server_type='redis').serve_forever()
+"""
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _raise_fd_limit():
+    """Thousands of sockets need more than the usual 1024 descriptors; children inherit it."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+
+def _wait_for(check, timeout, what):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if check():
+                return
+        except Exception:
+            pass
+        time.sleep(0.1)
+    raise SystemExit(f"❌ Timed out waiting for {what}")
+
+
+def start_redis(port, mode):
+    """Start the Redis stand-in on 127.0.0.1:port. Returns (process, description)."""
+    server = shutil.which('redis-server') if mode in ('auto', 'server') else None
+    if mode == 'server' and not server:
+        raise SystemExit("❌ --redis server: redis-server is not on PATH")
+    if server:
+        cmd = [server, '--bind', '127.0.0.1', '--port', str(port), '--save', '', '--appendonly', 'no']
+        desc = 'redis-server'
+    else:
+        try:
+            import fakeredis  # noqa: F401
+        except ImportError:
+            raise SystemExit("❌ No redis-server on PATH and fakeredis is not installed (pip install fakeredis)")
+        cmd = [sys.executable, '-c', _FAKE_REDIS_SERVER, str(port)]
+        desc = 'fakeredis TcpFakeServer'
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    client = redis.Redis(host='127.0.0.1', port=port)
+    _wait_for(client.ping, 15, desc)
+    return proc, desc
+
+
+def init_db(db_dir):
+    """Create the schema the way the monitor does, so the stats leader reads empty
+    tables instead of logging errors on every refresh."""
+    subprocess.run([sys.executable, '-c', 'import monitor; monitor.init_db()'], cwd=ROOT,
+                   env={**os.environ, 'DB_DIR': db_dir}, check=True, stdout=subprocess.DEVNULL)
+
+
+def start_app(port, redis_port, workers, db_dir, extra_env):
+    env = {**os.environ,
+           'REDIS_HOST': f'127.0.0.1:{redis_port}', 'REDIS_DB': '0', 'DB_DIR': db_dir,
+           'LOG_VISITORS': 'false', 'PYTHONUNBUFFERED': '1', **extra_env}
+    cmd = [sys.executable, '-m', 'uvicorn', 'main:app', '--host', '127.0.0.1', '--port', str(port),
+           '--workers', str(workers), '--log-level', 'warning']
+    return subprocess.Popen(cmd, cwd=ROOT, env=env)
+
+
+def wait_for_app(port):
+    url = f'http://127.0.0.1:{port}/'
+    _wait_for(lambda: urllib.request.urlopen(url, timeout=2).status == 200, 60, 'main.py to start')
+
+
+def _children(pid):
+    try:
+        return [int(p) for p in Path(f'/proc/{pid}/task/{pid}/children').read_text().split()]
+    except OSError:
+        return []
+
+
+def rss_bytes(pid):
+    """Resident memory of `pid` plus all of its descendants (uvicorn workers)."""
+    total, stack = 0, [pid]
+    while stack:
+        p = stack.pop()
+        try:
+            for line in Path(f'/proc/{p}/status').read_text().splitlines():
+                if line.startswith('VmRSS:'):
+                    total += int(line.split()[1]) * 1024
+        except OSError:
+            continue
+        stack.extend(_children(p))
+    return total
+
+
+def percentiles(values, points=(50, 90, 99)):
+    if not values:
+        return {**{f'p{p}': None for p in points}, 'max': None, 'n': 0}
+    values = sorted(values)
+    out = {f'p{p}': values[min(len(values) - 1, int(len(values) * p / 100))] for p in points}
+    out['max'] = values[-1]
+    out['n'] = len(values)
+    return out
+
+
+# --- client processes ---
+
+class _Client:
+    __slots__ = ('slow', 'received', 'evicted', 'closed_code')
+
+    def __init__(self, slow):
+        self.slow = slow
+        self.received = 0
+        self.evicted = False
+        self.closed_code = None
+
+
+async def _read(ws, client, opts, latencies, stopping):
+    try:
+        async for raw in ws:
+            if '"bench_ts"' not in raw:
+                continue   # stats frames, history replies
+            knock = json.loads(raw).get('data') or {}
+            if 'bench_ts' in knock:
+                latencies.append(time.time() - knock['bench_ts'])
+                client.received += 1
+            if client.slow:
+                await asyncio.sleep(opts['slow_delay'])
+    except websockets.ConnectionClosed as e:
+        client.closed_code = e.rcvd.code if e.rcvd else None
+    if not stopping.is_set():
+        client.evicted = True   # the server (or the transport) ended it, not us
+
+
+async def _swarm(url, count, slow_count, opts, ready_q, stop_ev, index):
+    fast_lat, slow_lat = [], []
+    handshake, init = [], []
+    clients, sockets, readers = [], [], []
+    failed = rejected = 0
+    stopping = asyncio.Event()
+    gap = 1.0 / opts['connect_rate'] if opts['connect_rate'] else 0
+
+    async def connect(slow):
+        nonlocal failed, rejected
+        t0 = time.perf_counter()
+        try:
+            ws = await websockets.connect(url, open_timeout=opts['timeout'], close_timeout=1,
+                                          max_queue=opts['max_queue'], ping_interval=None,
+                                          max_size=None, compression=None)
+        except Exception:
+            failed += 1
+            return
+        handshake.append(time.perf_counter() - t0)
+        try:
+            first = await asyncio.wait_for(ws.recv(), opts['timeout'])
+        except websockets.ConnectionClosed as e:
+            rejected += e.rcvd is not None and e.rcvd.code == 1008
+            failed += not (e.rcvd is not None and e.rcvd.code == 1008)
+            return
+        except Exception:
+            failed += 1
+            await ws.close()
+            return
+        if 'init_stats' not in first[:64]:
+            failed += 1
+            await ws.close()
+            return
+        init.append(time.perf_counter() - t0)
+        client = _Client(slow)
+        clients.append(client)
+        sockets.append(ws)
+        readers.append(asyncio.create_task(
+            _read(ws, client, opts, slow_lat if slow else fast_lat, stopping)))
+
+    kinds = [True] * slow_count + [False] * (count - slow_count)
+    random.Random(index).shuffle(kinds)
+    pending = []
+    for slow in kinds:
+        pending.append(asyncio.create_task(connect(slow)))
+        if gap:
+            await asyncio.sleep(gap)
+    await asyncio.gather(*pending)
+    ready_q.put((index, len(clients)))
+
+    await asyncio.get_running_loop().run_in_executor(None, stop_ev.wait)
+    stopping.set()
+    for task in readers:
+        task.cancel()
+    await asyncio.gather(*readers, return_exceptions=True)
+    await asyncio.gather(*[ws.close() for ws in sockets], return_exceptions=True)
+    return {
+        'handshake': handshake, 'init': init, 'fast': fast_lat, 'slow': slow_lat,
+        'failed': failed, 'rejected': rejected,
+        'connected': len(clients),
+        'evicted': sum(c.evicted for c in clients),
+        'evicted_slow': sum(c.evicted and c.slow for c in clients),
+        'received_fast': [c.received for c in clients if not c.slow],
+        'received_slow': [c.received for c in clients if c.slow],
+    }
+
+
+def _client_proc(index, url, count, slow_count, opts, ready_q, stop_ev, result_q):
+    _raise_fd_limit()
+    result_q.put((index, asyncio.run(_swarm(url, count, slow_count, opts, ready_q, stop_ev, index))))
+
+
+def _split(total, parts):
+    return [total // parts + (i < total % parts) for i in range(parts)]
+
+
+# --- publisher ---
+
+def synthetic_knock(seq, rng, protos):
+    proto = rng.choice(protos)
+    return {
+        "t": int(time.time()), "ip": f"198.51.{rng.randrange(100)}.{rng.randrange(1, 255)}",
+        "user": "root", "pass": rng.choice(("123456", "admin", "password", "root")),
+        "proto": proto, "city": "Testville", "region": None, "country": "Testland",
+        "iso": rng.choice(("US", "CN", "DE", "BR", "RU")), "isp": "Bench ISP", "asn": 64500,
+        "lat": rng.uniform(-60, 60), "lng": rng.uniform(-180, 180),
+        "source": "bench", "source_display": "bench",
+        "bench_seq": seq, "bench_ts": time.time(),
+    }
+
+
+def publish(redis_port, rate, duration, seed=0):
+    """Publish knocks at `rate`/s for `duration` s on a fixed schedule. Returns the count."""
+    client = redis.Redis(host='127.0.0.1', port=redis_port)
+    rng = random.Random(seed)
+    protos = sorted(PROTO)
+    start = time.perf_counter()
+    total = int(rate * duration)
+    for seq in range(total):
+        delay = start + seq / rate - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        client.publish("knocks_stream", json.dumps(synthetic_knock(seq, rng, protos)))
+    return total
+
+
+# --- report ---
+
+def _ms(stats):
+    return {k: (round(v * 1000, 1) if isinstance(v, float) else v) for k, v in stats.items()}
+
+
+def build_report(args, results, published, rss, redis_desc, publish_seconds):
+    merged = {k: [] for k in ('handshake', 'init', 'fast', 'slow', 'received_fast', 'received_slow')}
+    counts = {k: 0 for k in ('failed', 'rejected', 'connected', 'evicted', 'evicted_slow')}
+    for res in results:
+        for k in merged:
+            merged[k].extend(res[k])
+        for k in counts:
+            counts[k] += res[k]
+    expected = published * counts['connected']
+    got = sum(merged['received_fast']) + sum(merged['received_slow'])
+    connected = max(1, counts['connected'])
+    return {
+        'config': {k: getattr(args, k) for k in ('clients', 'slow_fraction', 'slow_delay', 'rate',
+                                                 'duration', 'drain', 'workers', 'client_procs',
+                                                 'connect_rate', 'max_queue')},
+        'redis': redis_desc,
+        'connections': counts,
+        'connect_latency_ms': {'handshake': _ms(percentiles(merged['handshake'])),
+                               'init_stats': _ms(percentiles(merged['init']))},
+        'fanout_latency_ms': {'fast': _ms(percentiles(merged['fast'])),
+                              'slow': _ms(percentiles(merged['slow']))},
+        'knocks': {'published': published, 'publish_seconds': round(publish_seconds, 2),
+                   'frames_expected': expected, 'frames_received': got,
+                   'frames_missing': expected - got,
+                   'fast_clients_incomplete': sum(n < published for n in merged['received_fast']),
+                   'slow_clients_incomplete': sum(n < published for n in merged['received_slow'])},
+        'memory': {'rss_idle_mb': round(rss['idle'] / 2**20, 1),
+                   'rss_connected_mb': round(rss['connected'] / 2**20, 1),
+                   'rss_end_mb': round(rss['end'] / 2**20, 1),
+                   'per_connection_kb': round((rss['connected'] - rss['idle']) / connected / 1024, 1),
+                   'growth_under_load_kb_per_connection':
+                       round((rss['end'] - rss['connected']) / connected / 1024, 1)},
+    }
+
+
+def print_report(rep):
+    c, k, m = rep['connections'], rep['knocks'], rep['memory']
+    print(f"\n📊 WebSocket fan-out ({rep['redis']}, {rep['config']['workers']} worker(s))")
+    print(f"  clients     {c['connected']} connected, {c['rejected']} rejected (1008), "
+          f"{c['failed']} failed, {c['evicted']} evicted ({c['evicted_slow']} slow)")
+    for name, st in rep['connect_latency_ms'].items():
+        print(f"  connect     {name:<10} p50 {st['p50']} ms  p90 {st['p90']} ms  "
+              f"p99 {st['p99']} ms  max {st['max']} ms")
+    for name, st in rep['fanout_latency_ms'].items():
+        print(f"  fan-out     {name:<10} p50 {st['p50']} ms  p90 {st['p90']} ms  "
+              f"p99 {st['p99']} ms  max {st['max']} ms  ({st['n']} frames)")
+    print(f"  knocks      {k['published']} published in {k['publish_seconds']} s; "
+          f"{k['frames_received']}/{k['frames_expected']} frames received, "
+          f"{k['frames_missing']} missing ({k['fast_clients_incomplete']} fast / "
+          f"{k['slow_clients_incomplete']} slow clients incomplete)")
+    print(f"  memory      RSS {m['rss_idle_mb']} MB idle -> {m['rss_connected_mb']} MB connected -> "
+          f"{m['rss_end_mb']} MB after load; {m['per_connection_kb']} KB/connection, "
+          f"+{m['growth_under_load_kb_per_connection']} KB/connection under load")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--slow-fraction', type=float, default=0.1,
+                        help='share of clients that read slowly (default 0.1)')
+    parser.add_argument('--slow-delay', type=float, default=0.5,
+                        help='seconds a slow client sleeps after each frame (default 0.5)')
+    parser.add_argument('--rate', type=float, default=20, help='knocks published per second')
+    parser.add_argument('--duration', type=float, default=20, help='seconds of publishing')
+    parser.add_argument('--drain', type=float, default=5,
+                        help='seconds to keep reading after the last publish (default 5)')
+    parser.add_argument('--workers', type=int, default=1, help='uvicorn workers for main.py')
+    parser.add_argument('--client-procs', type=int, default=max(1, min(8, (os.cpu_count() or 2) // 2)),
+                        help='processes hosting the simulated clients')
+    parser.add_argument('--connect-rate', type=float, default=500,
+                        help='new connections per second, across all client processes (0 = all at once)')
+    parser.add_argument('--max-queue', type=int, default=16,
+                        help='frames a client buffers before TCP backpressure (default 16)')
+    parser.add_argument('--timeout', type=float, default=30, help='per-connection connect timeout')
+    parser.add_argument('--redis', choices=('auto', 'server', 'fake'), default='auto',
+                        help='Redis stand-in: redis-server if on PATH (auto), or fakeredis')
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE',
+                        help='extra environment for main.py, e.g. WS_MAX_CONNECTIONS=500')
+    parser.add_argument('--json', metavar='PATH', help='also write the report as JSON')
+    args = parser.parse_args()
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))   # still stop the app
+    fd_limit = _raise_fd_limit()
+    per_proc = -(-args.clients // args.client_procs)
+    if per_proc + 64 > fd_limit:
+        print(f"⚠️ {per_proc} clients per process but the descriptor limit is {fd_limit}; "
+              f"raise ulimit -n or --client-procs", flush=True)
+    extra_env = dict(item.split('=', 1) for item in args.env)
+
+    redis_port, app_port = _free_port(), _free_port()
+    procs = []
+    with tempfile.TemporaryDirectory(prefix='knock-loadtest-') as db_dir:
+        try:
+            redis_proc, redis_desc = start_redis(redis_port, args.redis)
+            procs.append(redis_proc)
+            print(f"🧪 Redis stand-in: {redis_desc} on 127.0.0.1:{redis_port}", flush=True)
+            init_db(db_dir)
+            app_proc = start_app(app_port, redis_port, args.workers, db_dir, extra_env)
+            procs.append(app_proc)
+            wait_for_app(app_port)
+            time.sleep(1)   # let the lifespan tasks settle before the idle baseline
+            rss = {'idle': rss_bytes(app_proc.pid)}
+
+            ctx = mp.get_context('spawn')
+            ready_q, result_q, stop_ev = ctx.Queue(), ctx.Queue(), ctx.Event()
+            opts = {'slow_delay': args.slow_delay, 'max_queue': args.max_queue, 'timeout': args.timeout,
+                    'connect_rate': args.connect_rate / args.client_procs if args.connect_rate else 0}
+            url = f'ws://127.0.0.1:{app_port}/ws'
+            slow_total = round(args.clients * args.slow_fraction)
+            workers = []
+            for i, (count, slow) in enumerate(zip(_split(args.clients, args.client_procs),
+                                                  _split(slow_total, args.client_procs))):
+                p = ctx.Process(target=_client_proc,
+                                args=(i, url, count, slow, opts, ready_q, stop_ev, result_q), daemon=True)
+                p.start()
+                workers.append(p)
+            print(f"🔌 Connecting {args.clients} clients ({slow_total} slow) "
+                  f"from {args.client_procs} process(es)...", flush=True)
+            ramp = args.clients / args.connect_rate if args.connect_rate else 0
+            connected = sum(ready_q.get(timeout=ramp + args.timeout + 60)[1] for _ in workers)
+            time.sleep(1)
+            rss['connected'] = rss_bytes(app_proc.pid)
+
+            print(f"📣 {connected} connected; publishing {args.rate}/s for {args.duration}s...", flush=True)
+            t0 = time.perf_counter()
+            published = publish(redis_port, args.rate, args.duration)
+            publish_seconds = time.perf_counter() - t0
+            time.sleep(args.drain)
+            rss['end'] = rss_bytes(app_proc.pid)
+            stop_ev.set()
+            results = [result_q.get()[1] for _ in workers]
+            for p in workers:
+                p.join(10)
+        finally:
+            for proc in reversed(procs):
+                proc.terminate()
+                try:
+                    proc.wait(10)
+                except subprocess.TimeoutExpired:
+                    proc.kill()
+
+    report = build_report(args, results, published, rss, redis_desc, publish_seconds)
+    print_report(report)
+    if args.json:
+        Path(args.json).write_text(json.dumps(report, indent=2) + '\n')
+        print(f"💾 Report written to {args.json}")
+
+
+if __name__ == '__main__':
+    main()
@@ -18,9 +18,14 @@ def get_redis_client():
     # seconds when Redis is unreachable. These clients only ever issue short single-key commands,
     # so a 1s cap has ~1000x headroom and can only fire when Redis is genuinely unhealthy — keep
     # them for short cache ops only (a blocking command like BLPOP would hit socket_timeout).
+    # With REDIS_MODE=embedded the monitor serves these keys on KNOCK_BUS_SOCKET, which it
+    # exports to its honeypot subprocesses.
+    if os.environ.get('REDIS_MODE', '').strip().lower() == 'embedded' and os.environ.get('KNOCK_BUS_SOCKET'):
+        location = {'unix_socket_path': os.environ['KNOCK_BUS_SOCKET']}
+    else:
+        location = {'host': os.environ.get('REDIS_HOST', 'localhost'), 'port': 6379}
     return redis.Redis(
-        host=os.environ.get('REDIS_HOST', 'localhost'),
-        port=6379,
+        **location,
         db=int(os.environ.get('REDIS_DB', '0')),
         decode_responses=True,
         socket_connect_timeout=1.0,
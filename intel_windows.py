@@ -0,0 +1,134 @@
+"""
+Time-windowed intel rollups behind the today (UTC) / 7d / 30d leaderboards.
+
+The all-time *_intel tables can't answer "top passwords this week". The monitor's DB
+writer therefore also keeps:
+
+  <dim>_intel_day  (day, <key>, proto, hits)  — one UTC-day bucket per value/protocol,
+                                                 pruned once older than the widest window
+  <dim>_intel_win  (win, <key>, proto, hits)  — each window pre-merged, plus an
+                                                 ALL_PROTOS row per value
+
+Knocks are added to today's bucket and to every window at once. When the UTC day
+rolls over, the bucket that slid out of each window is subtracted. Reading a
+windowed top-N is then one indexed `ORDER BY hits DESC LIMIT n`, with no per-request
+merge of 30 days of buckets. Windows are whole UTC days that include today, so the
+shortest is 'today' (the current UTC day, not a rolling 24 hours).
+"""
+from datetime import date, datetime, timedelta, timezone
+
+WINDOWS = {'today': 1, '7d': 7, '30d': 30}   # window -> UTC day buckets it spans
+RETENTION_DAYS = max(WINDOWS.values())
+ALL_PROTOS = -1                            # window-table proto of the all-protocol rows
+
+# Board stat type (as named in main.py) -> (table prefix, key column, knock field)
+DIMENSIONS = {
+    'location': ('country', 'iso_code', 'iso'),
+    'password': ('pass', 'password', 'pass'),
+    'username': ('user', 'username', 'user'),
+    'isp':      ('isp', 'isp', 'isp'),
+    'ip':       ('ip', 'ip', 'ip'),
+}
+
+
+def day_table(stat_type):
+    return f"{DIMENSIONS[stat_type][0]}_intel_day"
+
+
+def window_table(stat_type):
+    return f"{DIMENSIONS[stat_type][0]}_intel_win"
+
+
+def utc_day(now=None):
+    return (now or datetime.now(timezone.utc)).strftime('%Y-%m-%d')
+
+
+def _shift(day, days):
+    return (date.fromisoformat(day) + timedelta(days=days)).isoformat()
+
+
+def init_window_tables(cur):
+    for stat_type, (_, key, _) in DIMENSIONS.items():
+        cur.execute(f"""CREATE TABLE IF NOT EXISTS {day_table(stat_type)} (
+            day TEXT, {key} TEXT, proto INTEGER, hits INTEGER,
+            PRIMARY KEY (day, {key}, proto))""")
+        cur.execute(f"""CREATE TABLE IF NOT EXISTS {window_table(stat_type)} (
+            win TEXT, {key} TEXT, proto INTEGER, hits INTEGER,
+            PRIMARY KEY (win, {key}, proto))""")
+        cur.execute(f"CREATE INDEX IF NOT EXISTS idx_{window_table(stat_type)}_hits "
+                    f"ON {window_table(stat_type)}(win, proto, hits DESC)")
+    # Last UTC day the window tables were advanced to.
+    cur.execute("CREATE TABLE IF NOT EXISTS intel_window_state (id INTEGER PRIMARY KEY CHECK (id = 0), day TEXT)")
+
+
+class WindowRollups:
+    """Per-batch accumulator for the DB writer thread: add() each knock, then flush()
+    on the batch's cursor before committing. A hot password repeated across a batch
+    costs one upsert per table, not one per knock."""
+
+    def __init__(self):
+        self.counts = {}   # stat_type -> {(value, proto): hits}
+
+    def add(self, knock, proto):
+        for stat_type, (_, _, field) in DIMENSIONS.items():
+            value = knock.get(field)
+            if value is None:
+                continue
+            counts = self.counts.setdefault(stat_type, {})
+            counts[(value, proto)] = counts.get((value, proto), 0) + 1
+
+    def discard(self):
+        self.counts = {}
+
+    def flush(self, cur, today=None):
+        today = today or utc_day()
+        self.roll(cur, today)
+        for stat_type, counts in self.counts.items():
+            key = DIMENSIONS[stat_type][1]
+            totals = {}
+            for (value, _), hits in counts.items():
+                totals[value] = totals.get(value, 0) + hits
+            cur.executemany(
+                f"INSERT INTO {day_table(stat_type)} (day, {key}, proto, hits) VALUES (?, ?, ?, ?) "
+                f"ON CONFLICT(day, {key}, proto) DO UPDATE SET hits = hits + excluded.hits",
+                [(today, value, proto, hits) for (value, proto), hits in counts.items()])
+            rows = [(win, value, proto, hits) for win in WINDOWS for (value, proto), hits in counts.items()]
+            rows += [(win, value, ALL_PROTOS, hits) for win in WINDOWS for value, hits in totals.items()]
+            cur.executemany(
+                f"INSERT INTO {window_table(stat_type)} (win, {key}, proto, hits) VALUES (?, ?, ?, ?) "
+                f"ON CONFLICT(win, {key}, proto) DO UPDATE SET hits = hits + excluded.hits",
+                rows)
+        self.counts = {}
+
+    def roll(self, cur, today):
+        """Advance the window tables to `today`. Each day stepped over subtracts the bucket
+        that left every window; buckets past RETENTION_DAYS are then pruned. A no-op once
+        today has been applied; catches up day by day after downtime."""
+        row = cur.execute("SELECT day FROM intel_window_state WHERE id = 0").fetchone()
+        last = row[0] if row else None
+        if last is not None and last >= today:
+            return   # already applied (or the clock stepped back; never subtract twice)
+        if last is not None:
+            day = _shift(last, 1)
+            while day <= today:
+                for win, days in WINDOWS.items():
+                    self._subtract(cur, win, _shift(day, -days))
+                day = _shift(day, 1)
+            for stat_type in DIMENSIONS:
+                cur.execute(f"DELETE FROM {window_table(stat_type)} WHERE hits <= 0")
+        cutoff = _shift(today, -RETENTION_DAYS)
+        for stat_type in DIMENSIONS:
+            cur.execute(f"DELETE FROM {day_table(stat_type)} WHERE day <= ?", (cutoff,))
+        cur.execute("INSERT INTO intel_window_state (id, day) VALUES (0, ?) "
+                    "ON CONFLICT(id) DO UPDATE SET day = excluded.day", (today,))
+
+    @staticmethod
+    def _subtract(cur, win, day):
+        for stat_type, (_, key, _) in DIMENSIONS.items():
+            wt, dt = window_table(stat_type), day_table(stat_type)
+            cur.execute(f"""UPDATE {wt} SET hits = {wt}.hits - d.hits
+                FROM (SELECT {key}, proto, hits FROM {dt} WHERE day = ?) AS d
+                WHERE {wt}.win = ? AND {wt}.{key} = d.{key} AND {wt}.proto = d.proto""", (day, win))
+            cur.execute(f"""UPDATE {wt} SET hits = {wt}.hits - d.hits
+                FROM (SELECT {key}, SUM(hits) AS hits FROM {dt} WHERE day = ? GROUP BY {key}) AS d
+                WHERE {wt}.win = ? AND {wt}.{key} = d.{key} AND {wt}.proto = {ALL_PROTOS}""", (day, win))
@@ -8,14 +8,15 @@ from datetime import datetime, timezone
 
 import redis
 
+from knock_bus import redis_url
+
 DB_PATH = os.environ.get('DB_DIR', 'data') + '/knock_knock.db'
-REDIS_HOST = os.environ.get('REDIS_HOST', 'localhost')
 REDIS_DB = int(os.environ.get('REDIS_DB', '0'))
 
 
 def get_redis():
     try:
-        r = redis.Redis(host=REDIS_HOST, port=6379, db=REDIS_DB, decode_responses=True)
+        r = redis.Redis.from_url(redis_url(REDIS_DB), decode_responses=True)
         r.ping()
         return r
     except Exception as e:
@@ -0,0 +1,762 @@
+"""
+Embedded event bus and state service for single-host deployments (REDIS_MODE=embedded).
+
+The monitor keeps the shared state itself in a BusStore: the feed stream, counters,
+blocked-IP keys, protocol config and rates. It writes to the store in-process, so a knock
+costs no network round trip. A BusServer exposes the same store on a Unix socket. The
+socket speaks the subset of the Redis protocol that the web tier, the honeypots and
+ip_ban.py use, so they keep their redis-py clients and only change how they connect
+(redis_url()). Both RESP2 and RESP3 are spoken; redis-py defaults to RESP3 via HELLO.
+
+Supported commands:
+  - strings with expiry: GET/SET/SETEX/INCR/INCRBY/EXPIRE/PEXPIRE/TTL/PTTL/EXISTS/DEL/KEYS/SCAN
+  - hashes: HSET/HGET/HGETALL/HEXISTS/HINCRBY/HDEL
+  - the feed stream: XADD/XRANGE/XREVRANGE/XLEN
+  - pub/sub: PUBLISH/SUBSCRIBE/UNSUBSCRIBE
+  - MULTI/EXEC
+  - the redis-py Lock scripts, which the web tier's stats-leader election runs via
+    EVALSHA/EVAL/SCRIPT LOAD; other Lua is refused.
+
+State lives in memory. After a restart the monitor re-seeds counters and bans from
+SQLite, as it does with Redis, and the feed starts empty.
+"""
+import asyncio
+import bisect
+import fnmatch
+import hashlib
+import math
+import os
+import threading
+import time
+
+from redis.lock import Lock as _RedisLock
+
+REDIS_EMBEDDED = os.environ.get('REDIS_MODE', 'server').strip().lower() == 'embedded'
+BUS_SOCKET = os.environ.get('KNOCK_BUS_SOCKET', os.path.join(os.environ.get('DB_DIR', 'data'), 'knock-bus.sock'))
+PUBSUB_BUFFER_LIMIT = 32 * 1024 * 1024   # like Redis's pubsub client-output-buffer-limit
+SWEEP_SECONDS = 60
+
+
+def redis_url(db=0):
+    """Connection URL for redis-py's from_url(): the bus socket when embedded, else REDIS_HOST."""
+    if REDIS_EMBEDDED:
+        return f"unix://{os.path.abspath(BUS_SOCKET)}?db={db}"
+    return f"redis://{os.environ.get('REDIS_HOST', 'localhost')}/{db}"
+
+
+class BusError(Exception):
+    """A command error, sent to socket clients as a RESP error ('ERR ...' unless prefixed)."""
+
+
+class Status(str):
+    """A RESP simple string (+OK), as opposed to a bulk string."""
+
+
+class Push(list):
+    """A pub/sub frame: a RESP3 push (>), or a plain array to a RESP2 client."""
+
+
+def _wrongtype():
+    return BusError("WRONGTYPE Operation against a key holding the wrong kind of value")
+
+
+def _text(value):
+    """Stored form of a value, matching how redis-py encodes arguments."""
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'surrogateescape')
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def _integer(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise BusError("ERR value is not an integer or out of range")
+
+
+class _Stream:
+    """Append-only entries ordered by (ms, seq) ID, trimmed from the front."""
+
+    def __init__(self):
+        self.ids = []       # [(ms, seq)], sorted, for bisect
+        self.entries = []   # [(id_str, {field: value})], parallel to ids
+        self.last = (0, 0)
+
+    def next_id(self, requested):
+        if requested == '*':
+            ms = int(time.time() * 1000)
+            return (ms, 0) if ms > self.last[0] else (self.last[0], self.last[1] + 1)
+        ms, _, seq = requested.partition('-')
+        ms = _integer(ms)
+        if seq == '*':
+            return (ms, 0) if ms > self.last[0] else (ms, self.last[1] + 1)
+        new = (ms, _integer(seq or 0))
+        if new <= self.last:
+            raise BusError("ERR The ID specified in XADD is equal or smaller than the target stream top item")
+        return new
+
+    def trim(self, maxlen, approximate):
+        excess = len(self.ids) - maxlen
+        # '~' lets the trim lag, as Redis does per radix-tree node; amortizes the slice.
+        if excess > 0 and (not approximate or excess >= max(1, maxlen // 10)):
+            del self.ids[:excess]
+            del self.entries[:excess]
+
+    @staticmethod
+    def bound(text, upper):
+        """A range bound as ((ms, seq), exclusive). '-'/'+' are open; a bare 'ms' covers
+        every seq of that millisecond, so it resolves by which side (and exclusivity) it is."""
+        exclusive = text.startswith('(')
+        text = text[1:] if exclusive else text
+        if text == '-':
+            return (0, 0), exclusive
+        if text == '+':
+            return (math.inf, math.inf), exclusive
+        ms, sep, seq = text.partition('-')
+        if sep:
+            return (_integer(ms), _integer(seq)), exclusive
+        return (_integer(ms), math.inf if upper != exclusive else 0), exclusive
+
+    def range(self, start, end, count, reverse):
+        (lo, lo_x), (hi, hi_x) = self.bound(start, False), self.bound(end, True)
+        i = bisect.bisect_right(self.ids, lo) if lo_x else bisect.bisect_left(self.ids, lo)
+        j = bisect.bisect_left(self.ids, hi) if hi_x else bisect.bisect_right(self.ids, hi)
+        if i >= j:
+            return []
+        if reverse:
+            k = j - count if count is not None else i
+            return self.entries[max(i, k):j][::-1]
+        return self.entries[i:j if count is None else min(j, i + count)]
+
+
+class BusStore:
+    """Thread-safe in-memory state with a redis-py-like API (decode_responses=True).
+
+    The monitor calls these methods directly in place of a redis.Redis client; the
+    BusServer maps socket commands onto the same methods.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._data = {}      # key -> str | dict (hash) | _Stream
+        self._expires = {}   # key -> time.monotonic() deadline
+        self._channels = {}  # channel -> set of deliver(bytes) callbacks
+
+    # --- keyspace ---
+
+    def _live(self, key):
+        deadline = self._expires.get(key)
+        if deadline is not None and deadline <= time.monotonic():
+            self._data.pop(key, None)
+            del self._expires[key]
+        return self._data.get(key)
+
+    def _typed(self, key, kind):
+        value = self._live(key)
+        if value is not None and not isinstance(value, kind):
+            raise _wrongtype()
+        return value
+
+    def sweep_expired(self):
+        with self._lock:
+            now = time.monotonic()
+            for key in [k for k, deadline in self._expires.items() if deadline <= now]:
+                self._data.pop(key, None)
+                del self._expires[key]
+
+    def exists(self, *names):
+        with self._lock:
+            return sum(1 for name in names if self._live(_text(name)) is not None)
+
+    def delete(self, *names):
+        with self._lock:
+            removed = 0
+            for name in map(_text, names):
+                if self._live(name) is not None:
+                    del self._data[name]
+                    removed += 1
+                self._expires.pop(name, None)
+            return removed
+
+    def keys(self, pattern='*'):
+        with self._lock:
+            pattern = _text(pattern)
+            return [k for k in list(self._data) if fnmatch.fnmatchcase(k, pattern) and self._live(k) is not None]
+
+    def scan_iter(self, match=None, count=None, _type=None):
+        yield from self.keys(match or '*')
+
+    def pexpire(self, name, ms):
+        with self._lock:
+            name = _text(name)
+            if self._live(name) is None:
+                return False
+            self._expires[name] = time.monotonic() + _integer(ms) / 1000
+            return True
+
+    def expire(self, name, time_seconds):
+        return self.pexpire(name, _integer(time_seconds) * 1000)
+
+    def pttl(self, name):
+        with self._lock:
+            name = _text(name)
+            if self._live(name) is None:
+                return -2
+            deadline = self._expires.get(name)
+            return -1 if deadline is None else max(0, int((deadline - time.monotonic()) * 1000))
+
+    def ttl(self, name):
+        ms = self.pttl(name)
+        return ms if ms < 0 else (ms + 999) // 1000
+
+    def ping(self):
+        return True
+
+    # --- strings ---
+
+    def get(self, name):
+        with self._lock:
+            return self._typed(_text(name), str)
+
+    def set(self, name, value, ex=None, px=None, nx=False, xx=False, keepttl=False):
+        with self._lock:
+            name = _text(name)
+            exists = self._live(name) is not None
+            if (nx and exists) or (xx and not exists):
+                return None
+            self._data[name] = _text(value)
+            if ex is not None or px is not None:
+                ms = _integer(px) if px is not None else _integer(ex) * 1000
+                self._expires[name] = time.monotonic() + ms / 1000
+            elif not keepttl:
+                self._expires.pop(name, None)
+            return True
+
+    def setex(self, name, time_seconds, value):
+        return self.set(name, value, ex=time_seconds)
+
+    def incrby(self, name, amount=1):
+        with self._lock:
+            name = _text(name)
+            value = _integer(self._typed(name, str) or 0) + _integer(amount)
+            self._data[name] = str(value)
+            return value
+
+    incr = incrby
+
+    # --- hashes ---
+
+    def hset(self, name, key=None, value=None, mapping=None, items=None):
+        pairs = dict(mapping or {})
+        if key is not None:
+            pairs[key] = value
+        for i in range(0, len(items or ()), 2):
+            pairs[items[i]] = items[i + 1]
+        with self._lock:
+            name = _text(name)
+            h = self._typed(name, dict)
+            if h is None:
+                h = self._data[name] = {}
+            added = 0
+            for k, v in pairs.items():
+                k = _text(k)
+                added += k not in h
+                h[k] = _text(v)
+            return added
+
+    def hget(self, name, key):
+        with self._lock:
+            return (self._typed(_text(name), dict) or {}).get(_text(key))
+
+    def hgetall(self, name):
+        with self._lock:
+            return dict(self._typed(_text(name), dict) or {})
+
+    def hexists(self, name, key):
+        with self._lock:
+            return _text(key) in (self._typed(_text(name), dict) or {})
+
+    def hincrby(self, name, key, amount=1):
+        with self._lock:
+            name, key = _text(name), _text(key)
+            h = self._typed(name, dict)
+            if h is None:
+                h = self._data[name] = {}
+            value = _integer(h.get(key, 0)) + _integer(amount)
+            h[key] = str(value)
+            return value
+
+    def hdel(self, name, *keys):
+        with self._lock:
+            name = _text(name)
+            h = self._typed(name, dict) or {}
+            removed = sum(1 for k in map(_text, keys) if h.pop(k, None) is not None)
+            if not h:
+                self._data.pop(name, None)
+            return removed
+
+    # --- lists: only read, by the pre-stream feed migration; there are none here ---
+
+    def lrange(self, name, start, end):
+        with self._lock:
+            if self._live(_text(name)) is not None:
+                raise _wrongtype()
+            return []
+
+    # --- streams ---
+
+    def xadd(self, name, fields, id='*', maxlen=None, approximate=True, nomkstream=False, minid=None, limit=None):
+        with self._lock:
+            name = _text(name)
+            stream = self._typed(name, _Stream)
+            if stream is None:
+                if nomkstream:
+                    return None
+                stream = self._data[name] = _Stream()
+            new = stream.next_id(_text(id))
+            id_str = f"{new[0]}-{new[1]}"
+            stream.ids.append(new)
+            stream.entries.append((id_str, {_text(k): _text(v) for k, v in fields.items()}))
+            stream.last = new
+            if maxlen is not None:
+                stream.trim(_integer(maxlen), approximate)
+            return id_str
+
+    def xrange(self, name, min='-', max='+', count=None):
+        with self._lock:
+            stream = self._typed(_text(name), _Stream)
+            return stream.range(_text(min), _text(max), count, False) if stream else []
+
+    def xrevrange(self, name, max='+', min='-', count=None):
+        with self._lock:
+            stream = self._typed(_text(name), _Stream)
+            return stream.range(_text(min), _text(max), count, True) if stream else []
+
+    def xlen(self, name):
+        with self._lock:
+            stream = self._typed(_text(name), _Stream)
+            return len(stream.ids) if stream else 0
+
+    # --- pub/sub ---
+
+    def subscribe(self, channel, deliver):
+        """Register deliver({resp3: bytes}) for `channel`; called from the publishing thread."""
+        with self._lock:
+            self._channels.setdefault(channel, set()).add(deliver)
+
+    def unsubscribe(self, channel, deliver):
+        with self._lock:
+            subscribers = self._channels.get(channel)
+            if subscribers:
+                subscribers.discard(deliver)
+                if not subscribers:
+                    del self._channels[channel]
+
+    def publish(self, channel, message):
+        channel, message = _text(channel), _text(message)
+        with self._lock:
+            subscribers = list(self._channels.get(channel, ()))
+        if subscribers:
+            frame = Push(["message", channel, message])
+            frames = {False: encode_reply(frame), True: encode_reply(frame, resp3=True)}
+            for deliver in subscribers:
+                deliver(frames)
+        return len(subscribers)
+
+    # --- redis-py Lock scripts (stats-leader election) ---
+
+    def _lock_release(self, key, token):
+        if self.get(key) != token:
+            return 0
+        self.delete(key)
+        return 1
+
+    def _lock_reacquire(self, key, token, ms):
+        if self.get(key) != token:
+            return 0
+        self.pexpire(key, ms)
+        return 1
+
+    def _lock_extend(self, key, token, ms, replace):
+        if self.get(key) != token:
+            return 0
+        remaining = self.pttl(key)
+        if remaining < 0:
+            return 0
+        self.pexpire(key, _integer(ms) + (remaining if replace == '0' else 0))
+        return 1
+
+    def eval_script(self, sha, keys, args):
+        """Run one of the redis-py Lock scripts, by SHA1. Anything else is refused."""
+        run = _LOCK_SCRIPTS.get(sha)
+        if run is None:
+            raise BusError("NOSCRIPT No matching script. Please use EVAL.")
+        with self._lock:
+            return run(self, *keys, *args)
+
+
+_LOCK_SCRIPTS = {
+    hashlib.sha1(_RedisLock.LUA_RELEASE_SCRIPT.encode()).hexdigest(): BusStore._lock_release,
+    hashlib.sha1(_RedisLock.LUA_REACQUIRE_SCRIPT.encode()).hexdigest(): BusStore._lock_reacquire,
+    hashlib.sha1(_RedisLock.LUA_EXTEND_SCRIPT.encode()).hexdigest(): BusStore._lock_extend,
+}
+
+
+# --- RESP2/RESP3 wire format ---
+
+class _Encoded(bytes):
+    """Reply frames already encoded (SUBSCRIBE/UNSUBSCRIBE answer once per channel)."""
+
+
+def encode_reply(value, resp3=False):
+    """RESP bytes for a reply value: RESP3 (HELLO 3, redis-py's default) or RESP2."""
+    if isinstance(value, _Encoded):
+        return value
+    if value is None:
+        return b"_\r\n" if resp3 else b"$-1\r\n"
+    if isinstance(value, BusError):
+        msg = str(value)
+        if not msg.split(' ', 1)[0].isupper():
+            msg = f"ERR {msg}"
+        return f"-{msg}\r\n".encode()
+    if isinstance(value, Status):
+        return f"+{value}\r\n".encode()
+    if isinstance(value, bool):
+        return b":1\r\n" if value else b":0\r\n"
+    if isinstance(value, int):
+        return f":{value}\r\n".encode()
+    if isinstance(value, dict):
+        if not resp3:
+            return encode_reply([x for kv in value.items() for x in kv])
+        return b"".join([f"%{len(value)}\r\n".encode(),
+                         *(encode_reply(x, resp3) for kv in value.items() for x in kv)])
+    if isinstance(value, (list, tuple)):
+        kind = ">" if resp3 and isinstance(value, Push) else "*"
+        return b"".join([f"{kind}{len(value)}\r\n".encode(), *(encode_reply(v, resp3) for v in value)])
+    data = value if isinstance(value, bytes) else _text(value).encode('utf-8', 'surrogateescape')
+    return b"$%d\r\n%s\r\n" % (len(data), data)
+
+
+def parse_commands(buffer):
+    """Complete commands at the front of `buffer` -> ([[arg, ...], ...], bytes consumed).
+
+    Clients send arrays of bulk strings; a bare line (redis-cli, nc) is split on spaces.
+    """
+    commands, pos, n = [], 0, len(buffer)
+    while pos < n:
+        eol = buffer.find(b"\r\n", pos)
+        if eol < 0:
+            break
+        if buffer[pos:pos + 1] != b"*":
+            commands.append(buffer[pos:eol].decode('utf-8', 'surrogateescape').split())
+            pos = eol + 2
+            continue
+        count, cursor, args = int(buffer[pos + 1:eol]), eol + 2, []
+        for _ in range(count):
+            eol = buffer.find(b"\r\n", cursor)
+            if eol < 0:
+                break
+            if buffer[cursor:cursor + 1] != b"$":
+                raise BusError("Protocol error: expected '$'")
+            size = int(buffer[cursor + 1:eol])
+            start, cursor = eol + 2, eol + 2 + size + 2
+            if cursor > n:
+                break
+            args.append(buffer[start:start + size].decode('utf-8', 'surrogateescape'))
+        if len(args) < count:
+            break
+        commands.append(args)
+        pos = cursor
+    return commands, pos
+
+
+def _options(args, flags=(), valued=()):
+    """Parse trailing Redis options: {'NX': True, 'EX': '30', ...}."""
+    out, i = {}, 0
+    while i < len(args):
+        word = args[i].upper()
+        if word in flags:
+            out[word] = True
+        elif word in valued and i + 1 < len(args):
+            out[word] = args[i + 1]
+            i += 1
+        else:
+            raise BusError("ERR syntax error")
+        i += 1
+    return out
+
+
+def _stream_reply(entries):
+    return [[id_str, [x for kv in fields.items() for x in kv]] for id_str, fields in entries]
+
+
+def _cmd_set(store, key, value, *opts):
+    o = _options(opts, flags=('NX', 'XX', 'KEEPTTL'), valued=('EX', 'PX'))
+    ok = store.set(key, value, ex=o.get('EX'), px=o.get('PX'), nx='NX' in o, xx='XX' in o, keepttl='KEEPTTL' in o)
+    return Status('OK') if ok else None
+
+
+def _cmd_xadd(store, key, *args):
+    args, maxlen, approximate, nomkstream = list(args), None, False, False
+    while args and args[0].upper() in ('NOMKSTREAM', 'MAXLEN'):
+        if args.pop(0).upper() == 'NOMKSTREAM':
+            nomkstream = True
+            continue
+        if args[0] in ('~', '='):
+            approximate = args.pop(0) == '~'
+        maxlen = args.pop(0)
+    if len(args) < 3 or len(args) % 2 == 0:
+        raise BusError("ERR wrong number of arguments for 'xadd' command")
+    fields = dict(zip(args[1::2], args[2::2]))
+    return store.xadd(key, fields, id=args[0], maxlen=maxlen, approximate=approximate, nomkstream=nomkstream)
+
+
+def _cmd_range(reverse):
+    def run(store, key, a, b, *opts):
+        count = _integer(_options(opts, valued=('COUNT',)).get('COUNT', -1))
+        count = None if count < 0 else count
+        entries = store.xrevrange(key, a, b, count) if reverse else store.xrange(key, a, b, count)
+        return _stream_reply(entries)
+    return run
+
+
+def _cmd_scan(store, cursor, *opts):
+    o = _options(opts, valued=('MATCH', 'COUNT', 'TYPE'))
+    return ["0", store.keys(o.get('MATCH', '*'))]   # one pass; COUNT is only a hint
+
+
+def _cmd_eval(store, script, numkeys, *rest):
+    return _cmd_evalsha(store, hashlib.sha1(script.encode('utf-8', 'surrogateescape')).hexdigest(), numkeys, *rest)
+
+
+def _cmd_evalsha(store, sha, numkeys, *rest):
+    n = _integer(numkeys)
+    return store.eval_script(sha.lower(), list(rest[:n]), list(rest[n:]))
+
+
+def _cmd_script(store, sub, *args):
+    sub = sub.upper()
+    if sub == 'LOAD' and len(args) == 1:
+        sha = hashlib.sha1(args[0].encode('utf-8', 'surrogateescape')).hexdigest()
+        if sha not in _LOCK_SCRIPTS:
+            raise BusError("ERR the embedded bus only runs the redis-py lock scripts")
+        return sha
+    if sub == 'EXISTS':
+        return [int(a.lower() in _LOCK_SCRIPTS) for a in args]
+    raise BusError(f"ERR unsupported SCRIPT subcommand '{sub}'")
+
+
+COMMANDS = {
+    'PING': lambda s, *a: a[0] if a else Status('PONG'),
+    'ECHO': lambda s, msg: msg,
+    'SELECT': lambda s, db: Status('OK'),      # one namespace per socket
+    'CLIENT': lambda s, *a: Status('OK'),      # SETINFO / SETNAME on connect
+    'GET': lambda s, k: s.get(k),
+    'SET': _cmd_set,
+    'SETEX': lambda s, k, t, v: Status('OK') if s.setex(k, t, v) else None,
+    'INCR': lambda s, k: s.incrby(k, 1),
+    'INCRBY': lambda s, k, n: s.incrby(k, n),
+    'EXISTS': lambda s, *k: s.exists(*k),
+    'DEL': lambda s, *k: s.delete(*k),
+    'UNLINK': lambda s, *k: s.delete(*k),
+    'EXPIRE': lambda s, k, t: s.expire(k, t),
+    'PEXPIRE': lambda s, k, t: s.pexpire(k, t),
+    'TTL': lambda s, k: s.ttl(k),
+    'PTTL': lambda s, k: s.pttl(k),
+    'KEYS': lambda s, p: s.keys(p),
+    'SCAN': _cmd_scan,
+    'HSET': lambda s, k, *a: s.hset(k, items=a) if a and len(a) % 2 == 0 else _arity('hset'),
+    'HGET': lambda s, k, f: s.hget(k, f),
+    'HGETALL': lambda s, k: s.hgetall(k),
+    'HEXISTS': lambda s, k, f: s.hexists(k, f),
+    'HINCRBY': lambda s, k, f, n: s.hincrby(k, f, n),
+    'HDEL': lambda s, k, *f: s.hdel(k, *f),
+    'LRANGE': lambda s, k, a, b: s.lrange(k, a, b),
+    'XADD': _cmd_xadd,
+    'XRANGE': _cmd_range(False),
+    'XREVRANGE': _cmd_range(True),
+    'XLEN': lambda s, k: s.xlen(k),
+    'PUBLISH': lambda s, c, m: s.publish(c, m),
+    'EVAL': _cmd_eval,
+    'EVALSHA': _cmd_evalsha,
+    'SCRIPT': _cmd_script,
+}
+
+
+def _arity(name):
+    raise BusError(f"ERR wrong number of arguments for '{name}' command")
+
+
+def execute(store, args):
+    """Run one command against `store`; returns the reply value (a BusError on failure)."""
+    if not args:
+        return BusError("ERR empty command")
+    name = args[0].upper()
+    handler = COMMANDS.get(name)
+    if handler is None:
+        return BusError(f"ERR unknown command '{args[0]}' (not supported by the embedded bus)")
+    try:
+        return handler(store, *args[1:])
+    except BusError as e:
+        return e
+    except TypeError:
+        return BusError(f"ERR wrong number of arguments for '{args[0].lower()}' command")
+
+
+class _BusConnection(asyncio.Protocol):
+    """One socket client: request/reply, MULTI/EXEC, or subscriber mode."""
+
+    def __init__(self, store, loop):
+        self.store = store
+        self.loop = loop
+        self.buffer = b""
+        self.queued = None      # commands queued by MULTI
+        self.channels = set()
+        self.transport = None
+        self.resp3 = False      # switched by HELLO 3
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        for channel in self.channels:
+            self.store.unsubscribe(channel, self.deliver)
+        self.channels.clear()
+
+    def deliver(self, frames):
+        """Called from any thread by BusStore.publish."""
+        self.loop.call_soon_threadsafe(self._write_message, frames[self.resp3])
+
+    def _write_message(self, frame):
+        if self.transport.is_closing():
+            return
+        if self.transport.get_write_buffer_size() > PUBSUB_BUFFER_LIMIT:
+            print("⚠️ Bus subscriber fell too far behind; disconnecting it", flush=True)
+            self.transport.close()
+            return
+        self.transport.write(frame)
+
+    def data_received(self, data):
+        self.buffer += data
+        try:
+            commands, used = parse_commands(self.buffer)
+        except (BusError, ValueError) as e:
+            self.transport.write(encode_reply(BusError(f"ERR Protocol error: {e}"), self.resp3))
+            self.transport.close()
+            return
+        self.buffer = self.buffer[used:]
+        replies = []
+        for args in commands:
+            if not args:
+                continue
+            try:
+                reply = self.handle(args)
+            except BusError as e:
+                reply = e
+            replies.append(encode_reply(reply, self.resp3))
+        self.transport.write(b"".join(replies))
+
+    def handle(self, args):
+        name = args[0].upper()
+        if name in ('SUBSCRIBE', 'UNSUBSCRIBE'):
+            return self._subscription(name, args[1:])
+        if self.channels and name != 'PING':
+            return BusError(f"ERR Can't execute '{args[0].lower()}' in subscribed mode")
+        if self.channels:
+            return Status('PONG') if self.resp3 else ["pong", args[1] if len(args) > 1 else ""]
+        if name == 'HELLO':
+            return self._hello(args[1:])
+        if name == 'MULTI':
+            if self.queued is not None:
+                return BusError("ERR MULTI calls can not be nested")
+            self.queued = []
+            return Status('OK')
+        if name == 'DISCARD':
+            self.queued = None
+            return Status('OK')
+        if name == 'EXEC':
+            if self.queued is None:
+                return BusError("ERR EXEC without MULTI")
+            queued, self.queued = self.queued, None
+            with self.store._lock:   # EXEC is atomic against every other client
+                return [execute(self.store, q) for q in queued]
+        if self.queued is not None:
+            self.queued.append(args)
+            return Status('QUEUED')
+        return execute(self.store, args)
+
+    def _hello(self, args):
+        version = _integer(args[0]) if args else (3 if self.resp3 else 2)
+        if version not in (2, 3):
+            return BusError("NOPROTO unsupported protocol version")
+        self.resp3 = version == 3
+        return {"server": "knock-bus", "version": "7.0.0", "proto": version, "id": id(self),
+                "mode": "standalone", "role": "master", "modules": []}
+
+    def _subscription(self, name, channels):
+        """Redis answers with one frame per channel rather than a single reply."""
+        frames = []
+        if name == 'SUBSCRIBE':
+            for channel in channels:
+                if channel not in self.channels:
+                    self.channels.add(channel)
+                    self.store.subscribe(channel, self.deliver)
+                frames.append(encode_reply(Push(["subscribe", channel, len(self.channels)]), self.resp3))
+            return _Encoded(b"".join(frames))
+        for channel in channels or sorted(self.channels) or [None]:
+            if channel in self.channels:
+                self.channels.discard(channel)
+                self.store.unsubscribe(channel, self.deliver)
+            frames.append(encode_reply(Push(["unsubscribe", channel, len(self.channels)]), self.resp3))
+        return _Encoded(b"".join(frames))
+
+
+class BusServer:
+    """Serves a BusStore on a Unix socket from its own event-loop thread."""
+
+    def __init__(self, store, path=BUS_SOCKET):
+        self.store = store
+        self.path = os.path.abspath(path)
+        self.ready = threading.Event()
+        self.loop = None
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True, name="knock-bus").start()
+        if not self.ready.wait(10):
+            raise RuntimeError(f"embedded bus did not start on {self.path}")
+        return self
+
+    def _run(self):
+        self.loop = asyncio.new_event_loop()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        try:
+            os.unlink(self.path)   # a socket left by a previous run
+        except FileNotFoundError:
+            pass
+        server = self.loop.run_until_complete(
+            self.loop.create_unix_server(lambda: _BusConnection(self.store, self.loop), self.path))
+        os.chmod(self.path, 0o660)
+        self.loop.call_later(SWEEP_SECONDS, self._sweep)
+        self.ready.set()
+        try:
+            self.loop.run_forever()
+        finally:
+            server.close()
+
+    def _sweep(self):
+        self.store.sweep_expired()
+        self.loop.call_later(SWEEP_SECONDS, self._sweep)
+
+
+def start_bus(path=BUS_SOCKET):
+    """Start the embedded bus and return its store, for the monitor to use as `r`.
+
+    Exports KNOCK_BUS_SOCKET (absolute) so honeypot subprocesses find the socket.
+    """
+    store = BusStore()
+    server = BusServer(store, path).start()
+    os.environ['KNOCK_BUS_SOCKET'] = server.path
+    print(f"🚌 Embedded bus listening on {server.path} (REDIS_MODE=embedded)", flush=True)
+    return store
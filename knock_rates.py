@@ -0,0 +1,130 @@
+"""
+Rolling knock-rate engine: 1m / 10m / 1h rates and peaks per protocol and per source.
+
+The monitor sees every knock, including ones ingested from feeders, so it owns the
+counters. Each scope (global, each protocol, each source) is a RateRing: one hour of
+per-second counts in a fixed array, a running sum per window, and a monotonic queue
+per window holding its peak 1-minute rate. Recording a knock and reading any rate are
+O(1), amortized over elapsed seconds. Memory is fixed per scope no matter how fast
+knocks arrive. A publisher thread writes KnockRates.snapshot() to RATES_KEY once a
+second; the web tier reads it for init_stats and /metrics.
+"""
+import json
+import threading
+import time
+from array import array
+from collections import deque
+
+RATES_KEY = 'knock:rates'
+RATE_WINDOWS = {'1m': 60, '10m': 600, '1h': 3600}   # label -> seconds
+RING_SECONDS = max(RATE_WINDOWS.values())
+
+
+class RateRing:
+    """Per-second counts for the last RING_SECONDS with O(1) windowed sums and peaks."""
+
+    def __init__(self, now=None, started=None):
+        now = int(now if now is not None else time.time())
+        # Rates average over at most the time since started. A scope that first
+        # knocks after the engine starts passes the engine's start: until then it
+        # was being watched, with nothing to count.
+        self.started = int(started) if started is not None else now
+        self.second = now
+        self.counts = array('I', bytes(4 * RING_SECONDS))
+        self.sums = {w: 0 for w in RATE_WINDOWS.values()}
+        # Per window: (second, 1m count at that second's close), values decreasing.
+        self.peaks = {w: deque() for w in RATE_WINDOWS.values()}
+
+    def _advance(self, now):
+        if now <= self.second:
+            return
+        if now - self.second > RING_SECONDS:   # idle past the whole ring: start clean
+            self._close_second(self.second)
+            self.counts = array('I', bytes(4 * RING_SECONDS))
+            self.sums = {w: 0 for w in self.sums}
+            self.second = now
+            self._expire_peaks(now)
+            return
+        while self.second < now:
+            self._close_second(self.second)
+            self.second += 1
+            s = self.second
+            for w in self.sums:   # drop the second that just left each window
+                slot = (s - w) % RING_SECONDS
+                self.sums[w] -= self.counts[slot]
+            self.counts[s % RING_SECONDS] = 0
+        self._expire_peaks(now)
+
+    def _close_second(self, second):
+        value = self.sums[60]
+        for w, peaks in self.peaks.items():
+            while peaks and peaks[-1][1] <= value:
+                peaks.pop()
+            peaks.append((second, value))
+
+    def _expire_peaks(self, now):
+        for w, peaks in self.peaks.items():
+            while peaks and peaks[0][0] <= now - w:
+                peaks.popleft()
+
+    def record(self, now=None, n=1):
+        now = int(now if now is not None else time.time())
+        self._advance(now)
+        if now < self.second:
+            return   # a straggler from a second already closed; its window has moved on
+        self.counts[now % RING_SECONDS] += n
+        for w in self.sums:
+            self.sums[w] += n
+
+    def rates(self, now=None):
+        """{'kpm_1m', 'kpm_10m', 'kpm_1h', 'peak_kpm_1m', ...} as knocks per minute."""
+        now = int(now if now is not None else time.time())
+        self._advance(now)
+        out = {}
+        current = self.sums[60]
+        for label, w in RATE_WINDOWS.items():
+            span = min(w, max(1, now - self.started + 1))
+            out[f"kpm_{label}"] = round(self.sums[w] * 60.0 / span, 1)
+            peaks = self.peaks[w]
+            out[f"peak_kpm_{label}"] = float(max(current, peaks[0][1] if peaks else 0))
+        return out
+
+
+class KnockRates:
+    """Thread-safe set of RateRings: the global scope, one per protocol, one per source."""
+
+    def __init__(self, now=None):
+        self._lock = threading.Lock()
+        self.all = RateRing(now)
+        self.protos = {}
+        self.sources = {}
+
+    def record(self, proto, source, now=None):
+        with self._lock:
+            self.all.record(now)
+            for rings, name in ((self.protos, proto), (self.sources, source)):
+                ring = rings.get(name)
+                if ring is None:   # build a ring (two 14 KB arrays) only for a new scope
+                    ring = rings[name] = RateRing(now, started=self.all.started)
+                ring.record(now)
+
+    def snapshot(self, now=None):
+        with self._lock:
+            return {
+                "t": int(now if now is not None else time.time()),
+                "global": self.all.rates(now),
+                "proto": {name: ring.rates(now) for name, ring in self.protos.items()},
+                "source": {name: ring.rates(now) for name, ring in self.sources.items()},
+            }
+
+
+def start_rate_publisher(redis_conn, rates, interval=1.0):
+    """Daemon thread writing rates.snapshot() to RATES_KEY every `interval` seconds."""
+    def _publish():
+        while True:
+            try:
+                redis_conn.set(RATES_KEY, json.dumps(rates.snapshot()), ex=30)
+            except Exception as e:
+                print(f"⚠️ Rate publish failed: {e}", flush=True)
+            time.sleep(interval)
+    threading.Thread(target=_publish, daemon=True).start()
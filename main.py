@@ -1,15 +1,27 @@
-import asyncio, json, logging, sqlite3, os, time, uvicorn
-from collections import deque
-from contextlib import asynccontextmanager
+import asyncio, base64, gzip, hashlib, heapq, ipaddress, json, logging, queue, random, sqlite3, os, socket, threading, time, uvicorn
+from contextlib import asynccontextmanager, contextmanager
 import redis.asyncio as redis
 import geoip2.database
 from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
-from fastapi.responses import HTMLResponse, Response
+from fastapi.responses import FileResponse, Response, StreamingResponse
 from fastapi import HTTPException
-from datetime import datetime
+from datetime import datetime, timezone
+from email.utils import formatdate
+from mimetypes import guess_type
 from fastapi.staticfiles import StaticFiles
-from constants import (PROTO, PROTO_NAME, PROTOCOL_META, DEFAULT_ENABLED_PROTOCOLS,
-                       sort_protocols_for_ui, require_schema_version)
+from starlette.datastructures import Headers
+from starlette.staticfiles import NotModifiedResponse
+from constants import (PROTO, PROTO_NAME, PROTOCOL_META, DEFAULT_ENABLED_PROTOCOLS, FEED_STREAM, SOURCES_VERSION_KEY,
+                       proto_feed_stream, sort_protocols_for_ui, require_schema_version)
+from visitor_log import VisitorLogger, init_visitors_db
+from intel_windows import WINDOWS, ALL_PROTOS, DIMENSIONS, window_table
+from knock_rates import RATES_KEY, RATE_WINDOWS
+from knock_bus import redis_url
+
+try:
+    import brotli
+except ImportError:  # optional: without it pages and static assets are offered gzip only
+    brotli = None
 
 def _flag(name):
     """True iff env var `name` is set to one of 1/true/yes/on (case-insensitive)."""
@@ -19,9 +31,17 @@ def _flag(name):
 async def lifespan(app: FastAPI):
     print("🚀 Knock-Knock Web Active...", flush=True)
     require_schema_version(DB_PATH)   # exit early if an existing DB needs updatedb.py
+    await asyncio.get_running_loop().run_in_executor(None, static_files.prepare)
+    asyncio.create_task(web_leader.run())
     asyncio.create_task(redis_listener())
     asyncio.create_task(stats_cache.update_and_broadcast())
+    if FEED_DISPLAY_BUDGET:
+        asyncio.create_task(feed_sampler_loop())
+    if visitor_logger:
+        visitor_logger.start()
     yield
+    if visitor_logger:
+        await visitor_logger.close()
 
 app = FastAPI(lifespan=lifespan)
 logger = logging.getLogger("uvicorn.error")
@@ -58,17 +78,20 @@ async def http_middleware(request: Request, call_next):
     # data feeds served from /static (StaticFiles serves them as text/plain, so they'd
     # otherwise dodge logging). Both land in visitors.db keyed by request.url.path, so the
     # feed grabs ('/static/ip-blocklist-*.txt') stay distinguishable from human page views.
+    # Revalidated page views come back as bodiless 304s, so those are matched by route.
     _path = request.url.path
     _is_feed = (response.status_code == 200
                 and _path.startswith('/static/ip-blocklist-') and _path.endswith('.txt'))
-    if LOG_VISITORS and (response.headers.get('content-type', '').startswith('text/html') or _is_feed):
+    _is_page = (response.headers.get('content-type', '').startswith('text/html')
+                or (response.status_code == 304 and _path in _HTML_ROUTES))
+    if LOG_VISITORS and (_is_page or _is_feed):
         ip = get_request_client_ip(request)
         if ip:
             referrer = request.headers.get('referer') or request.headers.get('referrer')
             if referrer and 'knock-knock' in referrer.lower():
                 referrer = None
-            asyncio.get_running_loop().run_in_executor(
-                None, log_visitor, ip,
+            visitor_logger.log(
+                ip,
                 request.headers.get('user-agent'),
                 referrer,
                 request.url.path,
@@ -81,83 +104,255 @@ async def http_middleware(request: Request, call_next):
 # --- Visitor Logging (opt-in via LOG_VISITORS=true) ---
 LOG_VISITORS = _flag('LOG_VISITORS')
 
+visitor_logger = None
 if LOG_VISITORS:
     VISITORS_DB_PATH = os.environ.get('DB_DIR', 'data') + '/visitors.db'
     GEOIP_CITY_PATH = '/usr/share/GeoIP/GeoLite2-City.mmdb'
     GEOIP_ASN_PATH = '/usr/share/GeoIP/GeoLite2-ASN.mmdb'
 
-    visitor_city_reader = geoip2.database.Reader(GEOIP_CITY_PATH) if os.path.exists(GEOIP_CITY_PATH) else None
-    visitor_asn_reader = geoip2.database.Reader(GEOIP_ASN_PATH) if os.path.exists(GEOIP_ASN_PATH) else None
+    init_visitors_db(VISITORS_DB_PATH)
+    visitor_logger = VisitorLogger(
+        VISITORS_DB_PATH,
+        city_reader=geoip2.database.Reader(GEOIP_CITY_PATH) if os.path.exists(GEOIP_CITY_PATH) else None,
+        asn_reader=geoip2.database.Reader(GEOIP_ASN_PATH) if os.path.exists(GEOIP_ASN_PATH) else None)
 
-    def init_visitors_db():
-        # Append-only raw request events. The legacy daily-rollup `visitors` table
-        # (deduped by ip/date/page) is left in place untouched — we just stop writing to it.
-        conn = sqlite3.connect(VISITORS_DB_PATH, timeout=10)
-        cur = conn.cursor()
-        cur.execute("PRAGMA journal_mode=WAL")
-        cur.fetchone()
-        cur.execute("""CREATE TABLE IF NOT EXISTS visitor_events (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            timestamp INTEGER NOT NULL,
-            ip TEXT NOT NULL,
-            page TEXT NOT NULL DEFAULT '/',
-            query_string TEXT,
-            method TEXT,
-            status_code INTEGER,
-            city TEXT,
-            region TEXT,
-            country TEXT,
-            iso_code TEXT,
-            isp TEXT,
-            asn INTEGER,
-            referrer TEXT,
-            user_agent TEXT
-        )""")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_ve_ip_ts ON visitor_events(ip, timestamp)")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_ve_page_ts ON visitor_events(page, timestamp)")
-        conn.commit()
-        conn.close()
-
-    def get_visitor_geo(ip):
-        geo = {"city": None, "region": None, "country": None, "iso": None, "isp": None, "asn": None}
-        try:
-            if visitor_city_reader:
-                c_res = visitor_city_reader.city(ip)
-                geo["iso"] = c_res.country.iso_code
-                geo["country"] = c_res.country.name
-                geo["city"] = c_res.city.name
-                if c_res.subdivisions.most_specific.name:
-                    geo["region"] = c_res.subdivisions.most_specific.name
-            if visitor_asn_reader:
-                a_res = visitor_asn_reader.asn(ip)
-                geo["isp"] = a_res.autonomous_system_organization
-                geo["asn"] = a_res.autonomous_system_number
-        except Exception:
-            pass
-        return geo
+# --- Precompressed responses ---
+# Text bodies at least this large get gzip (and, when the brotli module is present, br)
+# variants; below it the encoding overhead isn't worth a second representation.
+COMPRESS_MIN_BYTES = 1024
+_COMPRESSIBLE_SUFFIXES = ('.geojson', '.json', '.js', '.css', '.html', '.txt', '.svg', '.xml')
+_ENCODING_SUFFIX = {'br': '.br', 'gzip': '.gz'}
 
-    def log_visitor(ip, user_agent=None, referrer=None, page='/', query_string=None,
-                    method=None, status_code=None):
-        """Append one raw request event to visitor_events (no dedup)."""
-        try:
-            geo = get_visitor_geo(ip)
-            conn = sqlite3.connect(VISITORS_DB_PATH, timeout=10)
-            conn.execute("""
-                INSERT INTO visitor_events (timestamp, ip, page, query_string, method, status_code,
-                                            city, region, country, iso_code, isp, asn, referrer, user_agent)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (int(time.time()), ip, page, query_string, method, status_code,
-                  geo['city'], geo['region'], geo['country'], geo['iso'], geo['isp'], geo['asn'],
-                  referrer, user_agent))
-            conn.commit()
-            conn.close()
-        except Exception as e:
-            print(f"Visitor log error: {e}")
 
-    init_visitors_db()
+def _compress(body: bytes, encoding: str) -> bytes:
+    if encoding == 'br':
+        return brotli.compress(body, quality=11)
+    return gzip.compress(body, 9, mtime=0)   # mtime=0 keeps the output byte-stable
+
+
+def _available_encodings() -> tuple:
+    return ('br', 'gzip') if brotli else ('gzip',)
+
+
+def _accepted_encodings(header: str) -> set:
+    """Content codings an Accept-Encoding header allows (q=0 entries excluded)."""
+    accepted = set()
+    for part in header.split(','):
+        name, _, params = part.partition(';')
+        name = name.strip().lower()
+        if not name:
+            continue
+        q = params.strip().lower()
+        if q.startswith('q='):
+            try:
+                if float(q[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(name)
+    return accepted
+
+
+def _pick_encoding(header: str, available) -> str:
+    """Best of br > gzip the client accepts among `available`, else 'identity'."""
+    accepted = _accepted_encodings(header)
+    for encoding in ('br', 'gzip'):
+        if encoding in available and (encoding in accepted or '*' in accepted):
+            return encoding
+    return 'identity'
+
+
+def _etag(digest: str, encoding: str) -> str:
+    """Strong ETag per representation: the same content hash, suffixed by coding."""
+    return f'"{digest}"' if encoding == 'identity' else f'"{digest}-{encoding}"'
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    tags = [t.strip() for t in if_none_match.split(',')]
+    return '*' in tags or etag in (t[2:] if t.startswith('W/') else t for t in tags)
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    """StaticFiles that serves .br/.gz siblings and content-hash ETags.
+
+    prepare() writes the siblings next to large compressible assets (countries.geojson,
+    cities.geojson, the trivia JSON) and hashes every file once at startup. A sibling is
+    only used while it is at least as new as its source, so a file replaced in place (the
+    blocklist cron) is served uncompressed until the next prepare() rather than stale.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._digests = {}   # full_path -> ((mtime_ns, size), sha256 prefix)
+
+    def _digest(self, full_path, stat_result) -> str:
+        key = (stat_result.st_mtime_ns, stat_result.st_size)
+        cached = self._digests.get(full_path)
+        if cached and cached[0] == key:
+            return cached[1]
+        h = hashlib.sha256()
+        with open(full_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        digest = h.hexdigest()[:20]
+        self._digests[full_path] = (key, digest)
+        return digest
+
+    def prepare(self):
+        """Write missing/stale compressed siblings and prime the ETag cache. Idempotent,
+        so every worker can run it; writes go through a temp file + rename."""
+        written = 0
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith(('.gz', '.br', '.tmp')):
+                    continue
+                path = os.path.realpath(os.path.join(root, name))
+                try:
+                    st = os.stat(path)
+                    self._digest(path, st)
+                    if not name.endswith(_COMPRESSIBLE_SUFFIXES) or st.st_size < COMPRESS_MIN_BYTES:
+                        continue
+                    body = None
+                    for encoding in _available_encodings():
+                        sibling = path + _ENCODING_SUFFIX[encoding]
+                        try:
+                            if os.stat(sibling).st_mtime_ns >= st.st_mtime_ns:
+                                continue
+                        except FileNotFoundError:
+                            pass
+                        if body is None:
+                            with open(path, 'rb') as f:
+                                body = f.read()
+                        tmp = f"{sibling}.{os.getpid()}.tmp"
+                        with open(tmp, 'wb') as f:
+                            f.write(_compress(body, encoding))
+                        os.replace(tmp, sibling)
+                        written += 1
+                except OSError as e:
+                    print(f"⚠️ Static precompress skipped {name}: {e}", flush=True)
+        if written:
+            print(f"🗜️ Precompressed {written} static asset variant(s)", flush=True)
+
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        request_headers = Headers(scope=scope)
+        digest = self._digest(full_path, stat_result)
+        media_type = guess_type(str(full_path))[0] or "text/plain"
+        encoding, path, st = 'identity', full_path, stat_result
+        headers = {}
+        if str(full_path).endswith(_COMPRESSIBLE_SUFFIXES):
+            headers["vary"] = "Accept-Encoding"
+            accepted = _accepted_encodings(request_headers.get('accept-encoding', ''))
+            for candidate in ('br', 'gzip'):
+                if candidate not in accepted and '*' not in accepted:
+                    continue
+                try:
+                    sibling_st = os.stat(f"{full_path}{_ENCODING_SUFFIX[candidate]}")
+                except OSError:
+                    continue
+                if sibling_st.st_mtime_ns >= stat_result.st_mtime_ns:
+                    encoding, path, st = candidate, f"{full_path}{_ENCODING_SUFFIX[candidate]}", sibling_st
+                    headers["content-encoding"] = candidate
+                    break
+        headers["etag"] = _etag(digest, encoding)
+        headers["last-modified"] = formatdate(stat_result.st_mtime, usegmt=True)
+        response = FileResponse(path, status_code=status_code, headers=headers,
+                                media_type=media_type, stat_result=st)
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
+
 
 # This ensures /static/robot1.png is available immediately
-app.mount("/static", StaticFiles(directory="static"), name="static")
+static_files = PrecompressedStaticFiles(directory="static")
+app.mount("/static", static_files, name="static")
+
+
+class HashedAssetFiles(PrecompressedStaticFiles):
+    """Content-hashed files cached forever, plus one short-lived pointer file naming
+    the current hashes. A changed asset gets a new name, so caches never go stale."""
+
+    def __init__(self, directory, pointer, max_age, check_dir=True):
+        super().__init__(directory=directory, check_dir=check_dir)
+        self.pointer = pointer
+        self.max_age = max_age
+
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        response = super().file_response(full_path, stat_result, scope, status_code)
+        if os.path.basename(str(full_path)) == self.pointer:
+            response.headers["cache-control"] = f"public, max-age={self.max_age}"
+        else:
+            response.headers["cache-control"] = "public, max-age=31536000, immutable"
+        return response
+
+# --- Globe geometry (/geo) ---
+# Quantized TopoJSON countries + cities at several detail levels, built by
+# extras/generate-geometry into static/geo/world-<level>.<hash>.json. Pages read
+# manifest.json for the current names and pick a level by device class; static_files'
+# prepare() writes the .br/.gz siblings, since static/geo is under static/.
+GEO_MANIFEST_MAX_AGE = 300
+geo_assets = HashedAssetFiles(os.path.join("static", "geo"), pointer="manifest.json",
+                              max_age=GEO_MANIFEST_MAX_AGE, check_dir=False)
+app.mount("/geo", geo_assets, name="geo")
+
+# --- Stats snapshots (/stats) ---
+# On every refresh the stats leader writes the leaderboards + protocol breakdown as
+# /stats/<content hash>.json (immutable, cacheable forever at the CDN) with .br/.gz
+# siblings, and repoints /stats/latest.json ({"url", "stats_version", "generated_at"},
+# short max-age) at it. Pages paint the snapshot as soon as it arrives, connecting the
+# WebSocket in parallel; if the snapshot is in hand by then they pass ?stats=0, so the
+# socket's init_stats carries only the live counters.
+STATS_SNAPSHOT_DIR = os.environ.get('STATS_SNAPSHOT_DIR', os.path.join(os.environ.get('DB_DIR', 'data'), 'stats'))
+STATS_SNAPSHOT_MAX_AGE = int(os.environ.get('STATS_SNAPSHOT_MAX_AGE', '30'))
+STATS_SNAPSHOT_KEEP = 5   # hashed snapshots kept for pages still holding an older pointer
+# init_stats keys a snapshot replaces (stats_version too: deltas must chain from the
+# snapshot's version, else the client resyncs).
+SNAPSHOT_STATS_KEYS = ('top_locations', 'top_passwords', 'top_providers', 'top_users', 'top_ips',
+                       'proto_stats', 'stats_version')
+
+def _write_atomic(path, data):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+class StatsSnapshotFiles(HashedAssetFiles):
+    def __init__(self, directory):
+        super().__init__(directory, pointer="latest.json", max_age=STATS_SNAPSHOT_MAX_AGE, check_dir=False)
+
+    def write(self, snapshot, version):
+        """Leader only (from the executor): write one snapshot and repoint latest.json.
+        Identity bodies go first so the compressed siblings are never older than them."""
+        body = json.dumps(snapshot, separators=(",", ":"), sort_keys=True).encode()
+        digest = hashlib.sha256(body).hexdigest()[:20]
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"{digest}.json")
+        if not os.path.exists(path):
+            _write_atomic(path, body)
+            for encoding in _available_encodings():
+                _write_atomic(path + _ENCODING_SUFFIX[encoding], _compress(body, encoding))
+        else:   # unchanged content: mark it newest so _prune keeps it (siblings after it)
+            for suffix in ('', *(_ENCODING_SUFFIX[e] for e in _available_encodings())):
+                os.utime(path + suffix)
+        pointer = {"url": f"/stats/{digest}.json", "stats_version": version,
+                   "generated_at": snapshot.get("cache_ts")}
+        _write_atomic(os.path.join(self.directory, self.pointer), json.dumps(pointer).encode())
+        self._prune()
+        return digest
+
+    def _prune(self):
+        names = [n for n in os.listdir(self.directory) if n.endswith('.json') and n != self.pointer]
+        if len(names) <= STATS_SNAPSHOT_KEEP:
+            return
+        names.sort(key=lambda n: os.stat(os.path.join(self.directory, n)).st_mtime_ns, reverse=True)
+        for name in names[STATS_SNAPSHOT_KEEP:]:
+            for suffix in ('', *_ENCODING_SUFFIX.values()):
+                try:
+                    os.remove(os.path.join(self.directory, name + suffix))
+                except FileNotFoundError:
+                    pass
+
+stats_snapshots = StatsSnapshotFiles(STATS_SNAPSHOT_DIR)
+app.mount("/stats", stats_snapshots, name="stats")
 
 # Optional blog: serve static HTML posts from BLOG_DIR (typically a directory outside
 # the repo, so content deploys independently of the code). html=True lets /blog/<slug>/
@@ -166,47 +361,164 @@ _blog_dir = os.environ.get('BLOG_DIR')
 if _blog_dir and os.path.isdir(_blog_dir):
     app.mount("/blog", StaticFiles(directory=_blog_dir, html=True), name="blog")
 
-r = redis.from_url(f"redis://{os.environ.get('REDIS_HOST', 'localhost')}/{os.environ.get('REDIS_DB', '0')}", decode_responses=True, socket_timeout=None)
+r = redis.from_url(redis_url(os.environ.get('REDIS_DB', '0')), decode_responses=True, socket_timeout=None)
 DB_PATH    = os.environ.get('DB_DIR', 'data') + '/knock_knock.db'
 FEED_SIZE  = int(os.environ.get('FEED_SIZE',  '100'))
 INTEL_SIZE = int(os.environ.get('INTEL_SIZE', '100'))
-ROLLING_KPM_SECONDS = 600
+# Leaderboards are maintained live from knocks_stream; this is how often they are
+# re-seeded from the intel tables to correct drift (missed messages, batched writes).
+STATS_RECONCILE_SECONDS = int(os.environ.get('STATS_RECONCILE_SECONDS', '600'))
+# Live-feed display budget in knocks per second per client (0 = forward every knock).
+# Above it, the server forwards a per-protocol sample and a feed_summary of the rest.
+FEED_DISPLAY_BUDGET = int(os.environ.get('FEED_DISPLAY_BUDGET', '0'))
+
+# --- Read-only SQLite access ---
+# The web tier never writes the knock DB. Its reads (leaderboard seeds, windowed boards,
+# source metadata) share a few long-lived `mode=ro` connections per worker instead of
+# opening one per query: each keeps its prepared statements, page cache and mmap warm.
+READ_POOL_SIZE = int(os.environ.get('READ_POOL_SIZE', '2'))
+READ_MMAP_BYTES = 256 * 1024 * 1024
+READ_CACHE_KIB = 16 * 1024
+SOURCES_CACHE_SECONDS = 60   # also reloaded at once when the monitor registers a source
+
+class ReadPool:
+    def __init__(self, db_path, size=READ_POOL_SIZE):
+        self.db_path = db_path
+        self.size = max(1, size)
+        self._idle = queue.LifoQueue()
+        self._open = 0
+        self._lock = threading.Lock()
+        self.opened = 0   # connections ever opened, for diagnostics and tests
+
+    def _connect(self):
+        conn = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True, timeout=10,
+                               check_same_thread=False, cached_statements=256)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA query_only=ON")
+        conn.execute(f"PRAGMA mmap_size={READ_MMAP_BYTES}")
+        conn.execute(f"PRAGMA cache_size=-{READ_CACHE_KIB}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        self.opened += 1
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection (blocking while all `size` are busy). One that raises a
+        sqlite3 error is closed rather than returned, so the next borrow reconnects."""
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                fresh = self._open < self.size
+                if fresh:
+                    self._open += 1
+            if fresh:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._lock:
+                        self._open -= 1
+                    raise
+            else:
+                conn = self._idle.get()
+        broken = False
+        try:
+            yield conn
+        except sqlite3.Error:
+            broken = True
+            raise
+        finally:
+            if broken:
+                conn.close()
+                with self._lock:
+                    self._open -= 1
+            else:
+                self._idle.put(conn)
+
+read_pool = ReadPool(DB_PATH)
+
+class SourcesCache:
+    """Active rows of the `sources` table, read once per SOURCES_CACHE_SECONDS or when
+    SOURCES_VERSION_KEY moves, so client connects never touch SQLite."""
 
-class RollingKpmTracker:
     def __init__(self):
-        self.started_at = time.time()
-        self.knock_times = deque()
+        self.meta = {}
+        self.version = None
+        self.loaded_at = None
+
+    def _load(self):
+        with read_pool.connection() as conn:
+            rows = conn.execute("SELECT source_id, display_name, first_seen, last_seen FROM sources WHERE active=1").fetchall()
+        return {row[0]: {"display_name": row[1] or row[0], "first_seen": row[2], "last_seen": row[3]} for row in rows}
+
+    async def get(self):
+        try:
+            version = await r.get(SOURCES_VERSION_KEY)
+        except Exception:
+            version = self.version
+        fresh = self.loaded_at is not None and time.monotonic() - self.loaded_at < SOURCES_CACHE_SECONDS
+        if fresh and version == self.version:
+            return self.meta
+        try:
+            self.meta = await asyncio.get_running_loop().run_in_executor(None, self._load)
+            self.version = version
+        except Exception:
+            pass   # keep serving the last copy (or none) and retry on the next call
+        self.loaded_at = time.monotonic()
+        return self.meta
+
+sources_cache = SourcesCache()
+
+async def load_rates():
+    """The monitor's latest rate snapshot (see knock_rates.py), or None while it isn't
+    publishing. Every worker reads the same key, so they all report the same rates."""
+    try:
+        raw = await r.get(RATES_KEY)
+        return json.loads(raw) if raw else None
+    except Exception:
+        return None
 
-    def _prune(self, now):
-        cutoff = now - ROLLING_KPM_SECONDS
-        while self.knock_times and self.knock_times[0] < cutoff:
-            self.knock_times.popleft()
+# --- Stats leader (one per host, elected via a Redis lock) ---
+# Every uvicorn worker fans knocks out to its own WebSocket clients, but only the leader
+# reads SQLite and builds the periodic stats frame. It publishes the result on
+# STATS_CHANNEL (and keeps the latest copy in STATS_KEY); followers adopt it.
+LEADER_KEY    = "knock:web:leader"
+STATS_KEY     = "knock:web:stats"
+STATS_CHANNEL = "knock:web:stats"
+LEADER_TTL_SECONDS = 30
+LEADER_RENEW_SECONDS = 5
 
-    def record(self):
-        now = time.time()
-        self.knock_times.append(now)
-        self._prune(now)
+class WebLeader:
+    def __init__(self):
+        self.token = f"{socket.gethostname()}:{os.getpid()}"
+        self.is_leader = False
+        self.promoted = asyncio.Event()  # set when this worker wins the lock
+        self._lock = None
 
-    def kpm(self):
-        now = time.time()
-        self._prune(now)
-        window_seconds = min(ROLLING_KPM_SECONDS, max(1.0, now - self.started_at))
-        return round(len(self.knock_times) / (window_seconds / 60.0), 1)
+    async def run(self):
+        self._lock = r.lock(LEADER_KEY, timeout=LEADER_TTL_SECONDS, thread_local=False)
+        while True:
+            try:
+                if self.is_leader:
+                    await self._lock.reacquire()
+                elif await self._lock.acquire(blocking=False, token=self.token):
+                    self.is_leader = True
+                    self.promoted.set()
+                    print(f"👑 Stats leader: {self.token}", flush=True)
+            except Exception as e:
+                if self.is_leader:
+                    print(f"⚠️ Stats leadership lost: {e}", flush=True)
+                self.is_leader = False
+            await asyncio.sleep(LEADER_RENEW_SECONDS)
 
-rolling_kpm_tracker = RollingKpmTracker()
+web_leader = WebLeader()
 
-def _build_source_counts(raw):
-    """Merge Redis source_counts hash with display names from sources table.
+def _build_source_counts(raw, meta):
+    """Merge Redis source_counts hash with display names from the sources table
+    (`meta`, as cached by SourcesCache).
     Returns list of {source_id, display_name, hits} sorted by hits desc."""
     if not raw:
         return []
-    try:
-        conn = sqlite3.connect(DB_PATH, timeout=5)
-        rows = conn.execute("SELECT source_id, display_name, first_seen, last_seen FROM sources WHERE active=1").fetchall()
-        conn.close()
-        meta = {row[0]: {"display_name": row[1] or row[0], "first_seen": row[2], "last_seen": row[3]} for row in rows}
-    except Exception:
-        meta = {}
     result = []
     for src_id, count in raw.items():
         m = meta.get(src_id, {})
@@ -264,60 +576,277 @@ async def load_protocol_runtime_config():
         protocol_meta = default_protocol_meta
     return enabled_protocols, protocol_meta
 
+_STATS_LISTS = ("top_locations", "top_passwords", "top_providers", "top_users", "top_ips")
+
+def _diff_ranked(old, new):
+    """Positional diff of one ranked leaderboard: {"len": n, "set": [[rank, entry], ...]}.
+
+    Only ranks whose entry changed are sent; the client truncates to `len` and
+    overwrites the listed ranks. Returns None when the list is unchanged."""
+    changes = [[i, entry] for i, entry in enumerate(new) if i >= len(old) or old[i] != entry]
+    if not changes and len(old) == len(new):
+        return None
+    return {"len": len(new), "set": changes}
+
+def build_stats_delta(old, new):
+    """Diff two get_initial_data(include_history=False) payloads into a stats_delta body.
+
+    Returns None when the shape changed (e.g. a protocol was enabled or disabled) and
+    only a full init_stats frame can describe the new state."""
+    if set(old.get("proto_stats", {})) != set(new.get("proto_stats", {})):
+        return None
+    delta = {}
+    for key, value in new.items():
+        if key in _STATS_LISTS:
+            diff = _diff_ranked(old.get(key) or [], value)
+            if diff:
+                delta.setdefault("lists", {})[key] = diff
+        elif key == "proto_stats":
+            for proto, lists in value.items():
+                for list_key, entries in lists.items():
+                    diff = _diff_ranked(old["proto_stats"][proto].get(list_key) or [], entries)
+                    if diff:
+                        delta.setdefault("proto_stats", {}).setdefault(proto, {})[list_key] = diff
+        elif key == "proto_breakdown":
+            old_breakdown = old.get(key) or {}
+            changed = {name: entry for name, entry in value.items() if old_breakdown.get(name) != entry}
+            if changed:
+                delta["proto_breakdown"] = changed
+        elif old.get(key) != value:
+            delta.setdefault("set", {})[key] = value
+    return delta
+
+# stat type -> (knock field, global *_hits key, per-protocol *_hits key). The monitor
+# stamps every published knock with the post-increment intel counts for its values.
+_KNOCK_STAT_FIELDS = {
+    "location": ("iso",  "country_hits", "country_hits_proto"),
+    "password": ("pass", "pass_hits",    "pass_hits_proto"),
+    "username": ("user", "user_hits",    "user_hits_proto"),
+    "isp":      ("isp",  "isp_hits",     "isp_hits_proto"),
+    "ip":       ("ip",   "ip_hits",      "ip_hits_proto"),
+}
+_STAT_LIST_KEYS = {"location": "top_locations", "password": "top_passwords", "isp": "top_providers",
+                   "username": "top_users", "ip": "top_ips"}
+
+class Leaderboard:
+    """Top-K rows for one (stat type, proto), kept live from per-knock hit counts.
+
+    Knocks carry absolute counts, so a value outside the board joins as soon as its
+    count beats the board's floor — no DB scan needed. Entries are replaced, never
+    mutated, so rows handed out earlier (e.g. the last broadcast) stay intact.
+    `capacity=None` keeps every entry (countries)."""
+    def __init__(self, rows, key_field, capacity=None, defaults=None):
+        self.key_field = key_field
+        self.capacity = capacity
+        self.defaults = defaults or {}
+        self.entries = {row[key_field]: row for row in rows}
+        self._sorted = None
+
+    def rows(self):
+        if self._sorted is None:
+            self._sorted = sorted(self.entries.values(), key=lambda e: e["count"], reverse=True)
+        return self._sorted
+
+    def update(self, key, count, **fields):
+        entry = self.entries.get(key)
+        if entry is not None:
+            if count <= entry["count"]:
+                return False
+            self.entries[key] = {**entry, **fields, "count": count}
+        else:
+            if self.capacity and len(self.entries) >= self.capacity:
+                floor = self.rows()[-1]
+                if count <= floor["count"]:
+                    return False
+                del self.entries[floor[self.key_field]]
+            self.entries[key] = {self.key_field: key, **self.defaults, **fields, "count": count}
+        self._sorted = None
+        return True
+
+def _new_board(stat_type, rows):
+    return Leaderboard(
+        [dict(row) for row in rows],
+        key_field="iso" if stat_type == "location" else "label",
+        capacity=None if stat_type == "location" else INTEL_SIZE,
+        defaults={"banned": False} if stat_type == "ip" else None,
+    )
+
 class GlobalStatsCache:
     def __init__(self):
-        self.top_locations = []
-        self.top_passwords = []
-        self.top_providers = []
-        self.top_users = []
-        self.top_ips = []
-        self.proto_stats = {}  # keyed by proto int: {0: {top_locations, ...}, ...}
+        self.boards = {}  # (stat type, proto int or None for ALL) -> Leaderboard
+        self.enabled_protos = []
         self.last_updated = None
+        self._replay = None  # knocks seen while a reconcile is reading SQLite
+        # Periodic broadcasts are stats_delta frames against the previous broadcast;
+        # `version` lets a client spot a gap and ask for a full resync (get_stats).
+        self.version = 0
+        self.broadcast_payload = None
+        # today (UTC)/7d/30d boards, refreshed by the leader from the pre-merged window tables on
+        # each publish and shipped to followers with it: {window: {top_*, proto_stats}}.
+        self.windows = {}
+
+    def _rows(self, stat_type, proto=None):
+        board = self.boards.get((stat_type, proto))
+        return board.rows() if board else []
+
+    @property
+    def top_locations(self):
+        return self._rows("location")
 
-    async def _refresh_cache(self):
-        loop = asyncio.get_running_loop()
-        # ALL leaderboards (existing tables, index-driven)
-        self.top_locations = await loop.run_in_executor(None, self._get_top_stats, "location", None)
-        self.top_passwords = await loop.run_in_executor(None, self._get_top_stats, "password", None)
-        self.top_providers = await loop.run_in_executor(None, self._get_top_stats, "isp", None)
-        self.top_users = await loop.run_in_executor(None, self._get_top_stats, "username", None)
-        self.top_ips = await loop.run_in_executor(None, self._get_top_stats, "ip", None)
-        # Per-protocol leaderboards — only query enabled protocols
+    @property
+    def top_passwords(self):
+        return self._rows("password")
+
+    @property
+    def top_providers(self):
+        return self._rows("isp")
+
+    @property
+    def top_users(self):
+        return self._rows("username")
+
+    @property
+    def top_ips(self):
+        return self._rows("ip")
+
+    @property
+    def proto_stats(self):
+        """Per-protocol leaderboards keyed by proto int: {0: {top_locations, ...}, ...}"""
+        return {proto: {list_key: self._rows(stat_type, proto) for stat_type, list_key in _STAT_LIST_KEYS.items()}
+                for proto in self.enabled_protos}
+
+    def record(self, knock):
+        """Fold one knocks_stream message into the live boards."""
+        if self._replay is not None:
+            self._replay.append(knock)
+        proto = PROTO.get(str(knock.get("proto") or "").upper())
+        for stat_type, (field, hits_key, proto_hits_key) in _KNOCK_STAT_FIELDS.items():
+            value = knock.get(field)
+            if value is None:
+                continue
+            fields = {"country": knock.get("country")} if stat_type == "location" else {}
+            targets = [(None, knock.get(hits_key))]
+            if proto is not None:
+                targets.append((proto, knock.get(proto_hits_key)))
+            for board_proto, count in targets:
+                board = self.boards.get((stat_type, board_proto))
+                if board is not None and count:
+                    board.update(value, int(count), **fields)
+
+    async def _reconcile(self):
+        """Re-seed every board from the intel tables, correcting any drift."""
         enabled_protocols, _ = await load_protocol_runtime_config()
-        self.proto_stats = {}
-        for name in enabled_protocols:
-            proto_int = PROTO[name]
-            self.proto_stats[proto_int] = {
-                "top_locations": await loop.run_in_executor(None, self._get_top_stats, "location", proto_int),
-                "top_passwords": await loop.run_in_executor(None, self._get_top_stats, "password", proto_int),
-                "top_providers": await loop.run_in_executor(None, self._get_top_stats, "isp", proto_int),
-                "top_users":     await loop.run_in_executor(None, self._get_top_stats, "username", proto_int),
-                "top_ips":       await loop.run_in_executor(None, self._get_top_stats, "ip", proto_int),
-            }
+        protos = [PROTO[name] for name in enabled_protocols]
+        self._replay = []
+        try:
+            boards = await asyncio.get_running_loop().run_in_executor(None, self._load_boards, protos)
+            replay = self._replay
+        finally:
+            self._replay = None
+        self.boards = boards
+        self.enabled_protos = protos
+        # Counts are absolute, so replaying knocks the SQLite read may have missed is idempotent.
+        for knock in replay:
+            self.record(knock)
         self.last_updated = datetime.now().strftime("%H:%M:%S")
 
     async def update_and_broadcast(self):
-        # Prime the cache immediately so first visitors get full data
+        # Followers start from the leader's last published snapshot so first visitors
+        # get full data; the leader primes itself from SQLite as soon as it is elected.
         try:
-            await self._refresh_cache()
-            print(f"📊 Stats Cache Primed: {self.last_updated}")
+            await self.load_published()
         except Exception as e:
             print(f"❌ Cache Prime Error: {e}")
+        last_reconcile = None
 
         while True:
-            await asyncio.sleep(60)
+            web_leader.promoted.clear()
+            if web_leader.is_leader:
+                try:
+                    if last_reconcile is None or time.monotonic() - last_reconcile >= STATS_RECONCILE_SECONDS:
+                        primed = last_reconcile is None
+                        last_reconcile = time.monotonic()
+                        await self._reconcile()
+                        if primed:
+                            print(f"📊 Stats Cache Primed: {self.last_updated}")
+                    await self._publish()
+                except Exception as e:
+                    print(f"❌ Cache Update Error: {e}")
+            else:
+                last_reconcile = None  # re-seed from SQLite on (re)gaining leadership
             try:
-                await self._refresh_cache()
+                await asyncio.wait_for(web_leader.promoted.wait(), timeout=60)
+            except asyncio.TimeoutError:
+                pass
 
-                payload = await manager.get_initial_data(include_protocol_config=False, include_history=False)
-                await manager.broadcast(json.dumps({"type": "init_stats", "data": payload}))
-            except Exception as e:
-                print(f"❌ Cache Update Error: {e}")
+    async def _publish(self):
+        """Leader only: build the next stats frame and hand it to every worker via Redis."""
+        payload = await manager.get_initial_data(include_protocol_config=False, include_history=False)
+        try:
+            self.windows = await asyncio.get_running_loop().run_in_executor(
+                None, self._load_windows, list(self.enabled_protos))
+        except Exception as e:
+            print(f"❌ Window leaderboard error: {e}")
+        delta = build_stats_delta(self.broadcast_payload, payload) if self.broadcast_payload else None
+        self.version += 1
+        self.broadcast_payload = payload
+        if delta is None:
+            frame = {"type": "init_stats", "data": {**payload, "stats_version": self.version}}
+        else:
+            frame = {"type": "stats_delta", "version": self.version,
+                     "base": self.version - 1, "data": delta}
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                None, stats_snapshots.write, {**payload, "stats_version": self.version}, self.version)
+        except Exception as e:
+            print(f"❌ Stats snapshot error: {e}")
+        message = json.dumps({"leader": web_leader.token, "version": self.version,
+                              "payload": payload, "windows": self.windows,
+                              "frame": json.dumps(frame)})
+        await r.set(STATS_KEY, message)
+        await r.publish(STATS_CHANNEL, message)
 
-    def _get_top_stats(self, stat_type, proto=None):
-        """Synchronous helper for the executor - uses indexed intel tables."""
-        conn = sqlite3.connect(DB_PATH, timeout=10)
-        conn.row_factory = sqlite3.Row
+    def _adopt(self, published):
+        """Follower side: replace local boards with the leader's snapshot."""
+        payload = published["payload"]
+        boards = {}
+        for stat_type, list_key in _STAT_LIST_KEYS.items():
+            boards[(stat_type, None)] = _new_board(stat_type, payload.get(list_key) or [])
+        protos = [int(p) for p in payload.get("proto_stats", {})]
+        for proto in protos:
+            lists = payload["proto_stats"][str(proto)]
+            for stat_type, list_key in _STAT_LIST_KEYS.items():
+                boards[(stat_type, proto)] = _new_board(stat_type, lists.get(list_key) or [])
+        self.boards = boards
+        self.enabled_protos = protos
+        self.version = published["version"]
+        self.broadcast_payload = payload
+        self.last_updated = payload.get("cache_ts")
+        self.windows = published.get("windows") or {}
+
+    async def load_published(self):
+        raw = await r.get(STATS_KEY)
+        if raw and not web_leader.is_leader:
+            self._adopt(json.loads(raw))
+
+    async def on_published(self, raw):
+        """A leader stats message arrived on STATS_CHANNEL: adopt it and fan out its frame."""
+        published = json.loads(raw)
+        if published.get("leader") != web_leader.token:
+            self._adopt(published)
+        await manager.broadcast(published["frame"])
+
+    def _load_boards(self, protos):
+        """Synchronous helper for the executor - seeds every board over one connection."""
+        with read_pool.connection() as conn:
+            boards = {}
+            for proto in [None, *protos]:
+                for stat_type in _KNOCK_STAT_FIELDS:
+                    boards[(stat_type, proto)] = _new_board(stat_type, self._get_top_stats(conn, stat_type, proto))
+        return boards
+
+    def _get_top_stats(self, conn, stat_type, proto=None):
+        """Top-N rows for one board - uses indexed intel tables."""
         cur = conn.cursor()
         lim = INTEL_SIZE
         if proto is None:
@@ -339,7 +868,46 @@ class GlobalStatsCache:
             }
             cur.execute(queries[stat_type], (proto,))
         rows = cur.fetchall()
-        conn.close()
+        now = int(time.time())
+        result = [dict(row) for row in rows]
+        if stat_type == "ip":
+            for row in result:
+                bu = row.pop("ban_until", None)
+                row["banned"] = bu is not None and (bu == 0 or bu > now)
+        return result
+
+    def _load_windows(self, protos):
+        """Synchronous helper for the executor - every windowed board over one connection."""
+        with read_pool.connection() as conn:
+            windows = {}
+            for win in WINDOWS:
+                lists = {list_key: self._get_window_top(conn, stat_type, win)
+                         for stat_type, list_key in _STAT_LIST_KEYS.items()}
+                lists["proto_stats"] = {
+                    str(proto): {list_key: self._get_window_top(conn, stat_type, win, proto)
+                                 for stat_type, list_key in _STAT_LIST_KEYS.items()}
+                    for proto in protos}
+                windows[win] = lists
+        return windows
+
+    def _get_window_top(self, conn, stat_type, win, proto=None):
+        """Top-N rows for one windowed board - one indexed read of the pre-merged table."""
+        table, key = window_table(stat_type), DIMENSIONS[stat_type][1]
+        args = (win, ALL_PROTOS if proto is None else proto)
+        try:
+            if stat_type == "location":
+                rows = conn.execute(f"""SELECT w.iso_code as iso, c.country, w.hits as count FROM {table} w
+                    LEFT JOIN country_intel c ON c.iso_code = w.iso_code
+                    WHERE w.win=? AND w.proto=? ORDER BY w.hits DESC""", args).fetchall()
+            elif stat_type == "ip":
+                rows = conn.execute(f"""SELECT w.ip as label, w.hits as count, i.ban_until FROM {table} w
+                    LEFT JOIN ip_intel i ON i.ip = w.ip
+                    WHERE w.win=? AND w.proto=? ORDER BY w.hits DESC LIMIT {INTEL_SIZE}""", args).fetchall()
+            else:
+                rows = conn.execute(f"SELECT {key} as label, hits as count FROM {table} "
+                                    f"WHERE win=? AND proto=? ORDER BY hits DESC LIMIT {INTEL_SIZE}", args).fetchall()
+        except sqlite3.OperationalError:
+            return []  # window tables not created yet (monitor not restarted since upgrade)
         now = int(time.time())
         result = [dict(row) for row in rows]
         if stat_type == "ip":
@@ -351,6 +919,92 @@ class GlobalStatsCache:
 # Initialize the global cache
 stats_cache = GlobalStatsCache()
 
+def _history_page(items, before=None, limit=None):
+    """Slice a newest-first knock list for a `get_history` reply.
+
+    `before` is a knock timestamp cursor: only knocks with t < before are returned.
+    Knocks sharing the page's last timestamp are kept together so the next cursor
+    (the last knock's t) never splits a second across pages.
+    Returns (page, next_before) — next_before is None when nothing older remains."""
+    limit = max(1, min(int(limit or FEED_SIZE), FEED_SIZE))
+    if before is not None:
+        items = [k for k in items if int(k.get("t") or 0) < before]
+    page = items[:limit]
+    rest = items[limit:]
+    if page:
+        last_t = page[-1].get("t")
+        while rest and rest[0].get("t") == last_t:
+            page.append(rest.pop(0))
+    next_before = int(page[-1].get("t") or 0) if page and rest else None
+    return page, next_before
+
+
+def _sid_key(sid):
+    """Sortable form of a Redis stream ID ('1718000000000-3'), or None if malformed."""
+    ms, _, seq = str(sid or "").partition("-")
+    if not ms.isdigit() or (seq and not seq.isdigit()):
+        return None
+    return int(ms), int(seq or 0)
+
+
+def _feed_knock(sid, fields):
+    """Decode one FEED_STREAM entry; the stream ID rides along as `sid`."""
+    knock = json.loads(fields["knock"])
+    knock["sid"] = sid
+    return knock
+
+
+class ProtoHistoryCache:
+    """Per-protocol recent-knock lists, seeded from the per-protocol feed streams.
+
+    The monitor keeps a short stream per protocol (capped at FEED_SIZE) next to the
+    shared one, so even a rarely-hit protocol opens with a full tab. The first
+    `get_history` in this worker reads each of them once; redis_listener keeps the
+    lists current from then on, so repeat requests never touch Redis."""
+
+    def __init__(self):
+        self.histories = None  # proto name (lower) -> newest-first list; None until seeded
+        self._pending = None   # knocks that arrived while the seed reads were running
+        self._lock = asyncio.Lock()
+
+    async def get(self, proto):
+        if self.histories is None:
+            async with self._lock:
+                if self.histories is None:
+                    await self._seed()
+        return self.histories.get(proto.lower(), [])
+
+    async def _seed(self):
+        self._pending = []
+        histories = {}
+        try:
+            for name in PROTO:
+                entries = await r.xrevrange(proto_feed_stream(name), count=FEED_SIZE)
+                if entries:
+                    histories[name.lower()] = [_feed_knock(sid, fields) for sid, fields in entries]
+        except Exception as e:
+            print(f"Error seeding protocol histories: {e}")
+        pending, self._pending = self._pending, None
+        self.histories = histories
+        for knock in pending:
+            self.record(knock)
+
+    def record(self, knock):
+        if self._pending is not None:
+            self._pending.append(knock)
+            return
+        if self.histories is None:
+            return  # not seeded yet; the stream already holds this knock
+        items = self.histories.setdefault(str(knock.get("proto") or "").lower(), [])
+        head = _sid_key(items[0].get("sid")) if items else None
+        sid = _sid_key(knock.get("sid"))
+        if head and sid and sid <= head:
+            return  # the seed read already picked this knock up
+        items.insert(0, knock)
+        del items[FEED_SIZE:]
+
+proto_history_cache = ProtoHistoryCache()
+
 class ConnectionManager:
     def __init__(self):
         self.active_connections: list[WebSocket] = []
@@ -367,21 +1021,39 @@ class ConnectionManager:
         except Exception:
             return 0.0
 
-    async def get_recent_knocks(self, key="knock:recent", limit=100):
+    async def get_recent_knocks(self, limit=FEED_SIZE):
         try:
-            raw = await r.lrange(key, 0, limit - 1)
-            return [json.loads(item) for item in raw]
+            entries = await r.xrevrange(FEED_STREAM, count=limit)
+            return [_feed_knock(sid, fields) for sid, fields in entries]
         except Exception as e:
-            print(f"Error fetching history ({key}): {e}")
+            print(f"Error fetching history: {e}")
             return []
 
-    async def get_initial_data(self, include_protocol_config=True, include_history=True):
+    async def get_feed_gap(self, since):
+        """Knocks newer than stream ID `since`, newest first — or None when the gap can't
+        be served whole (trimmed out of the stream, or longer than one feed)."""
+        since_key = _sid_key(since)
+        if since_key is None:
+            return None
+        try:
+            entries = await r.xrevrange(FEED_STREAM, max="+", min=f"({since}", count=FEED_SIZE + 1)
+            oldest = await r.xrange(FEED_STREAM, count=1)
+            if len(entries) > FEED_SIZE or not oldest or _sid_key(oldest[0][0]) > since_key:
+                return None
+            return [_feed_knock(sid, fields) for sid, fields in entries]
+        except Exception as e:
+            print(f"Error fetching feed gap: {e}")
+            return None
+
+    async def get_initial_data(self, include_protocol_config=True, include_history=True, since=None,
+                               include_stats=True):
         total_val = await r.get("knock:total_global")
         uptime_val = await r.get("knock:uptime_minutes")
         last_knock_val = await r.get("knock:last_time")
         last_lat_val = await r.get("knock:last_lat")
         last_lng_val = await r.get("knock:last_lng")
         current_kpm = await self.get_kpm()
+        rates = await load_rates()
         proto_counts_raw = await r.hgetall("knock:proto_counts")
         is_aggregator = bool(await r.get("knock:is_aggregator"))
         enabled_protocols = []
@@ -398,36 +1070,44 @@ class ConnectionManager:
             proto_breakdown[name] = {"count": count, "pct": pct, "uptime": proto_uptime}
 
         payload = {
-            "top_locations": stats_cache.top_locations,
             "total": int(total_val) if total_val else 0,
             "uptime_minutes": int(uptime_val) if uptime_val else 0,
             "kpm": current_kpm,
-            "rolling_kpm": rolling_kpm_tracker.kpm(),
+            "rolling_kpm": rates["global"]["kpm_10m"] if rates else 0.0,
+            "rates": rates,
             "last_knock_time": int(last_knock_val) if last_knock_val else None,
             "last_lat": float(last_lat_val) if last_lat_val else None,
             "last_lng": float(last_lng_val) if last_lng_val else None,
-            "top_passwords": stats_cache.top_passwords,
-            "top_providers": stats_cache.top_providers,
-            "top_users": stats_cache.top_users,
-            "top_ips": stats_cache.top_ips,
-            "proto_stats": {str(k): v for k, v in stats_cache.proto_stats.items()},
             "proto_breakdown": proto_breakdown,
             "cache_ts": stats_cache.last_updated,
             "is_aggregator": is_aggregator,
-            "source_counts": _build_source_counts(await r.hgetall("knock:source_counts")) if is_aggregator else [],
+            "source_counts": _build_source_counts(await r.hgetall("knock:source_counts"), await sources_cache.get()) if is_aggregator else [],
         }
+        if include_stats:   # left out when the page already has them from a /stats snapshot
+            payload.update({
+                "top_locations": stats_cache.top_locations,
+                "top_passwords": stats_cache.top_passwords,
+                "top_providers": stats_cache.top_providers,
+                "top_users": stats_cache.top_users,
+                "top_ips": stats_cache.top_ips,
+                "proto_stats": {str(k): v for k, v in stats_cache.proto_stats.items()},
+            })
 
         if include_history:
-            history = await self.get_recent_knocks("knock:recent")
-            proto_histories = {}
+            # Only the combined feed ships on connect; a protocol's own history is fetched
+            # on demand with a `get_history` message when its tab is opened. A reconnecting
+            # client passes its last stream ID and gets just the knocks it missed.
+            history = await self.get_feed_gap(since) if since else None
+            if history is not None:
+                payload["history_since"] = since
+            else:
+                history = await self.get_recent_knocks()
             proto_last_times = {}
             for name in PROTO_NAME.values():
-                proto_histories[name.lower()] = await self.get_recent_knocks(f"knock:recent:{name.lower()}")
                 lt = await r.get(f"knock:last_time:{name.lower()}")
                 if lt:
                     proto_last_times[name.lower()] = int(lt)
             payload["history"] = history
-            payload["proto_histories"] = proto_histories
             payload["proto_last_times"] = proto_last_times
 
         if include_protocol_config:
@@ -437,7 +1117,7 @@ class ConnectionManager:
             payload["intel_size"] = INTEL_SIZE
         return payload
 
-    async def connect(self, websocket: WebSocket):
+    async def connect(self, websocket: WebSocket, since=None, include_stats=True):
         if WS_MAX_CONNECTIONS and len(self.active_connections) >= WS_MAX_CONNECTIONS:
             await websocket.close(code=1008)
             return False
@@ -445,7 +1125,12 @@ class ConnectionManager:
             await websocket.accept()
             # The 100ms breather we discussed for Cloudflare stability
             await asyncio.sleep(0.1)
-            stats = await self.get_initial_data()
+            stats = await self.get_initial_data(since=since, include_stats=include_stats)
+            # Later stats_delta frames are diffed against the last broadcast, so the boards
+            # and counters stamped with its version must be that broadcast's, not live ones.
+            stats_version, base = stats_cache.version, stats_cache.broadcast_payload
+            if base:
+                stats = {**stats, **base}
             history = stats.get("history", [])
 
             payload = {
@@ -455,11 +1140,13 @@ class ConnectionManager:
                     "uptime_minutes": stats.get("uptime_minutes", 0),
                     "kpm": stats.get("kpm", 0.0),
                     "rolling_kpm": stats.get("rolling_kpm", 0.0),
+                    "rates": stats.get("rates"),
                     "last_knock_time": stats.get("last_knock_time"),
                     "last_lat": stats.get("last_lat"),
                     "last_lng": stats.get("last_lng"),
                     "top_locations": stats.get("top_locations", []),
                     "history": history if history else [],
+                    "history_since": stats.get("history_since"),
                     "top_passwords": stats.get("top_passwords", []),
                     "top_providers": stats.get("top_providers", []),
                     "top_users": stats.get("top_users", []),
@@ -468,15 +1155,19 @@ class ConnectionManager:
                     "proto_breakdown": stats.get("proto_breakdown", {}),
                     "enabled_protocols": stats.get("enabled_protocols", []),
                     "protocol_meta": stats.get("protocol_meta", {}),
-                    "proto_histories": stats.get("proto_histories", {}),
                     "proto_last_times": stats.get("proto_last_times", {}),
                     "cache_ts": stats.get("cache_ts"),
                     "last_knock_stats": history[0] if history else None,
                     "is_aggregator": stats.get("is_aggregator", False),
                     "source_counts": stats.get("source_counts", []),
                     "exclude_panels": list(EXCLUDE_PANELS),
+                    "stats_version": stats_version,
                 }
             }
+            if not include_stats:   # not read above; drop the empty defaults too
+                for key in SNAPSHOT_STATS_KEYS:
+                    payload["data"].pop(key, None)
+                payload["data"]["stats_omitted"] = True
             await websocket.send_json(payload)
             self.active_connections.append(websocket)
             return True
@@ -485,6 +1176,42 @@ class ConnectionManager:
             self.disconnect(websocket)
             return False
 
+    async def send_history(self, websocket: WebSocket, request: dict):
+        proto = str(request.get("proto") or "").upper()
+        if proto not in PROTO:
+            return
+        try:
+            before = int(request["before"]) if request.get("before") is not None else None
+            limit = int(request["limit"]) if request.get("limit") is not None else None
+        except (TypeError, ValueError):
+            return
+        items = await proto_history_cache.get(proto)
+        page, next_before = _history_page(items, before=before, limit=limit)
+        await websocket.send_json({
+            "type": "history",
+            "proto": proto.lower(),
+            "before": before,
+            "next_before": next_before,
+            "data": page,
+        })
+
+    async def send_stats(self, websocket: WebSocket):
+        """Full leaderboard resync for a client that missed a stats_delta: the broadcast
+        payload `stats_version` names, which the next delta is diffed against."""
+        version, payload = stats_cache.version, stats_cache.broadcast_payload
+        if payload is None:   # nothing broadcast yet; the first frame will be a full init_stats
+            payload = await self.get_initial_data(include_protocol_config=False, include_history=False)
+        await websocket.send_json({"type": "init_stats", "data": {**payload, "stats_version": version}})
+
+    async def send_leaderboards(self, websocket: WebSocket, request: dict):
+        """Windowed (today (UTC)/7d/30d) leaderboards, served from the leader's last refresh."""
+        window = request.get("window")
+        if window not in WINDOWS:
+            return
+        await websocket.send_json({"type": "leaderboards", "window": window,
+                                   "cache_ts": stats_cache.last_updated,
+                                   "data": stats_cache.windows.get(window, {})})
+
     def disconnect(self, websocket: WebSocket):
         if websocket in self.active_connections:
             self.active_connections.remove(websocket)
@@ -498,25 +1225,165 @@ class ConnectionManager:
 
 manager = ConnectionManager()
 
+class FeedSampler:
+    """Caps the live feed at `budget` knocks per second for every client.
+
+    Knocks go out as they arrive until a second's budget is spent. The rest of that
+    second, and every following second while arrivals stay over budget, is held in one
+    reservoir per protocol (Algorithm R, `budget` slots each). tick() then closes the
+    second: it forwards a sample that fills the unspent budget, split across protocols
+    by volume with every busy protocol getting a slot first, and reports the other held
+    knocks as exact per-protocol / country / source counts for a feed_summary frame.
+    Only the broadcast is sampled; the history and leaderboard caches see every knock."""
+
+    def __init__(self, budget, rng=None):
+        self.budget = budget
+        self.rng = rng or random.Random()
+        self.overloaded = False
+        self.sent = 0
+        self._clear()
+
+    def _clear(self):
+        self.reservoirs = {}   # proto -> sampled knocks
+        self.seen = {}         # proto -> knocks held this second
+        self.countries = {}
+        self.sources = {}
+        self.last_sid = None
+
+    def offer(self, knock):
+        """True if `knock` should be broadcast now; otherwise it is held for tick()."""
+        if not self.budget:
+            return True
+        if not self.overloaded and self.sent < self.budget:
+            self.sent += 1
+            return True
+        self.overloaded = True
+        proto = str(knock.get("proto") or "").upper()
+        seen = self.seen[proto] = self.seen.get(proto, 0) + 1
+        reservoir = self.reservoirs.setdefault(proto, [])
+        if len(reservoir) < self.budget:
+            reservoir.append(knock)
+        else:
+            slot = self.rng.randrange(seen)
+            if slot < self.budget:
+                reservoir[slot] = knock
+        if knock.get("iso"):
+            self.countries[knock["iso"]] = self.countries.get(knock["iso"], 0) + 1
+        if knock.get("source"):
+            self.sources[knock["source"]] = self.sources.get(knock["source"], 0) + 1
+        self.last_sid = knock.get("sid") or self.last_sid
+        return False
+
+    def _quotas(self, total):
+        caps = {proto: len(reservoir) for proto, reservoir in self.reservoirs.items()}
+        order = sorted(caps, key=lambda proto: -self.seen[proto])
+        quotas = {proto: 0 for proto in caps}
+        for proto in order[:total]:
+            quotas[proto] = 1
+        left = total - sum(quotas.values())
+        while left > 0:
+            open_protos = [proto for proto in order if quotas[proto] < caps[proto]]
+            if not open_protos:
+                break
+            weight = sum(self.seen[proto] for proto in open_protos)
+            shares = {proto: min(caps[proto] - quotas[proto], left * self.seen[proto] // weight)
+                      for proto in open_protos}
+            if not any(shares.values()):
+                shares = {proto: 1 for proto in open_protos[:left]}
+            for proto, n in shares.items():
+                quotas[proto] += n
+            left -= sum(shares.values())
+        return quotas
+
+    def tick(self):
+        """Close the current second. Returns (knocks to broadcast oldest first, feed_summary
+        data or None)."""
+        held = sum(self.seen.values())
+        sample, summary = [], None
+        if held:
+            for proto, n in self._quotas(max(0, self.budget - self.sent)).items():
+                sample += self.rng.sample(self.reservoirs[proto], n)
+            sample.sort(key=lambda knock: _sid_key(knock.get("sid")) or (0, 0))
+            protos, countries, sources = dict(self.seen), dict(self.countries), dict(self.sources)
+            for knock in sample:
+                protos[str(knock.get("proto") or "").upper()] -= 1
+                if knock.get("iso"):
+                    countries[knock["iso"]] -= 1
+                if knock.get("source"):
+                    sources[knock["source"]] -= 1
+            if held > len(sample):
+                summary = {
+                    "skipped": held - len(sample),
+                    "protos": {k: v for k, v in protos.items() if v},
+                    "countries": {k: v for k, v in countries.items() if v},
+                    "sources": {k: v for k, v in sources.items() if v},
+                    "last_sid": self.last_sid,
+                }
+        # Stay in sampling mode while this second's arrivals outran the budget.
+        self.overloaded = self.sent + held > self.budget
+        self.sent = 0
+        self._clear()
+        return sample, summary
+
+feed_sampler = FeedSampler(FEED_DISPLAY_BUDGET)
+
+async def feed_sampler_loop():
+    while True:
+        await asyncio.sleep(1)
+        sample, summary = feed_sampler.tick()
+        for knock in sample:
+            await manager.broadcast(json.dumps({"type": "new_knock", "data": knock}))
+        if summary:
+            await manager.broadcast(json.dumps({"type": "feed_summary", "data": summary}))
+
 async def redis_listener():
-    pubsub = r.pubsub()
-    await pubsub.subscribe("knocks_stream")
-    async for message in pubsub.listen():
-        if message["type"] == "message":
-            data = json.loads(message["data"])
-            rolling_kpm_tracker.record()
-            payload = json.dumps({"type": "new_knock", "data": data})
-            await manager.broadcast(payload)
+    # Resubscribe when the connection drops: Redis restarting, or with REDIS_MODE=embedded
+    # the monitor (which serves the bus) restarting.
+    while True:
+        pubsub = r.pubsub()
+        try:
+            await pubsub.subscribe("knocks_stream", STATS_CHANNEL)
+            async for message in pubsub.listen():
+                if message["type"] == "message" and message["channel"] == STATS_CHANNEL:
+                    try:
+                        await stats_cache.on_published(message["data"])
+                    except Exception as e:
+                        print(f"❌ Stats message error: {e}")
+                elif message["type"] == "message":
+                    data = json.loads(message["data"])
+                    proto_history_cache.record(data)
+                    stats_cache.record(data)
+                    if feed_sampler.offer(data):
+                        payload = json.dumps({"type": "new_knock", "data": data})
+                        await manager.broadcast(payload)
+        except (redis.ConnectionError, redis.TimeoutError, OSError) as e:
+            print(f"⚠️ Knock stream subscription lost ({e}); retrying", flush=True)
+        finally:
+            await pubsub.aclose()
+        await asyncio.sleep(2)
 
 
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
-    if not await manager.connect(websocket):
+    if not await manager.connect(websocket, since=websocket.query_params.get("since"),
+                                 include_stats=websocket.query_params.get("stats") != "0"):
         return
     try:
         while True:
-            # This handles incoming pings from the browser to keep CF alive
-            await websocket.receive_text()
+            # Incoming pings from the browser keep CF alive; JSON requests are answered.
+            text = await websocket.receive_text()
+            try:
+                request = json.loads(text)
+            except ValueError:
+                continue
+            if not isinstance(request, dict):
+                continue
+            if request.get("type") == "get_history":
+                await manager.send_history(websocket, request)
+            elif request.get("type") == "get_stats":
+                await manager.send_stats(websocket)
+            elif request.get("type") == "get_leaderboards":
+                await manager.send_leaderboards(websocket, request)
     except WebSocketDisconnect:
         manager.disconnect(websocket)
 
@@ -539,48 +1406,246 @@ def _read_page(path: str) -> str:
     html = _read_file(path)
     return html.replace('</head>', f'<style>{_HIDE_CSS}</style></head>', 1) if _HIDE_CSS else html
 
+
+class PageCache:
+    """Pages rendered once into memory with gzip/brotli variants and strong ETags.
+
+    A page is re-rendered only when its file's mtime changes, so edits still go live
+    without a restart. Responses keep Cache-Control: no-cache — browsers revalidate
+    every view, and an unchanged page costs a bodiless 304 instead of a re-download.
+    """
+
+    def __init__(self):
+        self._pages = {}   # path -> (mtime_ns, {encoding: bytes}, {encoding: etag})
+
+    def get(self, path: str, inject_css: bool = False):
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            raise HTTPException(status_code=404, detail="Not found")
+        cached = self._pages.get(path)
+        if cached and cached[0] == mtime:
+            return cached[1], cached[2]
+        body = (_read_page(path) if inject_css else _read_file(path)).encode()
+        digest = hashlib.sha256(body).hexdigest()[:20]
+        variants = {'identity': body}
+        if len(body) >= COMPRESS_MIN_BYTES:
+            for encoding in _available_encodings():
+                variants[encoding] = _compress(body, encoding)
+        etags = {encoding: _etag(digest, encoding) for encoding in variants}
+        self._pages[path] = (mtime, variants, etags)
+        return variants, etags
+
+    def response(self, request: Request, path: str, media_type: str = "text/html",
+                 inject_css: bool = False) -> Response:
+        variants, etags = self.get(path, inject_css)
+        encoding = _pick_encoding(request.headers.get('accept-encoding', ''), variants)
+        headers = {"Cache-Control": "no-cache", "ETag": etags[encoding], "Vary": "Accept-Encoding"}
+        if _etag_matches(request.headers.get('if-none-match', ''), etags[encoding]):
+            return Response(status_code=304, headers=headers)
+        if encoding != 'identity':
+            headers["Content-Encoding"] = encoding
+        return Response(content=variants[encoding], media_type=media_type, headers=headers)
+
+page_cache = PageCache()
+
+# Routes serving HTML pages; the visitor log counts their 304 revalidations as views too.
+_HTML_ROUTES = {'/', '/internet-background-radiation', '/blocklist', '/api', '/summary', '/summary.html'}
+
 @app.head("/")
 @app.get("/")
-async def get():
-    return HTMLResponse(content=_read_page("index.html"), headers={"Cache-Control": "no-cache"})
+async def get(request: Request):
+    return page_cache.response(request, "index.html", inject_css=True)
 
 @app.head("/internet-background-radiation")
 @app.get("/internet-background-radiation")
-async def get_ibr():
-    return HTMLResponse(content=_read_file("internet-background-radiation.html"), headers={"Cache-Control": "no-cache"})
+async def get_ibr(request: Request):
+    return page_cache.response(request, "internet-background-radiation.html")
 
 
 if ENABLE_BLOCKLIST:
     @app.head("/blocklist")
     @app.get("/blocklist")
-    async def get_blocklist_page():
-        return HTMLResponse(content=_read_file("blocklist.html"), headers={"Cache-Control": "no-cache"})
+    async def get_blocklist_page(request: Request):
+        return page_cache.response(request, "blocklist.html")
 
 if ENABLE_API:
     @app.head("/api")
     @app.get("/api")
-    async def get_api_page():
-        return HTMLResponse(content=_read_file("api.html"), headers={"Cache-Control": "no-cache"})
+    async def get_api_page(request: Request):
+        return page_cache.response(request, "api.html")
 
 @app.head("/summary")
 @app.get("/summary")
-async def get_summary():
-    return HTMLResponse(content=_read_page("summary.html"), headers={"Cache-Control": "no-cache"})
+async def get_summary(request: Request):
+    return page_cache.response(request, "summary.html", inject_css=True)
 
 @app.head("/summary.html")
 @app.get("/summary.html")
-async def get_summary_html():
-    return HTMLResponse(content=_read_page("summary.html"), headers={"Cache-Control": "no-cache"})
+async def get_summary_html(request: Request):
+    return page_cache.response(request, "summary.html", inject_css=True)
 
 @app.head("/sitemap.xml")
 @app.get("/sitemap.xml")
-async def get_sitemap():
-    return Response(content=_read_file("sitemap.xml"), media_type="application/xml", headers={"Cache-Control": "no-cache"})
+async def get_sitemap(request: Request):
+    return page_cache.response(request, "sitemap.xml", media_type="application/xml")
 
 @app.head("/robots.txt")
 @app.get("/robots.txt")
-async def get_robots():
-    return Response(content=_read_file("robots.txt"), media_type="text/plain", headers={"Cache-Control": "no-cache"})
+async def get_robots(request: Request):
+    return page_cache.response(request, "robots.txt", media_type="text/plain")
+
+# --- Historical knock query (/api/knocks) ---
+# Saved knocks (SAVE_KNOCKS) by protocol, IP and time range, streamed as NDJSON in
+# (timestamp, protocol, id) order. Each table is read KNOCK_QUERY_CHUNK rows at a time
+# through its (timestamp) or (ip_address, timestamp) index, borrowing a pooled
+# connection per chunk, and the tables are merged lazily, so memory stays flat however
+# many rows match. A page ends with {"next_cursor": ...} when more rows remain.
+ENABLE_KNOCK_QUERY = _flag('ENABLE_KNOCK_QUERY')
+KNOCK_QUERY_CHUNK = 500
+KNOCK_QUERY_MAX_LIMIT = 10000
+
+def _saved_knock_tables():
+    """{proto name: knock table} for every protocol whose table exists in the DB."""
+    with read_pool.connection() as conn:
+        existing = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+    return {name: meta["definition"].knock_table for name, meta in PROTOCOL_META.items()
+            if meta.get("definition") and meta["definition"].knock_table in existing}
+
+def _parse_knock_time(value):
+    """Epoch seconds or an ISO date/datetime (UTC unless it carries an offset) -> the
+    'YYYY-MM-DD HH:MM:SS' UTC form the knock tables store. Raises ValueError."""
+    value = value.strip()
+    if value.isdigit():
+        dt = datetime.fromtimestamp(int(value), timezone.utc)
+    else:
+        dt = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        if dt.tzinfo is not None:
+            dt = dt.astimezone(timezone.utc)
+    return dt.strftime("%Y-%m-%d %H:%M:%S")
+
+def _encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode().rstrip("=")
+
+def _decode_cursor(text):
+    """Inverse of _encode_cursor: (timestamp, proto, id). Raises ValueError."""
+    try:
+        ts, proto, rowid = json.loads(base64.urlsafe_b64decode(text + "=" * (-len(text) % 4)))
+    except Exception:
+        raise ValueError("bad cursor")
+    if not isinstance(ts, str) or not isinstance(proto, str) or not isinstance(rowid, int):
+        raise ValueError("bad cursor")
+    return ts, proto, rowid
+
+def _iter_knock_table(proto, table, ip=None, since=None, until=None, after=None):
+    """(key, knock) pairs from one knock table in key order, strictly after cursor `after`."""
+    last = None
+    if after:
+        # Rows sort by (timestamp, proto, id): past the cursor's timestamp this table
+        # resumes after its id, at it (any id) or strictly after it (no id).
+        a_ts, a_proto, a_id = after
+        last = (a_ts, a_id if proto == a_proto else -1 if proto > a_proto else 2 ** 63 - 1)
+    while True:
+        where, args = [], []
+        if ip:
+            where.append("ip_address = ?")
+            args.append(ip)
+        if since:
+            where.append("timestamp >= ?")
+            args.append(since)
+        if until:
+            where.append("timestamp < ?")
+            args.append(until)
+        if last:
+            # The bare `timestamp >= ?` lets SQLite seek the index instead of rescanning it.
+            where.append("timestamp >= ? AND (timestamp > ? OR id > ?)")
+            args += [last[0], last[0], last[1]]
+        with read_pool.connection() as conn:
+            rows = conn.execute(f"SELECT * FROM {table} WHERE {' AND '.join(where) or '1'} "
+                                f"ORDER BY timestamp, id LIMIT {KNOCK_QUERY_CHUNK}", args).fetchall()
+        for row in rows:
+            knock = {"proto": proto, **dict(row)}
+            yield (knock["timestamp"], proto, knock["id"]), knock
+        if len(rows) < KNOCK_QUERY_CHUNK:
+            return
+        last = (rows[-1]["timestamp"], rows[-1]["id"])
+
+def query_knocks(tables, ip=None, since=None, until=None, after=None, limit=1000):
+    """NDJSON lines: up to `limit` knocks merged across `tables` ({proto: table}), then a
+    {"next_cursor": ...} line if more match."""
+    merged = heapq.merge(*[_iter_knock_table(proto, table, ip, since, until, after)
+                           for proto, table in sorted(tables.items())], key=lambda item: item[0])
+    last_key = None
+    for n, (key, knock) in enumerate(merged):
+        if n == limit:
+            yield json.dumps({"next_cursor": _encode_cursor(last_key)}) + "\n"
+            return
+        last_key = key
+        yield json.dumps(knock) + "\n"
+
+if ENABLE_KNOCK_QUERY:
+    @app.get("/api/knocks")
+    async def get_knocks(proto: str | None = None, ip: str | None = None, since: str | None = None,
+                         until: str | None = None, cursor: str | None = None, limit: int = 1000):
+        try:
+            ip = str(ipaddress.ip_address(ip.strip())) if ip else None
+            since = _parse_knock_time(since) if since else None
+            until = _parse_knock_time(until) if until else None
+            after = _decode_cursor(cursor) if cursor else None
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        if not 1 <= limit <= KNOCK_QUERY_MAX_LIMIT:
+            raise HTTPException(status_code=400, detail=f"limit must be 1-{KNOCK_QUERY_MAX_LIMIT}")
+        try:
+            tables = await asyncio.get_running_loop().run_in_executor(None, _saved_knock_tables)
+        except sqlite3.Error:
+            tables = {}
+        if proto:
+            proto = proto.strip().upper()
+            if proto not in PROTO:
+                raise HTTPException(status_code=400, detail=f"unknown protocol {proto}")
+            if proto not in tables:
+                raise HTTPException(status_code=404, detail=f"{proto} knocks are not saved")
+            tables = {proto: tables[proto]}
+        return StreamingResponse(query_knocks(tables, ip, since, until, after, limit),
+                                 media_type="application/x-ndjson",
+                                 headers={"Cache-Control": "no-store"})
+
+def format_metrics(rates, total, ws_connections):
+    """Prometheus text exposition of the knock rates, the global total and this worker's
+    WebSocket connection count. `rates` is a knock_rates snapshot (or None)."""
+    lines = [
+        "# HELP knock_total Knocks recorded since the counters were reset.",
+        "# TYPE knock_total counter",
+        f"knock_total {total}",
+        "# HELP knock_ws_connections WebSocket clients connected to this worker.",
+        "# TYPE knock_ws_connections gauge",
+        f"knock_ws_connections {ws_connections}",
+    ]
+    if rates:
+        scopes = [("global", "all", rates.get("global", {}))]
+        scopes += [("proto", name, v) for name, v in sorted(rates.get("proto", {}).items())]
+        scopes += [("source", name, v) for name, v in sorted(rates.get("source", {}).items())]
+        for metric, prefix, help_text in (("knock_rate_kpm", "kpm", "Average knocks per minute over the window."),
+                                          ("knock_peak_kpm", "peak_kpm", "Highest 1-minute knock count within the window.")):
+            lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} gauge"]
+            for scope, name, values in scopes:
+                name = str(name).replace("\\", "\\\\").replace('"', '\\"')
+                for window in RATE_WINDOWS:
+                    value = values.get(f"{prefix}_{window}")
+                    if value is not None:
+                        lines.append(f'{metric}{{scope="{scope}",name="{name}",window="{window}"}} {value}')
+    return "\n".join(lines) + "\n"
+
+@app.get("/metrics")
+async def get_metrics():
+    try:
+        total = int(await r.get("knock:total_global") or 0)
+    except Exception:
+        total = 0
+    body = format_metrics(await load_rates(), total, len(manager.active_connections))
+    return Response(content=body, media_type="text/plain; version=0.0.4",
+                    headers={"Cache-Control": "no-store"})
 
 if __name__ == "__main__":
     ssl_args = {}
@@ -26,13 +26,17 @@ DB_PATH = os.environ.get('DB_DIR', 'data') + '/knock_knock.db'
 TRACE_KNOCK     = os.environ.get('TRACE_KNOCK', '').lower()  # 'true' or 'verbose'
 REDIS_DB        = int(os.environ.get('REDIS_DB', '0'))
 FEED_SIZE       = int(os.environ.get('FEED_SIZE', '100'))
+FEED_STREAM_LEN = int(os.environ.get('FEED_STREAM_LEN', '2000'))  # ~cap of the shared feed stream
 SOURCE_ID       = os.environ.get('SOURCE_ID', socket.gethostname().split('.')[0])
 AGGREGATOR_HOST = os.environ.get('AGGREGATOR_HOST', '').strip()
 AGGREGATOR_PORT = int(os.environ.get('AGGREGATOR_PORT', '9999'))
 INGEST_PORT     = int(os.environ.get('INGEST_PORT', '0') or '0') or None
 
-from constants import (PROTO, PROTO_NAME, PROTOCOL_META, sort_protocols_for_ui,
+from constants import (PROTO, PROTO_NAME, PROTOCOL_META, FEED_STREAM, SOURCES_VERSION_KEY, proto_feed_stream, sort_protocols_for_ui,
                        require_schema_version, stamp_schema_version)
+from intel_windows import WindowRollups, init_window_tables
+from knock_rates import KnockRates, start_rate_publisher
+from knock_bus import REDIS_EMBEDDED, start_bus
 
 USER_PANEL_PROTOCOLS = {name for name, meta in PROTOCOL_META.items() if meta.get('supports_user_panel')}
 PASS_PANEL_PROTOCOLS = {name for name, meta in PROTOCOL_META.items() if meta.get('supports_pass_panel')}
@@ -430,6 +434,9 @@ def reset_all():
             print(f"   [+] Deleted {DB_PATH}")
         except Exception as e:
             print(f"   [!] Error deleting {DB_PATH}: {e}")
+    if REDIS_EMBEDDED:
+        print("   [+] Embedded bus: state is in memory, nothing to clear")
+        return
     try:
         r = redis.Redis(host=os.environ.get('REDIS_HOST', 'localhost'), port=6379, db=REDIS_DB, decode_responses=True)
         preserve = {'knock:alerted:'}
@@ -441,6 +448,42 @@ def reset_all():
     except Exception as e:
         print(f"   [!] Error clearing Redis: {e}")
 
+def migrate_recent_lists(r):
+    """One-time move of the pre-stream feed lists (knock:recent, knock:recent:<proto>)
+    into FEED_STREAM, so an upgrade keeps its feed. IDs are derived from each knock's
+    `t`, keeping them ordered and meaningful as resume cursors."""
+    keys = ["knock:recent"] + [f"knock:recent:{name.lower()}" for name in PROTO]
+    if not any(r.exists(k) for k in keys):
+        return
+    if not r.exists(FEED_STREAM):
+        knocks = {}
+        for key in keys:
+            for raw in r.lrange(key, 0, -1):
+                knocks.setdefault(raw, json.loads(raw))
+        last_ms, seq = 0, 0
+        for raw, knock in sorted(knocks.items(), key=lambda kv: int(kv[1].get("t") or 0)):
+            ms = max(int(knock.get("t") or 0) * 1000, last_ms, 1)
+            seq = seq + 1 if ms == last_ms else 0
+            last_ms = ms
+            r.xadd(FEED_STREAM, {"proto": knock.get("proto", ""), "knock": raw}, id=f"{ms}-{seq}")
+        print(f"📦 Moved {len(knocks)} recent knocks into {FEED_STREAM}", flush=True)
+    r.delete(*keys)
+
+def backfill_proto_feeds(r):
+    """One-time fill of the per-protocol feed streams from FEED_STREAM, for trees that
+    predate them. Entries keep their shared-stream IDs, so `sid` means the same in both."""
+    if not r.exists(FEED_STREAM) or any(r.exists(proto_feed_stream(name)) for name in PROTO):
+        return
+    per_proto = {}
+    for sid, fields in r.xrevrange(FEED_STREAM):
+        items = per_proto.setdefault(str(fields.get("proto", "")).lower(), [])
+        if len(items) < FEED_SIZE:
+            items.append((sid, fields))
+    for name, items in per_proto.items():
+        for sid, fields in reversed(items):
+            r.xadd(proto_feed_stream(name), fields, id=sid)
+    print(f"📦 Filled {len(per_proto)} per-protocol feed streams from {FEED_STREAM}", flush=True)
+
 def _ensure_columns(cur, table, columns):
     """Add any missing columns to an existing table (idempotent)."""
     existing = {row[1] for row in cur.execute(f"PRAGMA table_info({_sql_ident(table)})").fetchall()}
@@ -465,6 +508,10 @@ def init_db(save_protos=None, enabled_protocols=None):
         # Add any columns declared by the protocol definition but missing from
         # the existing table — handles protocol schema additions without migration.
         _ensure_columns(cur, definition.knock_table, definition.columns)
+        # Time-range and per-IP history lookups (/api/knocks). Building them on an existing
+        # large table is a one-off cost at the first start after an upgrade.
+        cur.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_ts ON {table}(timestamp)")
+        cur.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_ip_ts ON {table}(ip_address, timestamp)")
         # Knock-linked side-tables (e.g. smtp_body_intel) are created WITH the knock table —
         # only when the protocol is saved, since they hold nothing without it.
         for extra in definition.extra_tables:
@@ -532,6 +579,8 @@ def init_db(save_protos=None, enabled_protocols=None):
     cur.execute("CREATE INDEX IF NOT EXISTS idx_country_intel_proto_hits ON country_intel_proto(proto, hits DESC)")
     cur.execute("CREATE INDEX IF NOT EXISTS idx_isp_intel_proto_hits ON isp_intel_proto(proto, hits DESC)")
     cur.execute("CREATE INDEX IF NOT EXISTS idx_ip_intel_proto_hits ON ip_intel_proto(proto, hits DESC)")
+    # Day-bucketed rollups + pre-merged today/7d/30d window tables (intel_windows.py)
+    init_window_tables(cur)
     stamp_schema_version(conn)   # a freshly-created DB is current; mark it for the startup gate
     conn.commit()
     conn.close()
@@ -548,8 +597,9 @@ def _load_sources(conn):
     hits    = {row[1]: row[3] or 0 for row in rows}
     return encode, decode, hits
 
-def _ensure_source(source_id, encode, decode):
-    """Return integer id for source_id, registering a new row if first seen."""
+def _ensure_source(source_id, encode, decode, r=None):
+    """Return integer id for source_id, registering a new row if first seen (and bumping
+    SOURCES_VERSION_KEY in Redis so the web tier reloads its sources cache)."""
     if source_id in encode:
         return encode[source_id]
     conn = sqlite3.connect(DB_PATH, timeout=10)
@@ -561,6 +611,11 @@ def _ensure_source(source_id, encode, decode):
         conn.close()
     encode[source_id] = new_id
     decode[new_id] = source_id
+    if r is not None:
+        try:
+            r.incr(SOURCES_VERSION_KEY)
+        except Exception:
+            pass
     print(f"[INGEST] Registered new source: {source_id!r} → id={new_id}", flush=True)
     return new_id
 
@@ -728,12 +783,19 @@ def get_intel_stats_before_update(data):
     return stats
 
 _db_write_queue = queue.Queue()
+WINDOW_ROLL_SECONDS = 60   # an idle DB writer still rolls the window tables this often
 
 def _start_db_writer(save_protos):
     def _writer():
         conn = sqlite3.connect(DB_PATH, timeout=30)
+        rollups = WindowRollups()
         while True:
-            items = [_db_write_queue.get()]
+            try:
+                items = [_db_write_queue.get(timeout=WINDOW_ROLL_SECONDS)]
+            except queue.Empty:
+                # No knocks for a while: still advance the window tables past UTC midnight,
+                # so the today/7d/30d boards don't keep serving yesterday's totals.
+                items = []
             deadline = time.monotonic() + 0.1
             while True:
                 remaining = deadline - time.monotonic()
@@ -747,9 +809,12 @@ def _start_db_writer(save_protos):
             try:
                 for package in items:
                     log_to_enriched_db(package, cur, save_protos=save_protos)
+                    rollups.add(package, PROTO.get(package.get('proto') or '', 0))
+                rollups.flush(cur)
                 conn.commit()
             except Exception as e:
                 print(f"⚠️ DB writer error ({len(items)} knock(s)): {e}", flush=True)
+                rollups.discard()
                 try:
                     conn.rollback()
                 except Exception:
@@ -878,7 +943,10 @@ def monitor(save_knocks=None, max_knocks=None, ban_duration_days=30):
     global _read_conn
     _read_conn = sqlite3.connect(DB_PATH, timeout=10)
     _start_db_writer(save_protos)
-    r = redis.Redis(host=os.environ.get('REDIS_HOST', 'localhost'), port=6379, db=REDIS_DB, decode_responses=True)
+    if REDIS_EMBEDDED:   # state lives here; main.py, honeypots and ip_ban.py use the socket
+        r = start_bus()
+    else:
+        r = redis.Redis(host=os.environ.get('REDIS_HOST', 'localhost'), port=6379, db=REDIS_DB, decode_responses=True)
     publish_protocol_config(r, enabled_protocols)
     entry_strs = [entry.label() for entry in proto_entries]
     print(f"🧭 Enabled protocols: {', '.join(entry_strs)}", flush=True)
@@ -945,6 +1013,11 @@ def monitor(save_knocks=None, max_knocks=None, ban_duration_days=30):
             r.set(f"knock:uptime:{proto_name.lower()}", proto_up)
     except Exception as e:
         print(f"⚠️ Could not seed totals from SQLite: {e}")
+    try:
+        migrate_recent_lists(r)
+        backfill_proto_feeds(r)
+    except Exception as e:
+        print(f"⚠️ Could not migrate recent-knock lists: {e}")
 
     # Spawn enabled honeypots as subprocesses
     honeypots = {}
@@ -1000,6 +1073,8 @@ def monitor(save_knocks=None, max_knocks=None, ban_duration_days=30):
     signal.signal(signal.SIGINT, cleanup)
 
     threading.Thread(target=heartbeat_worker, args=(r, enabled_protocols), daemon=True).start()
+    knock_rates = KnockRates()
+    start_rate_publisher(r, knock_rates)
 
     print("🚀 Knock-Knock Monitor Active...")
 
@@ -1061,7 +1136,7 @@ def monitor(save_knocks=None, max_knocks=None, ban_duration_days=30):
             try:
                 # Source tagging — integer for SQLite, string+display for Redis/WebSocket
                 _src_id = knock.get('source', SOURCE_ID)
-                package['source_int']     = _ensure_source(_src_id, _src_encode, _src_decode)
+                package['source_int']     = _ensure_source(_src_id, _src_encode, _src_decode, r)
                 package['source']         = _src_id
                 package['source_display'] = _src_decode.get(package['source_int'], _src_id)
                 # Pass through protocol-specific extended telemetry into Redis/websocket payloads.
@@ -1090,12 +1165,11 @@ def monitor(save_knocks=None, max_knocks=None, ban_duration_days=30):
                 print(f"⚠️ Knock processing error (knock dropped): {e}", flush=True)
                 continue
             _after_save_hook(proto, knock, package)
-            r.lpush("knock:recent", json.dumps(package))
-            r.ltrim("knock:recent", 0, FEED_SIZE - 1)
-            proto_key = "knock:recent:" + package['proto'].lower()
-            r.lpush(proto_key, json.dumps(package))
-            r.ltrim(proto_key, 0, FEED_SIZE - 1)
+            entry = {"proto": package['proto'], "knock": json.dumps(package)}
+            sid = r.xadd(FEED_STREAM, entry, maxlen=FEED_STREAM_LEN, approximate=True)
+            r.xadd(proto_feed_stream(package['proto']), entry, id=sid, maxlen=FEED_SIZE, approximate=True)
             r.incr("knock:total_global")
+            knock_rates.record(package['proto'], package['source'])
             r.hincrby("knock:proto_counts", package['proto'], 1)
             r.hincrby("knock:source_counts", package['source'], 1)
             r.set("knock:last_time", package["t"])
@@ -1103,7 +1177,7 @@ def monitor(save_knocks=None, max_knocks=None, ban_duration_days=30):
             if geo['lat'] is not None:
                 r.set("knock:last_lat", geo['lat'])
                 r.set("knock:last_lng", geo['lng'])
-            r.publish("knocks_stream", json.dumps(package))
+            r.publish("knocks_stream", json.dumps({**package, "sid": sid}))
             if TRACE_KNOCK:
                 print(f"📡 {proto} {geo['iso']} | {geo['country']}, {ip} via {geo['isp']}")
             if TRACE_KNOCK == 'verbose':
@@ -14,7 +14,7 @@ import pytest
 # that don't have the full requirements installed (e.g. a dev laptop).
 # In CI, pip install -r requirements.txt runs first, so the real modules load.
 for _mod in (
-    'geoip2', 'geoip2.database',
+    'geoip2', 'geoip2.database', 'geoip2.errors',
     'impacket', 'impacket.examples', 'impacket.examples.secretsdump',
     'impacket.ntlm', 'impacket.spnego',
 ):
@@ -41,6 +41,11 @@ def wait_for_port(port, host='127.0.0.1', timeout=15):
     raise TimeoutError(f"Port {port} did not open within {timeout}s")
 
 
+# <NAME>_CERT_PATH / <NAME>_KEY_PATH env prefix -> file stem the honeypot would use
+_TLS_ENV = {'SMTP_TLS': 'smtp', 'HTTPS': 'https', 'MQTT_TLS': 'mqtt',
+            'NRED_TLS': 'nodered', 'SIP_TLS': 'sip_tls'}
+
+
 @pytest.fixture
 def honeypot_proc(tmp_path):
     """
@@ -49,8 +54,9 @@ def honeypot_proc(tmp_path):
         proc, q = honeypot_proc('ssh_honeypot_asyncssh.py', port=12022,
                                  env={'SSH_PORT': '12022'})
 
-    The subprocess is started with DB_DIR pointing at a per-test tmp dir so
-    it never touches the real data/ directory.  Redis is pointed at localhost
+    The subprocess is started with DB_DIR and every TLS cert/key path pointing
+    at a per-test tmp dir so it never touches the real data/ directory (and a
+    generated key can't end up in the tree or an image).  Redis is pointed at localhost
     but is_blocked() silently ignores connection failures, so Redis doesn't
     need to be running.
     """
@@ -62,6 +68,9 @@ def honeypot_proc(tmp_path):
             'REDIS_HOST': '127.0.0.1',
             'DB_DIR': str(tmp_path),
         }
+        for name, stem in _TLS_ENV.items():
+            base_env[f'{name}_CERT_PATH'] = str(tmp_path / f'{stem}.crt')
+            base_env[f'{name}_KEY_PATH'] = str(tmp_path / f'{stem}.key')
         if env:
             base_env.update(env)
         cmd = [sys.executable, os.path.join(HONEYPOTS_DIR, script)] + list(args)
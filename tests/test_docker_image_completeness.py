@@ -82,9 +82,11 @@ def _dockerfile_copied_html():
 
 
 def _served_html():
-    """HTML files main.py serves via _read_file('X.html') — these must be in the image."""
+    """HTML files main.py serves via _read_file('X.html') or page_cache.response(request,
+    'X.html') — these must be in the image."""
     served = set()
-    for m in re.finditer(r"""_read_file\(\s*["']([^"']+\.html)["']""", (ROOT / "main.py").read_text()):
+    pattern = r"""(?:_read_file\(|page_cache\.response\(\s*request,)\s*["']([^"']+\.html)["']"""
+    for m in re.finditer(pattern, (ROOT / "main.py").read_text()):
         served.add(m.group(1))
     return served
 
@@ -92,7 +94,7 @@ def _served_html():
 def test_dockerfile_ships_all_html_the_web_server_serves():
     served = _served_html()
     copied = _dockerfile_copied_html()
-    assert served, "sanity: expected main.py to serve at least one .html via _read_file"
+    assert served, "sanity: expected main.py to serve at least one .html page"
     missing = served - copied
     assert not missing, (
         f"Dockerfile COPY is missing HTML page(s) that main.py serves: {sorted(missing)}. "
@@ -0,0 +1,367 @@
+"""
+Unit tests for the knock-api service (extras/api/knock_api.py).
+
+Skipped where FastAPI isn't installed: the CI unit-test job installs only the
+monitor's dependencies. Nothing here touches the network or a real Redis.
+"""
+import os
+import sqlite3
+import sys
+
+import pytest
+
+pytest.importorskip('fastapi')
+pytest.importorskip('uvicorn')
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _ROOT)
+sys.path.insert(0, os.path.join(_ROOT, 'honeypots'))
+sys.path.insert(0, os.path.join(_ROOT, 'extras', 'api'))
+
+import knock_api
+import monitor
+
+
+# ---------------------------------------------------------------------------
+# knock_api.SnapshotBuilder
+# ---------------------------------------------------------------------------
+
+def _snapshot_contents(snaps):
+    return {(w, v): (list(s.ips), {c: list(a) for c, a in s.columns.items()},
+                     list(s.proto_ips), {c: list(a) for c, a in s.protos.items()},
+                     {asn: [s.ips[i] for i in s.asn_members(asn)] for asn in s.asn_keys},
+                     [{n: list(a) for n, a in agg.arrays().items()} for agg in (s.prefixes, s.asns)])
+            for w, families in snaps.items() for v, s in families.items()}
+
+
+def test_snapshot_incremental_refresh_matches_full_rebuild(tmp_path, monkeypatch):
+    from datetime import datetime, timedelta
+    db = tmp_path / 'knock_knock.db'
+    monkeypatch.setattr(monitor, 'DB_PATH', str(db))
+    monkeypatch.setattr(knock_api, 'KNOCK_DB', db)
+    monitor.init_db(save_protos=False)
+    now = datetime(2026, 10, 1, 12, 0, 0)
+    ago = lambda days: (now - timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+    conn = sqlite3.connect(db)
+    conn.executemany('INSERT INTO ip_intel (ip, hits, last_seen, asn, first_seen, ban_until) '
+                     'VALUES (?, ?, ?, ?, ?, ?)', [
+        ('10.0.0.5', 7, ago(1), 100, ago(50), 0),        # both windows, banned for good
+        ('10.0.0.1', 1, ago(29.9), 100, None, None),     # ages out of month
+        ('10.0.0.9', 2, ago(364.9), 200, ago(365), None),  # ages out of year
+        ('10.0.0.7', 3, ago(100), 300, ago(100), None),  # year only, re-seen under a new ASN
+        ('10.0.0.3', 1, ago(400), 300, ago(400), None),  # outside both, re-seen
+        ('10.0.0.4', 1, ago(2), None, ago(2), None),     # no ASN known
+        ('2001:db8::5', 6, ago(1), 100, ago(40), None),  # IPv6, same ASN as 10.0.0.5
+        ('2001:db8::1', 1, ago(200), 500, ago(200), None),
+    ])
+    conn.executemany('INSERT INTO ip_intel_proto (ip, proto, hits, last_seen) VALUES (?, ?, ?, ?)', [
+        ('10.0.0.5', 0, 2, ago(3)), ('10.0.0.5', 5, 5, ago(1)),
+        ('10.0.0.7', 0, 3, ago(100)), ('10.0.0.9', 1, 2, ago(364.9)), ('2001:db8::5', 0, 6, ago(1)),
+    ])
+    conn.commit()
+
+    builder = knock_api.SnapshotBuilder(tmp_path / 'snapshot.bin')
+    builder.rebuild(now)
+    before, header, _ = knock_api.load_snapshots(builder.path)
+    year, year6 = before['year'][4], before['year'][6]
+    assert [knock_api.ip_str(n) for n in year.ips] == [
+        '10.0.0.1', '10.0.0.4', '10.0.0.5', '10.0.0.7', '10.0.0.9']
+    assert [knock_api.ip_str(n) for n in before['month'][4].ips] == ['10.0.0.1', '10.0.0.4', '10.0.0.5']
+    assert list(year.asn_keys) == [100, 200, 300] and header['high_water'] == ago(1)
+    assert [knock_api.ip_str(n, 6) for n in year6.ips] == ['2001:db8::1', '2001:db8::5']
+    assert [knock_api.ip_str(year6.ips[i], 6) for i in year6.asn_members(100)] == ['2001:db8::5']
+    assert year6.hit(year6.find(int(knock_api.ipaddress.IPv6Address('2001:db8::5'))))['protocols'] == [
+        {'proto': knock_api.PROTO_NAME[0], 'hits': 6, 'last_seen': ago(1)}]
+    assert len(before['month'][6].ips) == 1
+    i = year.find(int(knock_api.ipaddress.IPv4Address('10.0.0.5')))
+    assert year.hit(i) == {'ip': '10.0.0.5', 'hits': 7, 'first_seen': ago(50), 'last_seen': ago(1),
+                           'protocols': [{'proto': knock_api.PROTO_NAME[5], 'hits': 5, 'last_seen': ago(1)},
+                                         {'proto': knock_api.PROTO_NAME[0], 'hits': 2, 'last_seen': ago(3)}]}
+    assert year.columns['ban_until'][i] == 0
+    assert year.hit(year.find(int(knock_api.ipaddress.IPv4Address('10.0.0.1'))))['first_seen'] is None
+
+    later = now + timedelta(days=1)
+    seen = later.strftime('%Y-%m-%d %H:%M:%S')
+    conn.execute('UPDATE ip_intel SET hits=4, last_seen=?, asn=400 WHERE ip=?', (seen, '10.0.0.7'))
+    conn.execute('UPDATE ip_intel SET hits=2, last_seen=? WHERE ip=?', (seen, '10.0.0.3'))
+    conn.executemany('INSERT INTO ip_intel (ip, hits, last_seen, asn, first_seen) VALUES (?, 1, ?, 100, ?)',
+                     [('10.0.0.2', seen, seen), ('2001:db8::3', seen, seen)])
+    conn.executemany('INSERT OR REPLACE INTO ip_intel_proto (ip, proto, hits, last_seen) VALUES (?, ?, ?, ?)', [
+        ('10.0.0.7', 0, 4, seen), ('10.0.0.3', 2, 1, seen), ('10.0.0.2', 0, 1, seen),
+        ('2001:db8::3', 1, 1, seen)])
+    conn.commit()
+    conn.close()
+
+    builder.refresh(later)
+    refreshed = knock_api.load_snapshots(builder.path)[0]
+    knock_api.SnapshotBuilder(tmp_path / 'expected.bin').rebuild(later)
+    expected = knock_api.load_snapshots(tmp_path / 'expected.bin')[0]
+    assert _snapshot_contents(refreshed) == _snapshot_contents(expected)
+    assert [knock_api.ip_str(n) for n in refreshed['year'][4].ips] == [
+        '10.0.0.1', '10.0.0.2', '10.0.0.3', '10.0.0.4', '10.0.0.5', '10.0.0.7']
+    assert [knock_api.ip_str(n) for n in refreshed['month'][4].ips] == [
+        '10.0.0.2', '10.0.0.3', '10.0.0.4', '10.0.0.5', '10.0.0.7']
+    assert list(refreshed['month'][4].protos['hits']) == [1, 1, 5, 2, 4]
+    assert [knock_api.ip_str(n, 6) for n in refreshed['month'][6].ips] == ['2001:db8::3', '2001:db8::5']
+    assert list(year.asn_keys) == [100, 200, 300]   # a mapped file outlives its replacement
+
+
+def test_splice_remap_and_group_splice_agree():
+    from array import array
+    src = array('I', [10, 20, 30, 40, 50])
+    drop, inserts = [(1, 3)], [(1, (15,)), (4, (45,)), (5, (55,))]
+    (out,) = knock_api._splice([src], drop, inserts)
+    assert list(out) == [10, 15, 40, 45, 50, 55]
+    remap = knock_api._remap(len(src), drop, [i for i, _ in inserts])
+    assert [out[j] if j != knock_api.GONE else None for j in remap] == [10, None, None, 40, 50]
+    # keys 1, 3, 5 with runs [a], [b, c], []; replace 3, drop 5, add 4
+    keys, (col,), offsets, (rows,) = knock_api._splice_groups(
+        array('Q', [1, 3, 5]), array('I', [0, 1, 3, 3]), [array('I', [7, 8, 9])], [array('I', [1, 2, 3])],
+        {3: ((80,), [(6,)]), 4: ((90,), [(7,), (8,)]), 5: None})
+    assert list(keys) == [1, 3, 4] and list(col) == [7, 80, 90]
+    assert list(offsets) == [0, 1, 2, 4] and list(rows) == [1, 6, 7, 8]
+
+
+def test_rebuild_check_logs_only_real_drift(tmp_path, monkeypatch, capsys):
+    from datetime import datetime, timedelta
+    db = tmp_path / 'knock_knock.db'
+    monkeypatch.setattr(monitor, 'DB_PATH', str(db))
+    monkeypatch.setattr(knock_api, 'KNOCK_DB', db)
+    monitor.init_db(save_protos=False)
+    now = datetime(2026, 10, 1, 12, 0, 0)
+    stamp = lambda t: t.strftime('%Y-%m-%d %H:%M:%S')
+    conn = sqlite3.connect(db)
+    conn.executemany('INSERT INTO ip_intel (ip, hits, last_seen, asn) VALUES (?, ?, ?, ?)', [
+        ('10.0.0.1', 3, stamp(now - timedelta(days=2)), 100), ('10.0.0.2', 1, stamp(now - timedelta(days=3)), 100),
+        ('2001:db8::1', 2, stamp(now - timedelta(days=1)), 200)])
+    conn.commit()
+    builder = knock_api.SnapshotBuilder(tmp_path / 'snapshot.bin')
+    builder.rebuild(now)
+
+    # Knocks landing after the refresh that precedes the check are not drift
+    later = now + timedelta(hours=1)
+    conn.execute('UPDATE ip_intel SET hits=4, last_seen=? WHERE ip=?', (stamp(later), '10.0.0.1'))
+    conn.execute('INSERT INTO ip_intel (ip, hits, last_seen) VALUES (?, 1, ?)', ('10.0.0.9', stamp(later)))
+    conn.commit()
+    with monkeypatch.context() as m:
+        m.setattr(builder, 'refresh', lambda now: None)
+        builder.rebuild(later, check=True)
+    assert capsys.readouterr().err == ''
+
+    # Changes a refresh can't see are
+    conn.execute('DELETE FROM ip_intel WHERE ip=?', ('10.0.0.2',))
+    conn.execute('UPDATE ip_intel SET ban_until=0 WHERE ip=?', ('2001:db8::1',))
+    conn.commit()
+    conn.close()
+    builder.rebuild(later + timedelta(minutes=10), check=True)
+    err = capsys.readouterr().err
+    assert 'snapshot drift (IPv4): only in incremental 1' in err
+    assert 'snapshot drift (IPv6): ban_until 1' in err
+
+
+def test_prefix_and_asn_aggregates():
+    from array import array
+    ip4 = lambda s: int(knock_api.ipaddress.IPv4Address(s))
+    ips = ['10.0.0.1', '10.0.0.9', '10.0.1.5', '10.0.2.1']
+    snap = knock_api.Snapshot(4, [array('I', map(ip4, ips))],
+                              [array('I', [5, 9, 7, 1]), array('I', [100, 100, 0, 200]), array('I', [3, 4, 9, 4]),
+                               array('I', [1] * 4), array('I', [knock_api.NO_BAN] * 4)],
+                              [array('I', map(ip4, ['10.0.0.1', '10.0.0.3', '10.0.0.9', '10.0.0.9']))],
+                              [array('I', [0, 2, 1, 0]), array('I', [3, 8, 3, 1]), array('I', [5, 5, 9, 9])])
+    rows = list(snap.per_ip())
+    assert [mix for *_, mix in rows] == [[(0, 3)], [(1, 3), (0, 1)], [], []]   # orphaned 10.0.0.3 skipped
+    prefixes = knock_api._aggregate((ip >> 8, hits, seen, mix) for ip, _, hits, seen, mix in rows)
+    assert [knock_api.ip_str(k << 8) for k in prefixes.keys] == ['10.0.0.0', '10.0.1.0', '10.0.2.0']
+    assert list(prefixes.ips) == [2, 1, 1] and list(prefixes.hits) == [7, 9, 4]
+    assert prefixes.row(0) == {'ips': 2, 'hits': 7, 'last_seen': knock_api._ts(9),
+                               'protocols': [{'proto': knock_api.PROTO_NAME[0], 'hits': 4},
+                                             {'proto': knock_api.PROTO_NAME[1], 'hits': 3}]}
+    assert list(prefixes.by_hits) == [prefixes.keys[g] for g in (1, 0, 2)]
+    assert list(prefixes.by_ips) == list(prefixes.keys)   # ties in key order
+    assert knock_api.ranked(prefixes, 'hits', 1, 5) == (3, [0, 2])
+    assert knock_api.ranked(prefixes, 'hits', 0, 5, range(1, 3)) == (2, [1, 2])
+    asns = knock_api._aggregate((snap.columns['asn'][i], hits, seen, mix)
+                                for _, i, hits, seen, mix in rows if snap.columns['asn'][i])
+    assert list(asns.keys) == [100, 200] and asns.find(100) == 0 and asns.find(0) is None
+    assert list(asns.hits) == [7, 4] and list(asns.proto_offsets) == [0, 2, 2]
+
+
+def test_aggregates_fold_a_delta_like_a_rebuild():
+    # IP -> (group, hits, last_seen, mix), shaped like Snapshot.contrib; 10 and 11 share group 1
+    before = {10: (1, 3, 5, [(0, 3)]), 11: (1, 2, 9, [(1, 2)]), 20: (2, 4, 4, [(0, 4)]), 30: (3, 1, 7, [])}
+    after = {10: (1, 3, 5, [(0, 3)]), 20: (2, 9, 8, [(0, 5), (2, 4)]), 30: (5, 1, 7, []), 40: (4, 2, 6, [(1, 2)])}
+    scratch = lambda ips: knock_api._aggregate(ips[ip] for ip in sorted(ips))
+    changes = [(ip, before.get(ip), after.get(ip)) for ip in before.keys() | after.keys()
+               if before.get(ip) != after.get(ip)]
+    deltas = knock_api._group_deltas(changes, lambda ip, c: c[0])
+    newest = lambda key: max(row[2] for row in after.values() if row[0] == key)   # 11 held group 1's last_seen
+    folded = knock_api._fold(scratch(before), deltas, newest)
+    assert folded.arrays() == scratch(after).arrays()
+    assert list(folded.by_hits) == [2, 1, 4, 5] and folded.row(folded.find(1))['last_seen'] == knock_api._ts(5)
+
+
+def test_bulk_entries_parse_and_match():
+    from array import array
+    entries = knock_api.parse_entries(
+        ['10.0.0.7', '', '# comment', '10.0.1.9/24  # host bits are masked', '::ffff:10.0.0.5',
+         '2001:db8::/32', '10.0.0.6'])
+    assert [(e[0], e[3]) for e in entries] == [
+        (4, '10.0.0.7'), (4, '10.0.1.9/24'), (4, '::ffff:10.0.0.5'), (6, '2001:db8::/32'), (4, '10.0.0.6')]
+    ip4 = lambda s: int(knock_api.ipaddress.IPv4Address(s))
+    family = {4: knock_api.Snapshot(4, [array('I', map(ip4, ['10.0.0.5', '10.0.0.7', '10.0.1.1', '10.0.1.200']))]),
+              6: knock_api.Snapshot(6)}
+    assert [(lo, hi) for _, lo, hi in knock_api.bulk_spans(family, entries)] == [
+        (1, 2), (2, 4), (0, 1), (0, 0), (1, 1)]
+    for bad in ('10.0.0.0/33', 'nope', '10.0.0.0/', '10.0.0.0/8', '2001:db8::/31'):
+        with pytest.raises(knock_api.HTTPException) as e:
+            knock_api.parse_entries(['10.0.0.1', bad])
+        assert e.value.detail['error'].startswith('line 2: ')
+
+
+def test_bulk_drops_duplicate_and_covered_entries():
+    entries = knock_api.parse_entries(
+        ['10.0.3.7', '10.0.0.0/16', '10.0.3.0/24', '10.0.0.0/16', '::ffff:10.0.3.7', '10.1.0.1',
+         '2001:db8::1', '2001:db8::/32', '10.1.0.1'])
+    assert [e[3] for e in knock_api.drop_covered(entries)] == ['10.0.0.0/16', '10.1.0.1', '2001:db8::/32']
+
+
+def test_response_cache_lru_and_etags():
+    from types import SimpleNamespace
+    small = knock_api.serialize({'hits': []}, '2026-10-01T12:00:00Z')
+    big = knock_api.serialize({'hits': ['x' * 1500]}, '2026-10-01T12:00:00Z')
+    assert not small[2] and big[2]   # only bodies of GZIP_MIN_BYTES and up are compressed
+    assert big[3] == (knock_api.calendar.timegm((2026, 10, 1, 12, 0, 0, 0, 0, 0))
+                      + knock_api.REFRESH_SECONDS + knock_api.RELOAD_SECONDS)
+    entries = {key: knock_api.serialize({'hits': [os.urandom(500).hex()]}, '2026-10-01T12:00:00Z')
+               for key in 'abc'}
+    cache = knock_api.ResponseCache(max_bytes=2 * max(len(e[1]) for e in entries.values()))
+    cache.put('a', entries['a'])
+    cache.put('b', entries['b'])
+    cache.get('a')
+    cache.put('c', entries['c'])   # room for two: the least recently used, b, goes
+    assert list(cache.entries) == ['a', 'c'] and cache.size <= cache.max_bytes
+    request = lambda tags: SimpleNamespace(headers={'if-none-match': tags} if tags else {})
+    assert knock_api.not_modified(request(f'"other", W/{small[0]}'), small)
+    assert knock_api.not_modified(request('*'), small)
+    assert not knock_api.not_modified(request(big[0]), small) and not knock_api.not_modified(request(None), small)
+
+
+def test_ndjson_response_streams_summary_then_chunked_rows(monkeypatch):
+    import asyncio
+    import json
+    from array import array
+    monkeypatch.setattr(knock_api, 'STREAM_CHUNK', 2)
+    snap = knock_api.Snapshot(4, [array('I', range(1, 6))], [array('I', [t] * 5) for t in (0, 7, 3, 0, 0)])
+    response = knock_api.ndjson_response({'total_matched': 4}, [({'query': 'a'}, snap, range(0, 3)),
+                                                                ({}, snap, array('I', [4]))])
+
+    async def chunks():
+        return [chunk async for chunk in response.body_iterator]
+    chunks = asyncio.run(chunks())
+    assert [len(c.splitlines()) for c in chunks] == [1, 2, 2]
+    rows = [json.loads(line) for c in chunks for line in c.splitlines()]
+    assert rows[0] == {'total_matched': 4}
+    assert [(r.get('query'), r['ip'], r['hits']) for r in rows[1:]] == [
+        ('a', '0.0.0.1', 3), ('a', '0.0.0.2', 3), ('a', '0.0.0.3', 3), (None, '0.0.0.5', 3)]
+
+
+# ---------------------------------------------------------------------------
+# knock_api rate limiting (GUARD_LUA, LEASE_LUA, GlobalBudget)
+# ---------------------------------------------------------------------------
+
+@pytest.fixture
+def api_redis(monkeypatch):
+    """knock_api wired to an in-process fakeredis with both Lua scripts registered."""
+    fakeredis = pytest.importorskip('fakeredis')
+    pytest.importorskip('lupa')   # fakeredis runs EVAL/EVALSHA through lupa
+    r = fakeredis.FakeAsyncRedis(server=fakeredis.FakeServer(), decode_responses=True)
+    monkeypatch.setattr(knock_api, 'R', r)
+    monkeypatch.setattr(knock_api, 'guard_script', r.register_script(knock_api.GUARD_LUA))
+    monkeypatch.setattr(knock_api, 'lease_script', r.register_script(knock_api.LEASE_LUA))
+    return r
+
+
+def test_guard_refusal_charges_no_window(api_redis, monkeypatch):
+    import asyncio
+    monkeypatch.setattr(knock_api, 'CHECK_CAP', 2)
+    day, hour = 'knock:api:rl:day:192.0.2.1', 'knock:api:rl:check-asn:192.0.2.1'
+
+    async def run():
+        await knock_api.guard('192.0.2.1', 'check-asn')
+        await knock_api.guard('192.0.2.1', 'check-asn')
+        with pytest.raises(knock_api.HTTPException) as e:
+            await knock_api.guard('192.0.2.1', 'check-asn')
+        assert e.value.status_code == 429 and 3590 <= int(e.value.headers['Retry-After']) <= 3600
+        assert await api_redis.get(day) == '2' and await api_redis.get(hour) == '2'
+
+        # the first full window sets Retry-After: here the daily cap, before the hourly one
+        await api_redis.set(day, knock_api.DAY_CAP, ex=100)
+        with pytest.raises(knock_api.HTTPException) as e:
+            await knock_api.guard('192.0.2.1', 'check-asn')
+        assert 95 <= int(e.value.headers['Retry-After']) <= 100
+        assert await api_redis.get(hour) == '2'
+
+        # a cost above the cap is refused outright, without charging the daily cap
+        with pytest.raises(knock_api.HTTPException):
+            await knock_api.guard('192.0.2.2', 'check-bulk', cost=knock_api.BULK_HOUR_CAP + 1)
+        assert await api_redis.get('knock:api:rl:day:192.0.2.2') is None
+        assert await api_redis.get('knock:api:rl:check-bulk:192.0.2.2') is None
+        assert await api_redis.get('knock:api:rate_limited:count') == '3'
+    asyncio.run(run())
+
+
+def test_check_bulk_refuses_a_limited_client_before_reading_its_body(api_redis, monkeypatch):
+    import asyncio
+    from types import SimpleNamespace
+    monkeypatch.setattr(knock_api, 'snapshots', {'year': {}})
+    hour = 'knock:api:rl:check-bulk:192.0.2.3'
+
+    async def unread(request):
+        raise AssertionError('body read for a client over its limit')
+    monkeypatch.setattr(knock_api, 'read_bulk', unread)
+    request = SimpleNamespace(headers={'cf-connecting-ip': '192.0.2.3'}, client=None)
+
+    async def run():
+        await knock_api.guard('192.0.2.3', 'check-bulk', charge=False)   # a check charges nothing
+        assert await api_redis.get(hour) is None and await api_redis.get('knock:api:rl:day:192.0.2.3') is None
+        await api_redis.set(hour, knock_api.BULK_HOUR_CAP, ex=60)
+        with pytest.raises(knock_api.HTTPException) as e:
+            await knock_api.check_bulk(request, 'year')
+        assert e.value.status_code == 429
+    asyncio.run(run())
+
+
+def test_global_budget_leases_locally_then_waits(api_redis, monkeypatch):
+    import asyncio
+    monkeypatch.setattr(knock_api, 'GLOBAL_MIN_CAP', 5)
+    monkeypatch.setattr(knock_api, 'GLOBAL_LEASE', 3)
+    monkeypatch.setattr(knock_api, 'WAIT_MAX', 2)
+    leases = []
+    script = knock_api.lease_script
+
+    async def lease(**kw):
+        leases.append(kw)
+        return await script(**kw)
+    monkeypatch.setattr(knock_api, 'lease_script', lease)
+
+    async def run():
+        budget = knock_api.GlobalBudget()
+        for _ in range(5):
+            await budget.take()
+        assert len(leases) == 2   # 3 tokens, then the 2 left in the window
+        assert await api_redis.get('knock:api:rl:global_min') == '5'
+
+        # A spent window that resets within WAIT_MAX: the waiters get the new one
+        await api_redis.pexpire('knock:api:rl:global_min', 300)
+        await asyncio.gather(budget.take(), budget.take())
+        assert len(leases) == 4   # one lease finds the window spent, one after it resets
+
+        # One that doesn't: 429 at once, with no further round trips for the next waiter
+        await api_redis.set('knock:api:rl:global_min', 5, ex=60)
+        budget = knock_api.GlobalBudget()
+        for _ in range(2):
+            with pytest.raises(knock_api.HTTPException) as e:
+                await budget.take()
+            assert e.value.status_code == 429 and 55 <= int(e.value.headers['Retry-After']) <= 60
+        assert len(leases) == 5
+    asyncio.run(run())
@@ -4,6 +4,7 @@ Unit tests for pure helper functions.
 No network connections, Redis, SQLite, or subprocess spawning — these
 functions are tested in isolation and cannot affect the DB or UI.
 """
+import hashlib
 import os
 import sqlite3
 import sys
@@ -18,6 +19,9 @@ sys.path.insert(0, os.path.join(_ROOT, 'honeypots'))
 
 from common import normalize_ip, extract_addr, smtp_tls_cert_subject, get_redis_client
 from ip_ban import fmt_ban_until
+from intel_windows import WindowRollups, init_window_tables
+from knock_rates import RateRing, KnockRates
+from knock_bus import BusStore, BusError, encode_reply, parse_commands, execute
 from ssh_honeypot_asyncssh import _clamp_delay_bounds
 import sip_honeypot
 import monitor
@@ -500,3 +504,189 @@ def test_redis_retry_makes_exactly_one_attempt():
     assert calls['n'] == 1
 
 
+
+
+# ---------------------------------------------------------------------------
+# intel_windows.WindowRollups
+# ---------------------------------------------------------------------------
+
+def _window_hits(cur, win):
+    return sorted(cur.execute("SELECT password, proto, hits FROM pass_intel_win WHERE win=?", (win,)))
+
+
+def test_window_rollups_merge_batch_into_day_and_windows():
+    cur = sqlite3.connect(':memory:').cursor()
+    init_window_tables(cur)
+    rollups = WindowRollups()
+    for proto in (0, 0, 1):
+        rollups.add({'pass': 'root', 'ip': '192.0.2.1', 'iso': 'US', 'isp': 'X'}, proto)
+    rollups.add({'ip': '192.0.2.2', 'iso': 'US', 'isp': 'X'}, 0)   # no password field
+    rollups.flush(cur, '2026-01-01')
+    assert cur.execute("SELECT day, password, proto, hits FROM pass_intel_day ORDER BY proto").fetchall() == \
+        [('2026-01-01', 'root', 0, 2), ('2026-01-01', 'root', 1, 1)]
+    assert _window_hits(cur, '7d') == [('root', -1, 3), ('root', 0, 2), ('root', 1, 1)]
+    assert rollups.counts == {}
+
+
+def test_window_rollups_slide_and_prune_on_day_rollover():
+    cur = sqlite3.connect(':memory:').cursor()
+    init_window_tables(cur)
+    rollups = WindowRollups()
+    rollups.add({'pass': 'root'}, 0)
+    rollups.flush(cur, '2026-01-01')
+    rollups.add({'pass': 'admin'}, 0)
+    rollups.flush(cur, '2026-01-02')
+    assert _window_hits(cur, 'today') == [('admin', -1, 1), ('admin', 0, 1)]
+    rollups.flush(cur, '2026-01-08')                     # 01-01 leaves the 7d window
+    assert _window_hits(cur, '7d') == [('admin', -1, 1), ('admin', 0, 1)]
+    assert ('root', -1, 1) in _window_hits(cur, '30d')
+    rollups.flush(cur, '2026-03-01')                     # catch up after downtime
+    assert _window_hits(cur, '30d') == []
+    assert cur.execute("SELECT COUNT(*) FROM pass_intel_day").fetchone()[0] == 0
+
+
+def test_idle_db_writer_still_rolls_the_windows(tmp_path, monkeypatch):
+    db = tmp_path / 'knocks.db'
+    with sqlite3.connect(db) as conn:
+        cur = conn.cursor()
+        init_window_tables(cur)
+        rollups = WindowRollups()
+        rollups.add({'pass': 'root'}, 0)
+        rollups.flush(cur, '2026-01-01')
+    monkeypatch.setattr(monitor, 'DB_PATH', str(db))
+    monkeypatch.setattr(monitor, 'WINDOW_ROLL_SECONDS', 0.01)
+    monkeypatch.setattr('intel_windows.utc_day', lambda: '2026-01-02')   # midnight passes, no knocks
+    monitor._start_db_writer(save_protos=set())
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        with sqlite3.connect(db) as conn:
+            if _window_hits(conn.cursor(), 'today') == []:
+                break
+        time.sleep(0.02)
+    with sqlite3.connect(db) as conn:
+        assert _window_hits(conn.cursor(), 'today') == []
+        assert ('root', -1, 1) in _window_hits(conn.cursor(), '7d')
+
+
+# ---------------------------------------------------------------------------
+# knock_rates.RateRing / KnockRates
+# ---------------------------------------------------------------------------
+
+def test_rate_ring_windows_and_peaks():
+    ring = RateRing(now=1000)
+    for t in range(1000, 1060):          # one knock a second for a minute
+        ring.record(t)
+    for _ in range(30):                  # then, after a gap, a burst of 30 in one second
+        ring.record(1200)
+    rates = ring.rates(1200)
+    assert rates['kpm_1m'] == 30.0       # only the burst is inside the last 60s
+    assert rates['peak_kpm_1m'] == 30.0
+    assert rates['peak_kpm_10m'] == 60.0  # the full minute of steady knocks
+    assert rates['kpm_10m'] == round(90 * 60.0 / 201, 1)   # still warming up
+    later = ring.rates(1200 + 660)       # the burst has left every 10m peak too
+    assert later['kpm_10m'] == 0.0 and later['peak_kpm_10m'] == 0.0
+    assert later['kpm_1h'] == round(90 * 60.0 / 861, 1)
+    assert later['peak_kpm_1h'] == 60.0
+
+
+def test_rate_ring_resets_after_idle_longer_than_ring():
+    ring = RateRing(now=0)
+    ring.record(0, n=5)
+    rates = ring.rates(10_000)
+    assert rates['kpm_1h'] == 0.0 and rates['peak_kpm_1h'] == 0.0
+    ring.record(10_000)
+    assert ring.rates(10_000)['kpm_1m'] == 1.0
+
+
+def test_knock_rates_snapshot_scopes():
+    rates = KnockRates()
+    rates.record('SSH', 'local', now=50)
+    rates.record('FTP', 'feeder-a', now=50)
+    snap = rates.snapshot(now=50)
+    assert snap['t'] == 50
+    assert set(snap['proto']) == {'SSH', 'FTP'}
+    assert set(snap['source']) == {'local', 'feeder-a'}
+    assert snap['proto']['SSH']['peak_kpm_1m'] == 1.0
+
+
+def test_knock_rates_new_scope_averages_over_engine_uptime():
+    rates = KnockRates(now=0)
+    rates.record('SSH', 'local', now=0)
+    ring = rates.protos['SSH']
+    rates.record('SSH', 'local', now=29)
+    assert rates.protos['SSH'] is ring                     # reused, not rebuilt per knock
+    rates.record('FTP', 'feeder-a', now=29)                # first FTP knock, 30 s after start
+    snap = rates.snapshot(now=29)
+    assert snap['proto']['FTP']['kpm_1h'] == 2.0           # 1 knock over 30 s, not 60 kpm
+    assert snap['source']['feeder-a']['kpm_1h'] == 2.0
+
+
+# ---------------------------------------------------------------------------
+# knock_bus.BusStore — embedded state (REDIS_MODE=embedded), in-process API
+# ---------------------------------------------------------------------------
+
+def test_bus_store_strings_hashes_and_expiry(monkeypatch):
+    store = BusStore()
+    assert store.set('knock:total_global', 5) is True
+    assert store.incr('knock:total_global') == 6
+    assert store.set('knock:total_global', 1, nx=True) is None
+    assert store.hincrby('knock:proto_counts', 'SSH', 2) == 2
+    assert store.hgetall('knock:proto_counts') == {'SSH': '2'}
+    with pytest.raises(BusError, match='WRONGTYPE'):
+        store.hget('knock:total_global', 'x')
+    now = [1000.0]
+    monkeypatch.setattr('knock_bus.time.monotonic', lambda: now[0])
+    store.set('knock:blocked:1.2.3.4', 1, ex=30)
+    assert store.exists('knock:blocked:1.2.3.4') == 1 and store.ttl('knock:blocked:1.2.3.4') == 30
+    now[0] += 31
+    assert store.exists('knock:blocked:1.2.3.4') == 0
+    assert store.keys('knock:blocked:*') == []
+
+
+def test_bus_store_stream_ranges_and_trim():
+    store = BusStore()
+    ids = [store.xadd('knock:feed', {'n': n}, id=f'100-{n}') for n in range(3)]
+    ids.append(store.xadd('knock:feed', {'n': 3}, id='200-0'))
+    assert [i for i, _ in store.xrevrange('knock:feed', count=2)] == ['200-0', '100-2']
+    assert [i for i, _ in store.xrevrange('knock:feed', max='+', min='(100-1')] == ['200-0', '100-2']
+    assert [i for i, _ in store.xrange('knock:feed', min='100', max='100')] == ids[:3]
+    assert [i for i, _ in store.xrevrange('knock:feed', max='(200', count=1)] == ['100-2']
+    with pytest.raises(BusError):
+        store.xadd('knock:feed', {'n': 9}, id='150-0')
+    store.xadd('knock:feed', {'n': 4}, maxlen=2, approximate=False)
+    assert store.xlen('knock:feed') == 2
+
+
+def test_backfill_proto_feeds_keeps_shared_ids_and_caps_each_protocol(monkeypatch):
+    monkeypatch.setattr(monitor, 'FEED_SIZE', 2)
+    store = BusStore()
+    for n, proto in enumerate(['FTP', 'SSH', 'SSH', 'SSH']):
+        store.xadd('knock:feed', {'proto': proto, 'knock': '{}'}, id=f'100-{n}')
+    monitor.backfill_proto_feeds(store)
+    assert [i for i, _ in store.xrange('knock:feed:ssh')] == ['100-2', '100-3']
+    assert [i for i, _ in store.xrange('knock:feed:ftp')] == ['100-0']
+    store.xadd('knock:feed:ftp', {'proto': 'FTP', 'knock': '{}'}, id='200-0')
+    monitor.backfill_proto_feeds(store)                       # already filled: a no-op
+    assert store.xlen('knock:feed:ssh') == 2 and store.xlen('knock:feed:ftp') == 2
+
+
+def test_bus_store_runs_redis_py_lock_scripts():
+    from redis.lock import Lock
+    store = BusStore()
+    store.set('leader', 'me', px=30000)
+    reacquire = hashlib.sha1(Lock.LUA_REACQUIRE_SCRIPT.encode()).hexdigest()
+    release = hashlib.sha1(Lock.LUA_RELEASE_SCRIPT.encode()).hexdigest()
+    assert execute(store, ['EVALSHA', reacquire, '1', 'leader', 'other', '30000']) == 0
+    assert execute(store, ['EVALSHA', reacquire, '1', 'leader', 'me', '30000']) == 1
+    assert execute(store, ['EVALSHA', release, '1', 'leader', 'me']) == 1
+    assert store.exists('leader') == 0
+    assert 'NOSCRIPT' in str(execute(store, ['EVAL', 'return 1', '0']))
+
+
+def test_bus_wire_format_round_trip():
+    commands, used = parse_commands(b'*2\r\n$3\r\nGET\r\n$1\r\na\r\nPING\r\n*1\r\n$4\r\nPI')
+    assert commands == [['GET', 'a'], ['PING']] and used == 26   # trailing partial command kept
+    assert encode_reply(None) == b'$-1\r\n' and encode_reply(None, resp3=True) == b'_\r\n'
+    assert encode_reply({'x': '1'}) == b'*2\r\n$1\r\nx\r\n$1\r\n1\r\n'
+    assert encode_reply({'x': '1'}, resp3=True) == b'%1\r\n$1\r\nx\r\n$1\r\n1\r\n'
+    assert encode_reply(execute(BusStore(), ['NOPE'])).startswith(b'-ERR unknown command')
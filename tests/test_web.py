@@ -0,0 +1,624 @@
+"""
+Unit tests for main.py (web tier) helpers.
+
+Importing main builds the FastAPI app but connects to nothing — the Redis client
+is lazy and the lifespan tasks never start — so these run offline.
+"""
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import sys
+
+import pytest
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _ROOT)
+os.chdir(_ROOT)  # main mounts ./static relative to the working directory
+
+import main
+import visitor_log
+
+
+# ---------------------------------------------------------------------------
+# main._history_page
+# ---------------------------------------------------------------------------
+
+def _knocks(*ts):
+    return [{'t': t, 'ip': f'192.0.2.{i}'} for i, t in enumerate(ts)]
+
+
+def test_history_page_first_page():
+    page, next_before = main._history_page(_knocks(9, 8, 7, 6), limit=2)
+    assert [k['t'] for k in page] == [9, 8]
+    assert next_before == 8
+
+
+def test_history_page_before_cursor():
+    page, next_before = main._history_page(_knocks(9, 8, 7, 6), before=8, limit=2)
+    assert [k['t'] for k in page] == [7, 6]
+    assert next_before is None
+
+
+def test_history_page_keeps_same_second_together():
+    page, next_before = main._history_page(_knocks(9, 8, 8, 8, 7), limit=2)
+    assert [k['t'] for k in page] == [9, 8, 8, 8]
+    assert next_before == 8
+    rest, _ = main._history_page(_knocks(9, 8, 8, 8, 7), before=next_before, limit=2)
+    assert [k['t'] for k in rest] == [7]
+
+
+def test_history_page_limit_clamped_to_feed_size():
+    page, _ = main._history_page(_knocks(*range(500, 0, -1)), limit=10_000)
+    assert len(page) == main.FEED_SIZE
+
+
+def test_proto_history_cache_record_only_when_seeded():
+    cache = main.ProtoHistoryCache()
+    cache.record({'t': 1, 'proto': 'SSH', 'sid': '1000-0'})
+    assert cache.histories is None
+    cache.histories = {'ssh': [{'t': 1, 'proto': 'SSH', 'sid': '1000-0'}]}
+    cache.record({'t': 1, 'proto': 'SSH', 'sid': '1000-0'})   # already in the seed read
+    cache.record({'t': 2, 'proto': 'SSH', 'sid': '2000-0'})
+    cache.record({'t': 2, 'proto': 'TNET', 'sid': '2000-1'})
+    assert [k['t'] for k in cache.histories['ssh']] == [2, 1]
+    assert [k['sid'] for k in cache.histories['tnet']] == ['2000-1']
+
+
+class _FakeFeed:
+    """Just enough of XRANGE/XREVRANGE over the feed streams for the feed helpers.
+
+    The shared stream holds the last `shared_len` entries; each per-protocol stream
+    holds all of that protocol's entries."""
+    def __init__(self, knocks, shared_len=None):
+        self.all = [(f'{k["t"]}000-{i}', {'proto': k['proto'], 'knock': main.json.dumps(k)})
+                    for i, k in enumerate(knocks)]
+        self.entries = self.all[-shared_len:] if shared_len else self.all
+
+    def _stream(self, name):
+        if name == main.FEED_STREAM:
+            return self.entries
+        return [e for e in self.all if main.proto_feed_stream(e[1]['proto']) == name]
+
+    def _bound(self, value, default):
+        if value in ('+', '-'):
+            return default, False
+        exclusive = value.startswith('(')
+        return main._sid_key(value.lstrip('(')), exclusive
+
+    async def xrevrange(self, name, max='+', min='-', count=None):
+        hi, hi_x = self._bound(max, (float('inf'), 0))
+        lo, lo_x = self._bound(min, (-1, 0))
+        out = [e for e in reversed(self._stream(name))
+               if (main._sid_key(e[0]) < hi if hi_x else main._sid_key(e[0]) <= hi)
+               and (main._sid_key(e[0]) > lo if lo_x else main._sid_key(e[0]) >= lo)]
+        return out[:count] if count else out
+
+    async def xrange(self, name, min='-', max='+', count=None):
+        return list(reversed(await self.xrevrange(name, max, min)))[:count]
+
+
+def test_proto_history_cache_seeds_quiet_protocols_past_the_shared_window(monkeypatch):
+    knocks = [{'t': 1, 'proto': 'FTP'}] + [{'t': t, 'proto': 'SSH'} for t in range(2, 9)]
+    feed = _FakeFeed(knocks, shared_len=3)   # the lone FTP knock has left the shared stream
+    monkeypatch.setattr(main, 'r', feed)
+    cache = main.ProtoHistoryCache()
+    ssh = asyncio.run(cache.get('SSH'))
+    assert [k['t'] for k in ssh] == [8, 7, 6, 5, 4, 3, 2]
+    assert [k['t'] for k in cache.histories['ftp']] == [1]
+    assert ssh[0]['sid'] == '8000-7'
+
+
+def test_feed_gap_resumes_or_falls_back(monkeypatch):
+    feed = _FakeFeed([{'t': t, 'proto': 'SSH'} for t in range(1, 6)])
+    monkeypatch.setattr(main, 'r', feed)
+    gap = asyncio.run(main.manager.get_feed_gap('3000-2'))
+    assert [k['t'] for k in gap] == [5, 4]
+    assert asyncio.run(main.manager.get_feed_gap('5000-4')) == []
+    feed.entries = feed.entries[3:]                      # trimmed past the cursor
+    assert asyncio.run(main.manager.get_feed_gap('2000-1')) is None
+    assert asyncio.run(main.manager.get_feed_gap('not-an-id')) is None
+
+
+# ---------------------------------------------------------------------------
+# main.build_stats_delta
+# ---------------------------------------------------------------------------
+
+def _stats(passwords, total=10, ssh_count=5):
+    return {
+        'total': total,
+        'top_passwords': [{'label': p, 'count': c} for p, c in passwords],
+        'proto_stats': {'0': {'top_passwords': [{'label': p, 'count': c} for p, c in passwords]}},
+        'proto_breakdown': {'SSH': {'count': ssh_count}, 'TNET': {'count': 1}},
+    }
+
+
+def _apply(lst, diff):
+    out = list(lst)[:diff['len']]
+    for rank, entry in diff['set']:
+        if rank < len(out):
+            out[rank] = entry
+        else:
+            out.append(entry)
+    return out
+
+
+def test_stats_delta_unchanged_is_empty():
+    s = _stats([('root', 5), ('admin', 3)])
+    assert main.build_stats_delta(s, s) == {}
+
+
+def test_stats_delta_sends_only_moved_ranks():
+    old = _stats([('root', 5), ('admin', 3), ('1234', 2)])
+    new = _stats([('root', 6), ('admin', 3), ('1234', 2)], total=11, ssh_count=6)
+    delta = main.build_stats_delta(old, new)
+    assert delta['set'] == {'total': 11}
+    assert delta['lists']['top_passwords'] == {'len': 3, 'set': [[0, {'label': 'root', 'count': 6}]]}
+    assert delta['proto_breakdown'] == {'SSH': {'count': 6}}
+    assert list(delta['proto_stats']['0']) == ['top_passwords']
+
+
+def test_stats_delta_reorder_and_shrink_round_trips():
+    old = _stats([('root', 5), ('admin', 3), ('1234', 2)])
+    new = _stats([('admin', 7), ('root', 5)])
+    delta = main.build_stats_delta(old, new)
+    assert _apply(old['top_passwords'], delta['lists']['top_passwords']) == new['top_passwords']
+
+
+def test_stats_delta_shape_change_needs_full_frame():
+    old = _stats([('root', 5)])
+    new = _stats([('root', 5)])
+    new['proto_stats']['1'] = {'top_passwords': []}
+    assert main.build_stats_delta(old, new) is None
+
+
+# ---------------------------------------------------------------------------
+# main.Leaderboard / GlobalStatsCache.record
+# ---------------------------------------------------------------------------
+
+def test_leaderboard_admits_value_that_beats_floor():
+    board = main.Leaderboard([{'label': 'root', 'count': 9}, {'label': 'admin', 'count': 4}],
+                             key_field='label', capacity=2)
+    assert board.update('1234', 3) is False            # below the floor
+    assert board.update('1234', 5) is True             # evicts 'admin'
+    assert [r['label'] for r in board.rows()] == ['root', '1234']
+
+
+def test_leaderboard_counts_never_go_backwards():
+    board = main.Leaderboard([{'label': 'root', 'count': 9}], key_field='label', capacity=10)
+    before = board.rows()
+    assert board.update('root', 8) is False
+    assert board.update('root', 10) is True
+    assert board.rows()[0]['count'] == 10
+    assert before[0]['count'] == 9                     # earlier snapshots are not mutated
+
+
+def test_stats_cache_record_updates_global_and_proto_boards():
+    cache = main.GlobalStatsCache()
+    ssh = main.PROTO['SSH']
+    for proto in (None, ssh):
+        cache.boards[('password', proto)] = main.Leaderboard([], key_field='label', capacity=5)
+        cache.boards[('ip', proto)] = main.Leaderboard([], key_field='label', capacity=5,
+                                                       defaults={'banned': False})
+    cache.enabled_protos = [ssh]
+    cache.record({'proto': 'SSH', 'pass': 'hunter2', 'pass_hits': 7, 'pass_hits_proto': 3,
+                  'ip': '192.0.2.1', 'ip_hits': 2, 'ip_hits_proto': 2})
+    assert cache.top_passwords == [{'label': 'hunter2', 'count': 7}]
+    assert cache.proto_stats[ssh]['top_passwords'] == [{'label': 'hunter2', 'count': 3}]
+    assert cache.top_ips == [{'label': '192.0.2.1', 'banned': False, 'count': 2}]
+    assert cache.proto_stats[ssh]['top_users'] == []
+
+
+def test_stats_cache_adopts_leader_snapshot():
+    cache = main.GlobalStatsCache()
+    payload = {
+        'top_passwords': [{'label': 'root', 'count': 4}],
+        'top_ips': [{'label': '192.0.2.1', 'count': 2, 'banned': True}],
+        'proto_stats': {'0': {'top_passwords': [{'label': 'root', 'count': 3}]}},
+        'cache_ts': '12:00:00',
+    }
+    cache._adopt({'leader': 'other:1', 'version': 7, 'payload': payload})
+    assert cache.version == 7
+    assert cache.enabled_protos == [0]
+    assert cache.top_passwords == payload['top_passwords']
+    assert cache.proto_stats[0]['top_passwords'] == [{'label': 'root', 'count': 3}]
+    # adopted boards keep updating live from the knock stream
+    cache.record({'proto': 'SSH', 'pass': 'root', 'pass_hits': 5, 'pass_hits_proto': 4})
+    assert cache.top_passwords == [{'label': 'root', 'count': 5}]
+    assert payload['top_passwords'] == [{'label': 'root', 'count': 4}]
+
+
+def test_stats_cache_loads_window_boards(tmp_path, monkeypatch):
+    import intel_windows
+    db = str(tmp_path / 'knock_knock.db')
+    conn = sqlite3.connect(db)
+    intel_windows.init_window_tables(conn.cursor())
+    conn.execute("CREATE TABLE country_intel (iso_code TEXT PRIMARY KEY, country TEXT, hits INTEGER, last_seen DATETIME)")
+    conn.execute("CREATE TABLE ip_intel (ip TEXT PRIMARY KEY, hits INTEGER, ban_until INTEGER)")
+    conn.execute("INSERT INTO country_intel VALUES ('US', 'United States', 9, NULL)")
+    conn.execute("INSERT INTO ip_intel VALUES ('192.0.2.1', 9, 0)")
+    rollups = intel_windows.WindowRollups()
+    rollups.add({'pass': 'root', 'iso': 'US', 'ip': '192.0.2.1'}, main.PROTO['SSH'])
+    rollups.flush(conn.cursor())
+    conn.commit()
+    conn.close()
+    monkeypatch.setattr(main, 'read_pool', main.ReadPool(db))
+    windows = main.GlobalStatsCache()._load_windows([main.PROTO['SSH']])
+    assert set(windows) == {'today', '7d', '30d'}
+    week = windows['7d']
+    assert week['top_passwords'] == [{'label': 'root', 'count': 1}]
+    assert week['top_locations'] == [{'iso': 'US', 'country': 'United States', 'count': 1}]
+    assert week['top_ips'] == [{'label': '192.0.2.1', 'count': 1, 'banned': True}]
+    assert week['proto_stats'][str(main.PROTO['SSH'])]['top_passwords'] == [{'label': 'root', 'count': 1}]
+    assert week['top_users'] == []
+
+
+# ---------------------------------------------------------------------------
+# main.StatsSnapshotFiles
+# ---------------------------------------------------------------------------
+
+def test_stats_snapshots_write_hashed_body_and_pointer(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, 'STATS_SNAPSHOT_KEEP', 2)
+    snapshots = main.StatsSnapshotFiles(str(tmp_path / 'stats'))
+    digests = [snapshots.write({'total': n, 'top_passwords': [], 'cache_ts': 'x'}, n) for n in range(3)]
+    latest = json.loads((tmp_path / 'stats' / 'latest.json').read_text())
+    assert latest == {'url': f'/stats/{digests[-1]}.json', 'stats_version': 2, 'generated_at': 'x'}
+    body = (tmp_path / 'stats' / f'{digests[-1]}.json').read_bytes()
+    assert json.loads(body)['total'] == 2
+    assert (tmp_path / 'stats' / f'{digests[-1]}.json.gz').exists()
+    assert not (tmp_path / 'stats' / f'{digests[0]}.json').exists()     # pruned past KEEP
+    assert not (tmp_path / 'stats' / f'{digests[0]}.json.gz').exists()
+    assert (tmp_path / 'stats' / f'{digests[1]}.json').exists()
+
+
+def test_initial_data_skips_leaderboards_the_page_already_has(monkeypatch):
+    fakeredis = pytest.importorskip('fakeredis')
+    monkeypatch.setattr(main, 'r', fakeredis.FakeAsyncRedis(decode_responses=True))
+    full = asyncio.run(main.manager.get_initial_data(include_protocol_config=False, include_history=False))
+    live = asyncio.run(main.manager.get_initial_data(include_protocol_config=False, include_history=False,
+                                                     include_stats=False))
+    assert set(full) - set(live) == set(main.SNAPSHOT_STATS_KEYS) - {'stats_version'}
+
+
+class _SentSocket:
+    def __init__(self):
+        self.sent = []
+
+    async def accept(self):
+        pass
+
+    async def send_json(self, message):
+        self.sent.append(message)
+
+
+def test_stats_resync_sends_the_broadcast_its_version_names(monkeypatch):
+    fakeredis = pytest.importorskip('fakeredis')
+    monkeypatch.setattr(main, 'r', fakeredis.FakeAsyncRedis(decode_responses=True))
+    cache = main.GlobalStatsCache()
+    cache.boards = {('password', None): main._new_board('password', [{'label': 'root', 'count': 5}])}
+    monkeypatch.setattr(main, 'stats_cache', cache)
+    base = asyncio.run(main.manager.get_initial_data(include_protocol_config=False, include_history=False))
+    cache.version, cache.broadcast_payload = 7, base
+    cache.record({'proto': 'SSH', 'pass': 'admin', 'pass_hits': 9})   # live boards move on
+    assert cache.top_passwords[0]['label'] == 'admin'
+
+    resync, connected = _SentSocket(), _SentSocket()
+    asyncio.run(main.manager.send_stats(resync))
+    assert asyncio.run(main.manager.connect(connected))
+    main.manager.disconnect(connected)
+    for sock in (resync, connected):
+        data = sock.sent[0]['data']
+        assert data['stats_version'] == 7
+        assert data['top_passwords'] == base['top_passwords']
+
+
+
+# ---------------------------------------------------------------------------
+# static/geo (extras/generate-geometry) and main.HashedAssetFiles
+# ---------------------------------------------------------------------------
+
+def _decode_arcs(topology):
+    arcs = []
+    for arc in topology['arcs']:
+        x = y = 0
+        points = []
+        for dx, dy in arc:
+            x, y = x + dx, y + dy
+            points.append((x, y))
+        arcs.append(points)
+    return arcs
+
+
+def test_geo_manifest_names_valid_topologies():
+    geo = os.path.join('static', 'geo')
+    with open(os.path.join(geo, 'manifest.json')) as f:
+        levels = json.load(f)['levels']
+    assert set(levels) == {'low', 'medium', 'high'}
+    sizes = {}
+    for level, name in levels.items():
+        with open(os.path.join(geo, name)) as f:
+            topology = json.load(f)
+        sizes[level] = sum(len(a) for a in topology['arcs'])
+        arcs = _decode_arcs(topology)
+        countries = topology['objects']['countries']['geometries']
+        assert len(countries) == 177
+        assert len(topology['objects']['cities']['geometries']) == 243
+        for g in countries:
+            for polygon in ([g['arcs']] if g['type'] == 'Polygon' else g['arcs']):
+                for refs in polygon:
+                    ring = []
+                    for ref in refs:
+                        points = arcs[ref] if ref >= 0 else arcs[~ref][::-1]
+                        assert not ring or ring[-1] == points[0]   # arcs chain end to start
+                        ring.extend(points if not ring else points[1:])
+                    assert ring[0] == ring[-1] and len(set(ring)) >= 3, g['properties']['NAME']
+    assert sizes['low'] < sizes['medium'] < sizes['high']
+
+
+def test_hashed_assets_cache_forever_except_pointer(tmp_path):
+    (tmp_path / 'manifest.json').write_text('{}')
+    (tmp_path / 'world-low.abc.json').write_text('{}')
+    assets = main.HashedAssetFiles(str(tmp_path), pointer='manifest.json', max_age=300)
+    scope = {'type': 'http', 'headers': []}
+    for name, expected in (('manifest.json', 'public, max-age=300'),
+                           ('world-low.abc.json', 'public, max-age=31536000, immutable')):
+        path = str(tmp_path / name)
+        response = assets.file_response(path, os.stat(path), scope)
+        assert response.headers['cache-control'] == expected
+
+
+# ---------------------------------------------------------------------------
+# main.ReadPool / SourcesCache
+# ---------------------------------------------------------------------------
+
+def _sources_db(tmp_path):
+    db = str(tmp_path / 'knock_knock.db')
+    conn = sqlite3.connect(db)
+    conn.execute("CREATE TABLE sources (source_id TEXT, display_name TEXT, first_seen TEXT, "
+                 "last_seen TEXT, active INTEGER DEFAULT 1)")
+    conn.execute("INSERT INTO sources (source_id, display_name) VALUES ('local', 'Home')")
+    conn.commit()
+    conn.close()
+    return db
+
+
+def test_read_pool_reuses_read_only_connections(tmp_path):
+    pool = main.ReadPool(_sources_db(tmp_path), size=2)
+    for _ in range(3):
+        with pool.connection() as conn:
+            assert conn.execute("SELECT COUNT(*) FROM sources").fetchone()[0] == 1
+    assert pool.opened == 1
+    with pytest.raises(sqlite3.OperationalError):
+        with pool.connection() as conn:
+            conn.execute("DELETE FROM sources")
+    with pool.connection() as conn:   # the failed connection was dropped, not reused
+        assert conn.execute("SELECT COUNT(*) FROM sources").fetchone()[0] == 1
+    assert pool.opened == 2
+
+
+class _FakeVersion:
+    def __init__(self):
+        self.version = None
+
+    async def get(self, key):
+        return self.version
+
+
+def test_sources_cache_reloads_only_on_new_version(tmp_path, monkeypatch):
+    db = _sources_db(tmp_path)
+    fake = _FakeVersion()
+    monkeypatch.setattr(main, 'r', fake)
+    monkeypatch.setattr(main, 'read_pool', main.ReadPool(db))
+    cache = main.SourcesCache()
+    assert asyncio.run(cache.get())['local']['display_name'] == 'Home'
+    conn = sqlite3.connect(db)
+    conn.execute("INSERT INTO sources (source_id) VALUES ('feeder-a')")
+    conn.commit()
+    conn.close()
+    assert set(asyncio.run(cache.get())) == {'local'}     # cached
+    fake.version = '1'                                    # the monitor registered a source
+    assert set(asyncio.run(cache.get())) == {'local', 'feeder-a'}
+    assert main._build_source_counts({'feeder-a': '3', 'local': '5'}, cache.meta)[0] == {
+        'source_id': 'local', 'display_name': 'Home', 'hits': 5, 'first_seen': None, 'last_seen': None}
+
+
+# ---------------------------------------------------------------------------
+# main.query_knocks (/api/knocks)
+# ---------------------------------------------------------------------------
+
+def _knocks_db(tmp_path):
+    db = str(tmp_path / 'knock_knock.db')
+    conn = sqlite3.connect(db)
+    for table, rows in (('knocks_ssh', [('2026-01-01 00:00:01', '192.0.2.1'), ('2026-01-01 00:00:02', '192.0.2.2'),
+                                        ('2026-01-01 00:00:02', '192.0.2.1')]),
+                        ('knocks_ftp', [('2026-01-01 00:00:02', '192.0.2.1'), ('2026-01-01 00:00:03', '192.0.2.1')])):
+        conn.execute(f"CREATE TABLE {table} (id INTEGER PRIMARY KEY AUTOINCREMENT, timestamp TEXT, ip_address TEXT)")
+        conn.executemany(f"INSERT INTO {table} (timestamp, ip_address) VALUES (?, ?)", rows)
+    conn.commit()
+    conn.close()
+    return db
+
+
+def _query(tables, **kw):
+    return [json.loads(line) for line in main.query_knocks(tables, **kw)]
+
+
+def test_query_knocks_merges_tables_and_pages_by_cursor(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, 'read_pool', main.ReadPool(_knocks_db(tmp_path)))
+    monkeypatch.setattr(main, 'KNOCK_QUERY_CHUNK', 2)
+    tables = {'SSH': 'knocks_ssh', 'FTP': 'knocks_ftp'}
+    everything = _query(tables, limit=10)
+    assert [(k['timestamp'][-2:], k['proto'], k['id']) for k in everything] == [
+        ('01', 'SSH', 1), ('02', 'FTP', 1), ('02', 'SSH', 2), ('02', 'SSH', 3), ('03', 'FTP', 2)]
+    seen, cursor = [], None
+    while True:
+        page = _query(tables, after=main._decode_cursor(cursor) if cursor else None, limit=2)
+        cursor = page.pop()['next_cursor'] if 'next_cursor' in page[-1] else None
+        seen += page
+        if not cursor:
+            break
+    assert seen == everything
+    by_ip = _query(tables, ip='192.0.2.1', since=main._parse_knock_time('2026-01-01T00:00:02Z'), limit=10)
+    assert [(k['proto'], k['id']) for k in by_ip] == [('FTP', 1), ('SSH', 3), ('FTP', 2)]
+
+
+def test_parse_knock_time_accepts_epoch_and_iso():
+    assert main._parse_knock_time('0') == '1970-01-01 00:00:00'
+    assert main._parse_knock_time('2026-01-01') == '2026-01-01 00:00:00'
+    assert main._parse_knock_time('2026-01-01T02:00:00+02:00') == '2026-01-01 00:00:00'
+    with pytest.raises(ValueError):
+        main._parse_knock_time('yesterday')
+    with pytest.raises(ValueError):
+        main._decode_cursor('not-a-cursor')
+
+
+# ---------------------------------------------------------------------------
+# main.FeedSampler
+# ---------------------------------------------------------------------------
+
+def _feed_knock(i, proto, iso='US'):
+    return {'sid': f'1000-{i}', 'proto': proto, 'iso': iso, 'source': 'local'}
+
+
+def test_feed_sampler_forwards_everything_when_disabled_or_under_budget():
+    assert main.FeedSampler(0).offer(_feed_knock(0, 'SSH'))
+    sampler = main.FeedSampler(3)
+    assert all(sampler.offer(_feed_knock(i, 'SSH')) for i in range(3))
+    assert sampler.tick() == ([], None)
+    assert not sampler.overloaded
+
+
+def test_feed_sampler_keeps_counts_exact_under_overload():
+    sampler = main.FeedSampler(4, rng=random.Random(1))
+    for i in range(4):
+        assert sampler.offer(_feed_knock(i, 'SSH'))
+    knocks = [_feed_knock(i, 'SSH', 'CN') for i in range(4, 40)] + [_feed_knock(40, 'FTP', 'DE')]
+    assert not any(sampler.offer(k) for k in knocks)
+    sample, summary = sampler.tick()            # budget already spent: summary only
+    assert sample == [] and summary['skipped'] == 37
+    assert summary['protos'] == {'SSH': 36, 'FTP': 1}
+    assert summary['last_sid'] == '1000-40'
+    assert sampler.overloaded
+    knocks = [_feed_knock(i, 'SSH', 'CN') for i in range(100, 130)] + [_feed_knock(130, 'FTP', 'DE')]
+    assert not any(sampler.offer(k) for k in knocks)
+    sample, summary = sampler.tick()
+    assert len(sample) == 4
+    assert [k['proto'] for k in sample].count('FTP') == 1   # quiet protocols still show
+    assert [k['sid'] for k in sample] == sorted(k['sid'] for k in sample)
+    assert summary['skipped'] == 27
+    assert summary['protos'] == {'SSH': 27}
+    assert summary['countries'] == {'CN': 27}
+    assert sampler.tick() == ([], None)         # a quiet second ends overload mode
+    assert not sampler.overloaded
+
+
+# ---------------------------------------------------------------------------
+# main.format_metrics
+# ---------------------------------------------------------------------------
+
+def test_format_metrics_labels_every_scope_and_window():
+    rates = {'global': {'kpm_1m': 2.0, 'kpm_10m': 1.5, 'kpm_1h': 1.0,
+                        'peak_kpm_1m': 4.0, 'peak_kpm_10m': 4.0, 'peak_kpm_1h': 9.0},
+             'proto': {'SSH': {'kpm_1m': 2.0}},
+             'source': {'fe"ed': {'peak_kpm_1h': 3.0}}}
+    text = main.format_metrics(rates, 42, 3)
+    assert 'knock_total 42\n' in text
+    assert 'knock_ws_connections 3\n' in text
+    assert 'knock_rate_kpm{scope="global",name="all",window="10m"} 1.5' in text
+    assert 'knock_peak_kpm{scope="global",name="all",window="1h"} 9.0' in text
+    assert 'knock_rate_kpm{scope="proto",name="SSH",window="1m"} 2.0' in text
+    assert 'knock_peak_kpm{scope="source",name="fe\\"ed",window="1h"} 3.0' in text
+    assert text.endswith('\n')
+    assert 'knock_rate_kpm' not in main.format_metrics(None, 0, 0)
+
+
+# ---------------------------------------------------------------------------
+# main.PageCache / content negotiation
+# ---------------------------------------------------------------------------
+
+def test_pick_encoding_prefers_brotli_and_honours_q0():
+    assert main._pick_encoding('gzip, deflate, br', {'identity', 'gzip', 'br'}) == 'br'
+    assert main._pick_encoding('gzip, br;q=0', {'identity', 'gzip', 'br'}) == 'gzip'
+    assert main._pick_encoding('br', {'identity', 'gzip'}) == 'identity'
+    assert main._pick_encoding('', {'identity', 'gzip'}) == 'identity'
+
+
+def test_etag_matches_list_and_weak_prefix():
+    assert main._etag_matches('"abc-gzip", "def"', '"def"')
+    assert main._etag_matches('W/"def"', '"def"')
+    assert main._etag_matches('*', '"def"')
+    assert not main._etag_matches('"abc"', '"abc-gzip"')
+
+
+def test_page_cache_rerenders_on_mtime_change(tmp_path):
+    page = tmp_path / 'page.html'
+    page.write_text('<html><head></head><body>' + 'x' * 2000 + '</body></html>')
+    cache = main.PageCache()
+    variants, etags = cache.get(str(page))
+    assert 'gzip' in variants and variants['identity'].endswith(b'</html>')
+    assert cache.get(str(page))[0] is variants          # served from memory
+    page.write_text('<html><head></head><body>changed</body></html>')
+    os.utime(page, ns=(0, os.stat(page).st_mtime_ns + 1_000_000))
+    variants2, etags2 = cache.get(str(page))
+    assert variants2['identity'].endswith(b'</html>') and b'changed' in variants2['identity']
+    assert 'gzip' not in variants2                      # below COMPRESS_MIN_BYTES
+    assert etags2['identity'] != etags['identity']
+
+
+# ---------------------------------------------------------------------------
+# visitor_log.VisitorLogger
+# ---------------------------------------------------------------------------
+
+def test_visitor_logger_batches_and_counts_drops(tmp_path):
+    db = str(tmp_path / 'visitors.db')
+    visitor_log.init_visitors_db(db)
+
+    async def burst():
+        logger = visitor_log.VisitorLogger(db, queue_size=3, flush_seconds=0.01)
+        logger.start()
+        for i in range(5):
+            logger.log(f'192.0.2.{i}', 'ua', None, '/', None, 'GET', 200)
+        await asyncio.sleep(0.1)
+        await logger.close()
+        return logger
+
+    logger = asyncio.run(burst())
+    assert (logger.written, logger.dropped) == (3, 2)
+    with sqlite3.connect(db) as conn:
+        rows = conn.execute('SELECT ip, page, status_code FROM visitor_events ORDER BY id').fetchall()
+    assert rows == [('192.0.2.0', '/', 200), ('192.0.2.1', '/', 200), ('192.0.2.2', '/', 200)]
+
+
+# ---------------------------------------------------------------------------
+# main's Redis calls against the embedded bus (knock_bus, REDIS_MODE=embedded)
+# ---------------------------------------------------------------------------
+
+def test_web_tier_redis_calls_work_over_embedded_bus(tmp_path, monkeypatch):
+    import redis.asyncio as aioredis
+    import knock_bus
+    store = knock_bus.BusStore()
+    server = knock_bus.BusServer(store, str(tmp_path / 'bus.sock')).start()
+    store.set(main.RATES_KEY, json.dumps({'global': {'kpm_10m': 4.0}}))
+    store.xadd(main.FEED_STREAM, {'proto': 'SSH', 'knock': '{"t": 1}'})
+
+    async def scenario():
+        client = aioredis.from_url(f"unix://{server.path}?db=0", decode_responses=True)
+        monkeypatch.setattr(main, 'r', client)
+        assert (await main.load_rates())['global']['kpm_10m'] == 4.0
+        [(_, fields)] = await client.xrevrange(main.FEED_STREAM, count=5)
+        assert fields['proto'] == 'SSH'
+        lock = client.lock(main.LEADER_KEY, timeout=30, thread_local=False)
+        assert await lock.acquire(blocking=False, token='a')
+        assert await lock.reacquire()
+        assert not await client.lock(main.LEADER_KEY, timeout=30).acquire(blocking=False)
+        pubsub = client.pubsub()
+        await pubsub.subscribe('knocks_stream')
+        assert (await pubsub.get_message(timeout=1))['type'] == 'subscribe'
+        assert store.publish('knocks_stream', '{"ip": "192.0.2.1"}') == 1   # from the monitor's thread
+        message = await pubsub.get_message(timeout=1)
+        assert message['data'] == '{"ip": "192.0.2.1"}'
+        await pubsub.aclose()
+        await client.aclose()
+
+    asyncio.run(scenario())
@@ -0,0 +1,163 @@
+"""
+Batched visitor-event logging, shared by main.py and extras/api/knock_api.py.
+
+Request handlers call VisitorLogger.log(), which only timestamps the event and puts it
+on a bounded asyncio queue. One writer task drains the queue every FLUSH_SECONDS and
+hands the batch to a dedicated single-thread executor, which does the GeoIP lookups and
+one executemany() + commit on a connection it keeps open. A crawler burst therefore
+costs one transaction per flush instead of a thread-pool slot and a connection per hit.
+When the queue is full, events are dropped and counted, never awaited.
+"""
+import asyncio
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+VISITOR_QUEUE_SIZE = int(os.environ.get('VISITOR_QUEUE_SIZE', '10000'))
+FLUSH_SECONDS = 0.25
+MAX_BATCH = 1000
+
+_INSERT = """
+    INSERT INTO visitor_events (timestamp, ip, page, query_string, method, status_code,
+                                city, region, country, iso_code, isp, asn, referrer, user_agent)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+
+def init_visitors_db(db_path):
+    """Create the append-only visitor_events table (a no-op when it exists). The legacy
+    daily-rollup `visitors` table (deduped by ip/date/page) is left in place untouched."""
+    conn = sqlite3.connect(db_path, timeout=10)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL").fetchone()
+        conn.execute("""CREATE TABLE IF NOT EXISTS visitor_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            timestamp INTEGER NOT NULL,
+            ip TEXT NOT NULL,
+            page TEXT NOT NULL DEFAULT '/',
+            query_string TEXT,
+            method TEXT,
+            status_code INTEGER,
+            city TEXT,
+            region TEXT,
+            country TEXT,
+            iso_code TEXT,
+            isp TEXT,
+            asn INTEGER,
+            referrer TEXT,
+            user_agent TEXT
+        )""")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_ve_ip_ts ON visitor_events(ip, timestamp)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_ve_page_ts ON visitor_events(page, timestamp)")
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def lookup_geo(ip, city_reader=None, asn_reader=None):
+    geo = {"city": None, "region": None, "country": None, "iso": None, "isp": None, "asn": None}
+    try:
+        if city_reader:
+            c_res = city_reader.city(ip)
+            geo["iso"] = c_res.country.iso_code
+            geo["country"] = c_res.country.name
+            geo["city"] = c_res.city.name
+            if c_res.subdivisions.most_specific.name:
+                geo["region"] = c_res.subdivisions.most_specific.name
+        if asn_reader:
+            a_res = asn_reader.asn(ip)
+            geo["isp"] = a_res.autonomous_system_organization
+            geo["asn"] = a_res.autonomous_system_number
+    except Exception:
+        pass
+    return geo
+
+
+class VisitorLogger:
+    """Bounded queue + single batching writer for visitor_events rows."""
+
+    def __init__(self, db_path, city_reader=None, asn_reader=None,
+                 queue_size=VISITOR_QUEUE_SIZE, flush_seconds=FLUSH_SECONDS):
+        self.db_path = str(db_path)
+        self.city_reader = city_reader
+        self.asn_reader = asn_reader
+        self.flush_seconds = flush_seconds
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.written = 0
+        self.dropped = 0
+        self._dropped_reported = 0
+        self._conn = None       # owned by the writer thread
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='visitor-log')
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+        return self._task
+
+    def log(self, ip, user_agent=None, referrer=None, page='/', query_string=None,
+            method=None, status_code=None):
+        """Queue one raw request event (no dedup). Never blocks; drops when full."""
+        try:
+            self.queue.put_nowait((int(time.time()), ip, page, query_string, method,
+                                   status_code, referrer, user_agent))
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    def _drain(self):
+        batch = []
+        while len(batch) < MAX_BATCH:
+            try:
+                batch.append(self.queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        return batch
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            await asyncio.sleep(self.flush_seconds)   # let the burst accumulate
+            batch.extend(self._drain())
+            await loop.run_in_executor(self._executor, self._write, batch)
+            if self.dropped != self._dropped_reported:
+                print(f"⚠️ Visitor log queue full: {self.dropped - self._dropped_reported} "
+                      f"event(s) dropped ({self.dropped} total)", flush=True)
+                self._dropped_reported = self.dropped
+
+    async def flush(self):
+        """Write whatever is queued now (used on shutdown)."""
+        loop = asyncio.get_running_loop()
+        while batch := self._drain():
+            await loop.run_in_executor(self._executor, self._write, batch)
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._close_conn)
+        self._executor.shutdown(wait=False)
+
+    def _close_conn(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _write(self, batch):
+        rows = []
+        for ts, ip, page, query_string, method, status_code, referrer, user_agent in batch:
+            geo = lookup_geo(ip, self.city_reader, self.asn_reader)
+            rows.append((ts, ip, page, query_string, method, status_code,
+                         geo['city'], geo['region'], geo['country'], geo['iso'],
+                         geo['isp'], geo['asn'], referrer, user_agent))
+        try:
+            if self._conn is None:
+                self._conn = sqlite3.connect(self.db_path, timeout=10)
+            with self._conn:
+                self._conn.executemany(_INSERT, rows)
+            self.written += len(rows)
+        except sqlite3.Error as e:
+            print(f"Visitor log error: {e} ({len(rows)} event(s) lost)", flush=True)
+            self._close_conn()   # reconnect on the next batch